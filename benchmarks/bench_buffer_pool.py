@@ -0,0 +1,68 @@
+# Run it like so: `python -m benchmarks.bench_buffer_pool`
+"""Decode speed and allocations of the pooled sample blocks (buffer_pool.py) against
+unpacking FeedData and converting them to an array, the path the array sinks took."""
+
+import argparse
+import time
+import tracemalloc
+
+import buffer_pool
+import dynamite_sampler_api as ds
+import feed_arrays
+
+
+def make_packets(n_packets: int, n_samples: int) -> list[bytearray]:
+    packets = []
+    for i in range(n_packets):
+        sample = (i % 1000 - 500).to_bytes(3, "little", signed=True) * 4
+        ssn = (i * n_samples) % 2**16
+        packets.append(bytearray(ssn.to_bytes(2, "little") + sample * n_samples))
+    return packets
+
+
+def decode_feeddatas(packets):
+    for packet in packets:
+        feeddatas = ds.DynamiteSampler.ADCFeed.unpack(packet).samples
+        feed_arrays.feeddatas_to_array(feeddatas)
+
+
+def decode_pooled(packets, pool: buffer_pool.BufferPool):
+    for packet in packets:
+        pool.decode(packet).release()
+
+
+def measure(func, *args) -> tuple[float, int]:
+    """Seconds taken and peak traced bytes."""
+    t0 = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - t0
+
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--packets", default=20000, type=int)
+    parser.add_argument("--samples", default=20, type=int, help="Samples per packet")
+    args = parser.parse_args()
+
+    packets = make_packets(args.packets, args.samples)
+    pool = buffer_pool.BufferPool(block_samples=args.samples)
+    n = args.packets * args.samples
+
+    print(f"{args.packets} packets of {args.samples} samples")
+    results = {
+        "FeedData": measure(decode_feeddatas, packets),
+        "pooled": measure(decode_pooled, packets, pool),
+    }
+    for name, (seconds, peak) in results.items():
+        print(
+            f"{name:>10}: {seconds:.3f}s {n / seconds / 1e6:6.2f} Msamples/s, "
+            f"peak {peak / 1024:7.1f} KiB"
+        )
+    print(f"Speedup: {results['FeedData'][0] / results['pooled'][0]:.1f}x")
+    print(pool)
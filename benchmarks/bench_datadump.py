@@ -0,0 +1,50 @@
+# Run it like so: `python -m benchmarks.bench_datadump`
+"""Parsing speed of datadump.py against evaluating the datadump line by line."""
+
+import argparse
+import ast
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+import datadump
+
+SAMPLE_DATA = pathlib.Path(__file__).parent.parent / "sample_data"
+
+
+def parse_naive(path: pathlib.Path) -> np.ndarray:
+    """The old way: ast.literal_eval on every line."""
+    with open(path) as f:
+        return np.array(
+            [ast.literal_eval(line)["channels"] for line in f], dtype=np.int32
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--repeat", default=10, type=int, help="Copies of the sample data to parse"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = pathlib.Path(tmp) / "datadump.txt"
+        sample = (SAMPLE_DATA / "datadump_20241212_123045.txt").read_bytes()
+        path.write_bytes(sample * args.repeat)
+        size = path.stat().st_size
+
+        t0 = time.perf_counter()
+        expected = parse_naive(path)
+        naive_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        dump = datadump.read_datadump(path)
+        fast_s = time.perf_counter() - t0
+        assert np.array_equal(dump.channels, expected)
+
+    print(f"{len(expected)} samples, {size / 1e6:.1f} MB")
+    print(f"{'literal_eval':>14}: {naive_s:.3f}s {size / naive_s / 1e6:8.1f} MB/s")
+    print(f"{'datadump':>14}: {fast_s:.3f}s {size / fast_s / 1e6:8.1f} MB/s")
+    print(f"Speedup: {naive_s / fast_s:.0f}x")
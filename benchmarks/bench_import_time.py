@@ -0,0 +1,53 @@
+# Run it like so: `python -m benchmarks.bench_import_time`
+"""Import time of the CLI modules, each in a fresh interpreter, and which heavy
+dependencies they pull in. stream.py is launched from automation many times a day, so
+its startup should stay fast and not load bleak/numpy unless a selected mode needs
+them."""
+
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = [
+    "stream",
+    "pipeline",
+    "replay",
+    "convert_captures",
+    "dynamite_sampler_bleak_util",
+]
+HEAVY = ["bleak", "numpy", "tqdm", "http.server"]
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+t = time.perf_counter() - t0
+print(json.dumps([t, [m for m in {heavy!r} if m in sys.modules]]))
+"""
+
+
+def import_time(module: str, repeat: int) -> tuple[float, list[str]]:
+    """Best of repeat import times in seconds, and the heavy modules it loaded."""
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY)],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        t, loaded = json.loads(out)
+        times.append(t)
+    return min(times), loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", default=5, type=int)
+    args = parser.parse_args()
+
+    print(f"{'module':>28} {'import ms':>10}  heavy dependencies loaded")
+    for module in MODULES:
+        t, loaded = import_time(module, args.repeat)
+        print(f"{module:>28} {t * 1000:10.1f}  {', '.join(loaded) or '-'}")
@@ -0,0 +1,53 @@
+# Run it like so: `python -m benchmarks.bench_pyramid`
+"""Query time of pyramid.Pyramid against the capture length: it should stay flat, as it
+depends on the pixel width only. Also times building the pyramid, as RecordingWriter
+does for every chunk."""
+
+import argparse
+import time
+
+import numpy as np
+
+import pyramid
+
+CHUNK_SAMPLES = 32768  # RecordingWriter's default
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--width", default=1000, type=int, help="Pixels per query")
+    parser.add_argument(
+        "--minutes", default=[1, 10, 60], type=float, nargs="+", help="At 32 kHz"
+    )
+    parser.add_argument(
+        "--max-live-bins",
+        default=None,
+        type=int,
+        help="Spill the older bins to a file, as RecordingWriter does",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    chunk = rng.integers(-(2**23), 2**23, (CHUNK_SAMPLES, 4), dtype=np.int32)
+
+    for minutes in args.minutes:
+        n_chunks = max(1, int(minutes * 60 * 32000) // CHUNK_SAMPLES)
+        pyr = pyramid.Pyramid(max_live_bins=args.max_live_bins)
+        t0 = time.perf_counter()
+        for i in range(n_chunks):
+            pyr.add(i * CHUNK_SAMPLES, chunk)
+        build_s = time.perf_counter() - t0
+
+        n_queries = 20
+        t0 = time.perf_counter()
+        for i in range(n_queries):
+            # Whole capture, then zoomed in on ever smaller ranges.
+            span = max(args.width, pyr.n_samples >> i)
+            pyr.query(0, span, args.width)
+        query_s = (time.perf_counter() - t0) / n_queries
+
+        print(
+            f"{minutes:5g} min, {pyr.n_samples / 1e6:6.1f} M samples: "
+            f"build {pyr.n_samples / build_s / 1e6:5.1f} M samples/s, "
+            f"query {query_s * 1e3:6.2f} ms"
+        )
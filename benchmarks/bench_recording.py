@@ -0,0 +1,75 @@
+# Run it like so: `python -m benchmarks.bench_recording`
+"""Compression ratio and throughput of the recording codecs, against storing the
+samples as plain int32 and against the uncompressed ("none") recording."""
+
+import argparse
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+import recording
+
+
+def synthetic_capture(seconds: float, sample_rate: int = 32000) -> np.ndarray:
+    """Load cell like data: a DC offset, slow loading, mains hum and white noise."""
+    rng = np.random.default_rng(0)
+    n = int(seconds * sample_rate)
+    t = np.arange(n) / sample_rate
+    offsets = np.array([2_100_000, 600, 35_000, -4_800])
+    load = 50_000 * np.sin(2 * np.pi * 0.2 * t)[:, np.newaxis] * [1, 0, 0.5, 0]
+    hum = 30 * np.sin(2 * np.pi * 60 * t)[:, np.newaxis]
+    noise = rng.normal(0, [20, 20, 100, 15], (n, 4))
+    return np.rint(offsets + load + hum + noise).astype(np.int32)
+
+
+def bench(samples: np.ndarray, codec: str, level: int, path: pathlib.Path) -> dict:
+    t0 = time.perf_counter()
+    with recording.RecordingWriter(path, codec=codec, level=level) as writer:
+        # Packet sized writes, like the live feed.
+        for start in range(0, len(samples), 20):
+            writer.write(start, samples[start : start + 20])
+    write_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with recording.RecordingReader(path) as reader:
+        _, decoded = reader.read()
+    read_s = time.perf_counter() - t0
+    assert np.array_equal(decoded, samples)
+
+    return dict(
+        size=path.stat().st_size,
+        encode_mb_s=writer.stats.throughput_mb_s,
+        write_mb_s=samples.nbytes / write_s / 1e6,
+        read_mb_s=samples.nbytes / read_s / 1e6,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", default=30.0, type=float)
+    args = parser.parse_args()
+
+    samples = synthetic_capture(args.seconds)
+    raw_size = samples.nbytes
+    print(f"{len(samples)} samples, {raw_size / 1e6:.1f} MB as int32")
+
+    configs = [("none", 0), ("zlib", 1), ("zlib", 6), ("bz2", 9), ("lzma", 1)]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec, level in configs:
+            path = pathlib.Path(tmp) / f"{codec}_{level}.dynrec"
+            results[codec, level] = bench(samples, codec, level, path)
+
+    uncompressed = results["none", 0]["size"]
+    print(
+        f"{'codec':<8} {'level':>5} {'MB':>8} {'vs int32':>9} {'vs none':>8} "
+        f"{'enc MB/s':>9} {'write MB/s':>11} {'read MB/s':>10}"
+    )
+    for (codec, level), r in results.items():
+        print(
+            f"{codec:<8} {level:>5} {r['size'] / 1e6:>8.2f} "
+            f"{raw_size / r['size']:>9.2f} {uncompressed / r['size']:>8.2f} "
+            f"{r['encode_mb_s']:>9.1f} {r['write_mb_s']:>11.1f} {r['read_mb_s']:>10.1f}"
+        )
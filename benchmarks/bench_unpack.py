@@ -0,0 +1,95 @@
+# Run it like so: `python -m benchmarks.bench_unpack`
+"""Speed of ADCFeed.unpack against the previous per-sample implementation. Both are
+pure Python, so this is what a host without numpy gets."""
+
+import argparse
+import dataclasses
+import random
+import time
+
+import dynamite_sampler_api as ds
+
+
+@dataclasses.dataclass
+class FeedHeader:
+    sample_sequence_number: int
+
+
+@dataclasses.dataclass
+class FeedData:
+    ch0: int
+    ch1: int
+    ch2: int
+    ch3: int
+
+
+@dataclasses.dataclass
+class FeedPacket:
+    header: FeedHeader
+    samples: list[FeedData]
+
+
+def unpack_per_sample(b: bytearray | bytes) -> FeedPacket:
+    """The old way: slice every sample and int.from_bytes every value, into dataclasses
+    without slots."""
+    header = FeedHeader(int.from_bytes(b[0:2], byteorder="little", signed=False))
+    payload = b[2:]
+    samples = []
+    for start in range(0, len(payload), 12):
+        s = payload[start : start + 12]
+        samples.append(
+            FeedData(
+                int.from_bytes(s[0:3], byteorder="little", signed=True),
+                int.from_bytes(s[3:6], byteorder="little", signed=True),
+                int.from_bytes(s[6:9], byteorder="little", signed=True),
+                int.from_bytes(s[9:12], byteorder="little", signed=True),
+            )
+        )
+    return FeedPacket(header, samples)
+
+
+def same(old: FeedPacket, new: ds.FeedPacket) -> bool:
+    # The new header also has the host arrival time, which unpack leaves unset.
+    return (
+        old.header.sample_sequence_number == new.header.sample_sequence_number
+        and dataclasses.astuple(old)[1] == dataclasses.astuple(new)[1]
+    )
+
+
+def time_unpack(unpack, packets) -> float:
+    t0 = time.perf_counter()
+    for packet in packets:
+        unpack(packet)
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--packets", default=20000, type=int)
+    parser.add_argument("--samples", default=20, type=int, help="Samples per packet")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    packets = [
+        bytearray(rng.randbytes(2 + 12 * args.samples)) for _ in range(args.packets)
+    ]
+    assert all(
+        same(unpack_per_sample(p), ds.DynamiteSampler.ADCFeed.unpack(p))
+        for p in packets
+    )
+
+    n = args.packets * args.samples
+    old_s = time_unpack(unpack_per_sample, packets)
+    new_s = time_unpack(ds.DynamiteSampler.ADCFeed.unpack, packets)
+    values_s = time_unpack(ds.DynamiteSampler.ADCFeed.unpack_values, packets)
+
+    print(f"{args.packets} packets of {args.samples} samples, identical output")
+    for name, seconds in (
+        ("per sample", old_s),
+        ("unpack", new_s),
+        ("unpack_values", values_s),
+    ):
+        print(
+            f"{name:>14}: {seconds:.3f}s {n / seconds / 1e6:6.2f} Msamples/s, "
+            f"{old_s / seconds:5.1f}x"
+        )
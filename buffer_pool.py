@@ -0,0 +1,156 @@
+"""Pool of pre-allocated sample blocks that FeedSession decodes the ADC feed into.
+
+A packet is decoded straight from the notification bytes into a free (n, 4) int32 block,
+with no FeedData objects or lists in between, and the block is handed to every
+NotifyCallbackSamples callback (see dynamite_sampler_bleak_util). Blocks are reference
+counted: FeedSession holds one reference while the callbacks run, and a callback that
+keeps the samples past its call retain()s the block and release()s it when done. The
+block goes back to the pool once the last reference is released.
+
+In steady state every packet reuses a block, so decoding allocates no sample buffers,
+which keeps the garbage collector quiet during long captures. hits/misses count the
+packets that did and didn't find a free block.
+"""
+
+import threading
+from typing import Optional
+
+import numpy as np
+
+N_CHANNELS = 4
+_HEADER_BYTES = 2  # See ds.DynamiteSampler.ADCFeed
+_SAMPLE_BYTES = 12  # 4 channels x 3 bytes
+
+
+class PooledBlock:
+    """A block of samples from a BufferPool. samples is the read-only (n, 4) int32 view
+    of the latest packet decoded into it."""
+
+    __slots__ = ("pool", "samples", "_storage", "_bytes", "_refs")
+
+    def __init__(self, pool: Optional["BufferPool"], capacity: int):
+        self.pool = pool
+        self._storage = np.zeros((capacity, N_CHANNELS), dtype="<i4")
+        # The bytes of every value, to decode the 24-bit values into the top 3.
+        self._bytes = self._storage.view(np.uint8).reshape(capacity, N_CHANNELS, 4)
+        self.samples = self._storage[:0]
+        self._refs = 0
+
+    @classmethod
+    def wrap(cls, samples: np.ndarray) -> "PooledBlock":
+        """A block around existing samples, not from any pool. Releasing it does
+        nothing."""
+        block = cls(None, 0)
+        block.samples = samples
+        return block
+
+    @property
+    def capacity(self) -> int:
+        return len(self._storage)
+
+    def decode(self, raw_data: bytes | bytearray, n_samples: int):
+        """Decode the samples of an ADC feed notification into the block."""
+        raw = np.frombuffer(
+            raw_data, np.uint8, count=n_samples * _SAMPLE_BYTES, offset=_HEADER_BYTES
+        )
+        b = self._bytes[:n_samples]
+        b[:, :, 1:] = raw.reshape(n_samples, N_CHANNELS, 3)
+        b[:, :, 0] = 0
+        # Shifting the value back down from the top 3 bytes extends the sign.
+        samples = self._storage[:n_samples]
+        np.right_shift(samples, 8, out=samples)
+        self.samples = samples[:]
+        self.samples.flags.writeable = False
+
+    def retain(self):
+        """Keep the block (and its samples) until a matching release()."""
+        if self.pool is not None:
+            self.pool._retain(self)
+
+    def release(self):
+        if self.pool is not None:
+            self.pool._release(self)
+
+
+class BufferPool:
+    """Free list of blocks of block_samples samples. Packets longer than that get a
+    one-off block, counted as a miss."""
+
+    def __init__(
+        self, block_samples: int = 64, preallocate: int = 16, max_free: int = 256
+    ):
+        """
+        block_samples:  Samples per block, at least the samples per notification.
+        preallocate:    Blocks to allocate up front.
+        max_free:       Blocks to keep around at most when they are released, a burst
+                        needing more than that is garbage collected.
+        """
+        self.block_samples = int(block_samples)
+        self.max_free = int(max_free)
+        self._free = [PooledBlock(self, self.block_samples) for _ in range(preallocate)]
+        # Blocks can be released from the sinks' threads.
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+
+    def decode(self, raw_data: bytes | bytearray) -> PooledBlock:
+        """Decode an ADC feed notification into a free block, holding one reference."""
+        n_samples, rest = divmod(len(raw_data) - _HEADER_BYTES, _SAMPLE_BYTES)
+        assert n_samples >= 0 and rest == 0, "Not an ADC feed notification"
+        block = self._acquire(n_samples)
+        block.decode(raw_data, n_samples)
+        return block
+
+    def _acquire(self, n_samples: int) -> PooledBlock:
+        block = None
+        with self._lock:
+            if n_samples <= self.block_samples and self._free:
+                block = self._free.pop()
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        if block is None:
+            block = PooledBlock(self, max(n_samples, self.block_samples))
+        block._refs = 1
+        return block
+
+    def _retain(self, block: PooledBlock):
+        with self._lock:
+            assert block._refs > 0, "Retaining a released block"
+            block._refs += 1
+
+    def _release(self, block: PooledBlock):
+        with self._lock:
+            assert block._refs > 0, "Block released more often than retained"
+            block._refs -= 1
+            if block._refs:
+                return
+            self.in_use -= 1
+            if block.capacity == self.block_samples and len(self._free) < self.max_free:
+                self._free.append(block)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            in_use=self.in_use,
+            peak_in_use=self.peak_in_use,
+            free=len(self._free),
+        )
+
+    def __str__(self):
+        return (
+            f"buffer pool {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate:.1%} hit rate), {self.in_use} in use "
+            f"(peak {self.peak_in_use}), {self.block_samples} samples per block"
+        )
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""Convert directories of recorded captures to arrays, in parallel, with a summary.
+
+Inputs (searched recursively):
+- `.txt` datadumps, one Python dict repr per sample (`{'status':..., 'channels':[...],
+  'crc':...}`) or one bare integer per line (see `sample_data/`),
+- `.csv` files written by `stream.py --csv`.
+
+Outputs, one per input in --out:
+- "columnar": `.npz` with one array per column (ssn, channels, status, crc...),
+- "binary": a compressed `.dynrec` recording (see recording.py).
+
+Files are parsed in line aligned byte ranges on a process pool, so a single large
+capture also uses every core. A summary.csv with per-file statistics is written next to
+the outputs.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import dataclasses
+import os
+import pathlib
+import time
+from typing import Optional
+
+import numpy as np
+
+import datadump
+
+FORMAT_DICT_DUMP = "dict_dump"  # One dict repr per line
+FORMAT_INT_DUMP = "int_dump"  # One integer per line
+FORMAT_CSV = "csv"  # stream.py FeedDataCSVWriter
+
+
+def detect_format(path: pathlib.Path) -> Optional[str]:
+    """Format of a capture file from its suffix and first data line, None if unknown."""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.suffix == ".csv":
+                return FORMAT_CSV
+            if line.startswith("{"):
+                return FORMAT_DICT_DUMP
+            if line.lstrip("-").isdigit():
+                return FORMAT_INT_DUMP
+            return None
+    return None
+
+
+def chunk_ranges(path: pathlib.Path, chunk_bytes: int) -> list[tuple[int, int]]:
+    """Split a file into (start, end) byte ranges that begin and end on line breaks."""
+    size = path.stat().st_size
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()  # Move to the end of the line
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_chunk(
+    path: pathlib.Path, fmt: str, start: int, end: int
+) -> dict[str, np.ndarray]:
+    """Parse the lines in a byte range of a capture into columns."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        b = f.read(end - start)
+
+    if fmt == FORMAT_DICT_DUMP:
+        n_channels = datadump.count_channels(b)
+        return datadump.parse_bytes(b, datadump.LAYOUT_DICT, n_channels).columns()
+
+    if fmt == FORMAT_INT_DUMP:
+        return datadump.parse_bytes(b, datadump.LAYOUT_INT).columns()
+
+    lines = b.decode().splitlines()
+    if fmt == FORMAT_CSV:
+        data_lines = (line for line in lines if line and not line.startswith("#"))
+        rows = [row for row in csv.reader(data_lines) if row[0].lstrip("-").isdigit()]
+        table = np.array(rows, dtype=np.int64).reshape(len(rows), -1)
+        return dict(ssn=table[:, 0], channels=table[:, 1:].astype(np.int32))
+
+    raise ValueError(f"Unknown capture format {fmt}")
+
+
+def merge_chunks(chunks: list[dict[str, np.ndarray]]) -> dict[str, np.ndarray]:
+    return {key: np.concatenate([c[key] for c in chunks]) for key in chunks[0]}
+
+
+def csv_metadata(path: pathlib.Path) -> str:
+    """The device info comment line at the top of a stream.py CSV, if any."""
+    with open(path) as f:
+        for line in f:
+            if not line.startswith("#"):
+                break
+            if "CSV setup" not in line:
+                return line[1:].strip()
+    return ""
+
+
+@dataclasses.dataclass
+class FileSummary:
+    path: str
+    format: str
+    samples: int
+    missing: int  # From SSN jumps, only known for CSV
+    input_bytes: int
+    seconds: float
+    mean: list[float]
+    std: list[float]
+    min: list[int]
+    max: list[int]
+
+
+def summarize(
+    path: pathlib.Path, fmt: str, columns: dict[str, np.ndarray], seconds: float
+) -> FileSummary:
+    channels = columns["channels"]
+    missing = 0
+    if "ssn" in columns and len(columns["ssn"]) > 1:
+        # stream.py writes the unwrapped SSNs, so gaps of any length show as jumps.
+        missing = int(np.clip(np.diff(columns["ssn"]) - 1, 0, None).sum())
+    if len(channels):
+        stats = dict(
+            mean=channels.mean(axis=0).tolist(),
+            std=channels.std(axis=0).tolist(),
+            min=channels.min(axis=0).tolist(),
+            max=channels.max(axis=0).tolist(),
+        )
+    else:
+        stats = dict(mean=[], std=[], min=[], max=[])
+    return FileSummary(
+        path=str(path),
+        format=fmt,
+        samples=len(channels),
+        missing=missing,
+        input_bytes=path.stat().st_size,
+        seconds=seconds,
+        **stats,
+    )
+
+
+def write_output(
+    columns: dict[str, np.ndarray],
+    out_path: pathlib.Path,
+    output_format: str,
+    metadata: str,
+):
+    if output_format == "columnar":
+        np.savez(out_path.with_suffix(".npz"), **columns)
+        return
+
+    import recording
+
+    channels = columns["channels"]
+    if "ssn" in columns:
+        # Recordings are in SSN order, so leave out duplicate and late samples: those
+        # not past every SSN before them.
+        ssns = columns["ssn"]
+        keep = np.ones(len(ssns), dtype=bool)
+        keep[1:] = ssns[1:] > np.maximum.accumulate(ssns)[:-1]
+        ssns, channels = ssns[keep], channels[keep]
+    else:
+        ssns = np.arange(len(channels))
+    with recording.RecordingWriter(
+        out_path.with_suffix(".dynrec"),
+        n_channels=channels.shape[1],
+        metadata={"source": metadata},
+    ) as writer:
+        # Write each run of consecutive SSNs, so gaps start a new chunk.
+        breaks = np.flatnonzero(np.diff(ssns) != 1) + 1
+        for run_ssns, run in zip(np.split(ssns, breaks), np.split(channels, breaks)):
+            if len(run):
+                writer.write(int(run_ssns[0]), run)
+
+
+def find_captures(paths: list[str]) -> list[pathlib.Path]:
+    found = []
+    for p in map(pathlib.Path, paths):
+        if p.is_dir():
+            found += sorted(p.rglob("*.txt")) + sorted(p.rglob("*.csv"))
+        else:
+            found.append(p)
+    return found
+
+
+def convert(
+    paths: list[pathlib.Path],
+    out_dir: pathlib.Path,
+    output_format: str = "columnar",
+    workers: Optional[int] = None,
+    chunk_bytes: int = 8 * 2**20,
+) -> list[FileSummary]:
+    """Convert the captures on a pool of `workers` processes, printing progress.
+    Returns a summary per converted file."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    t_start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        # Queue every chunk of every file up front so the pool never idles.
+        jobs = []
+        for path in paths:
+            fmt = detect_format(path)
+            if fmt is None:
+                print(f"Skipping {path}: unknown format")
+                continue
+            futures = [
+                pool.submit(parse_chunk, path, fmt, start, end)
+                for start, end in chunk_ranges(path, chunk_bytes)
+            ]
+            jobs.append((path, fmt, futures))
+
+        summaries = []
+        total_bytes = 0
+        for i, (path, fmt, futures) in enumerate(jobs):
+            t_file = time.perf_counter()
+            chunks = [f.result() for f in futures]
+            columns = merge_chunks(chunks) if chunks else {"channels": np.zeros((0, 1))}
+            metadata = csv_metadata(path) if fmt == FORMAT_CSV else ""
+            write_output(columns, out_dir / path.stem, output_format, metadata)
+
+            summary = summarize(path, fmt, columns, time.perf_counter() - t_file)
+            summaries.append(summary)
+            total_bytes += summary.input_bytes
+            elapsed = time.perf_counter() - t_start
+            print(
+                f"[{i + 1}/{len(jobs)}] {path.name}: {summary.samples} samples, "
+                f"{len(futures)} chunks, total {total_bytes / 1e6:.1f} MB "
+                f"at {total_bytes / elapsed / 1e6:.1f} MB/s"
+            )
+
+    write_summary(summaries, out_dir / "summary.csv")
+    elapsed = time.perf_counter() - t_start
+    total_samples = sum(s.samples for s in summaries)
+    print(
+        f"Converted {len(summaries)} files, {total_samples} samples, "
+        f"{total_bytes / 1e6:.1f} MB in {elapsed:.2f}s: "
+        f"{total_bytes / elapsed / 1e6:.1f} MB/s, {total_samples / elapsed:.0f} samples/s"
+    )
+    return summaries
+
+
+def write_summary(summaries: list[FileSummary], path: pathlib.Path):
+    with open(path, "w", newline="") as f:
+        fieldnames = [field.name for field in dataclasses.fields(FileSummary)]
+        writer = csv.DictWriter(f, fieldnames)
+        writer.writeheader()
+        for summary in summaries:
+            writer.writerow(dataclasses.asdict(summary))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths", nargs="+", help="Capture files or directories")
+    parser.add_argument("--out", default="./data/converted", help="Output directory")
+    parser.add_argument(
+        "--format", choices=["columnar", "binary"], default="columnar", dest="fmt"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="Worker processes"
+    )
+    parser.add_argument(
+        "--chunk-mb", type=float, default=8.0, help="[MB] Parse chunk size"
+    )
+    args = parser.parse_args()
+
+    convert(
+        find_captures(args.paths),
+        pathlib.Path(args.out),
+        args.fmt,
+        args.workers,
+        int(args.chunk_mb * 2**20),
+    )
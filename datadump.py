@@ -0,0 +1,175 @@
+"""Fast streaming parser for the legacy datadump text captures in `sample_data/`.
+
+Two layouts exist:
+- "dict": one Python dict repr per sample,
+  `{'status': 3845, 'channels': [2122144, 666, 35872, -4852], 'crc': 0}`
+- "int": one bare integer per line (a single channel).
+
+Instead of evaluating every line, a chunk of bytes has every character that can't be
+part of a number blanked out with bytes.translate, and the remaining integers are
+parsed in one np.fromstring call. The dict keys are fixed, so the numbers come in a
+fixed order per line. A chunk with an unexpected line (keys missing or out of order, a
+number count per line other than status, channels and crc) falls back to a per line
+regex, then to ast.literal_eval. Lines not starting with "{" are skipped in the "dict"
+layout.
+
+The file is read in chunks cut at line breaks, so memory stays bounded by the chunk
+size however big the capture is.
+"""
+
+import ast
+import dataclasses
+import pathlib
+import re
+from typing import BinaryIO, Iterator, Optional
+
+import numpy as np
+
+LAYOUT_DICT = "dict"
+LAYOUT_INT = "int"
+
+# Keep digits and minus signs, blank out everything else.
+_NUMBERS_ONLY = bytes(c if c in b"0123456789-" else ord(" ") for c in range(256))
+_DICT_LINE = re.compile(
+    rb"\{'status': (-?\d+), 'channels': \[([-\d, ]*)\], 'crc': (-?\d+)\}"
+)
+
+
+@dataclasses.dataclass
+class Datadump:
+    """Parsed samples. status and crc are None for the "int" layout."""
+
+    channels: np.ndarray  # (n, n_channels) int32
+    status: Optional[np.ndarray] = None  # (n,) int64
+    crc: Optional[np.ndarray] = None  # (n,) int64
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """The non-empty fields by name."""
+        return {
+            field.name: getattr(self, field.name)
+            for field in dataclasses.fields(self)
+            if getattr(self, field.name) is not None
+        }
+
+
+def detect_layout(line: bytes) -> Optional[str]:
+    """Layout of a datadump from its first line, None if it is neither."""
+    line = line.strip()
+    if line.startswith(b"{"):
+        return LAYOUT_DICT
+    if line.lstrip(b"-").isdigit():
+        return LAYOUT_INT
+    return None
+
+
+def count_channels(b: bytes, default: int = 4) -> int:
+    """Number of channels in the first "dict" layout line of b, default if none."""
+    match = _DICT_LINE.search(b)
+    if not match:
+        return default
+    return len(match.group(2).split(b","))
+
+
+def parse_bytes(b: bytes, layout: str, n_channels: int = 4) -> Datadump:
+    """Parse whole lines of a datadump."""
+    numbers = np.fromstring(b.translate(_NUMBERS_ONLY), dtype=np.int64, sep=" ")
+    n_lines = len(b.split()) if layout == LAYOUT_INT else b.count(b"{")
+
+    if layout == LAYOUT_INT:
+        if len(numbers) != n_lines:
+            raise ValueError("Integer datadump has a line that isn't one integer")
+        return Datadump(numbers.astype(np.int32).reshape(-1, 1))
+
+    per_line = n_channels + 2  # status, channels..., crc
+    if len(numbers) != n_lines * per_line or not _is_regular(b, n_lines, per_line):
+        return _parse_dict_lines_slow(b, n_channels)
+    table = numbers.reshape(n_lines, per_line)
+    return Datadump(
+        channels=table[:, 1:-1].astype(np.int32),
+        status=table[:, 0].copy(),
+        crc=table[:, -1].copy(),
+    )
+
+
+def _is_regular(b: bytes, n_lines: int, per_line: int) -> bool:
+    """Whether every line of b has the dict keys in order and per_line numbers, so the
+    numbers can be taken by position."""
+    keys = (b"{'status': ", b", 'channels': [", b"], 'crc': ")
+    if any(b.count(key) != n_lines for key in keys):
+        return False
+    is_number = np.frombuffer(b.translate(_NUMBERS_ONLY), dtype=np.uint8) != ord(" ")
+    starts = np.flatnonzero(is_number[1:] & ~is_number[:-1]) + 1
+    if len(is_number) and is_number[0]:
+        starts = np.concatenate(([0], starts))
+    line_breaks = np.flatnonzero(np.frombuffer(b, dtype=np.uint8) == ord("\n"))
+    per_line_counts = np.bincount(np.searchsorted(line_breaks, starts))
+    return bool(np.all(per_line_counts == per_line))
+
+
+def _parse_dict_lines_slow(b: bytes, n_channels: int) -> Datadump:
+    """Line by line fallback, for chunks with unusual lines."""
+    status, channels, crc = [], [], []
+    for line in b.splitlines():
+        line = line.strip()
+        if not line.startswith(b"{"):
+            continue  # Blank line or comment
+        match = _DICT_LINE.fullmatch(line)
+        if match:
+            s, ch, c = match.groups()
+            values = [int(v) for v in ch.split(b",")]
+        else:
+            d = ast.literal_eval(line.decode())
+            s, values, c = d["status"], d["channels"], d["crc"]
+        if len(values) != n_channels:
+            raise ValueError(f"Expected {n_channels} channels: {line!r}")
+        status.append(int(s))
+        channels.append(values)
+        crc.append(int(c))
+    return Datadump(
+        channels=np.array(channels, dtype=np.int32).reshape(-1, n_channels),
+        status=np.array(status, dtype=np.int64),
+        crc=np.array(crc, dtype=np.int64),
+    )
+
+
+def iter_chunks(f: BinaryIO, chunk_bytes: int = 4 * 2**20) -> Iterator[bytes]:
+    """Read a file in chunks of whole lines."""
+    rest = b""
+    while chunk := f.read(chunk_bytes):
+        chunk = rest + chunk
+        cut = chunk.rfind(b"\n") + 1
+        if cut == 0:
+            rest = chunk  # A line longer than the chunk, keep reading
+            continue
+        rest = chunk[cut:]
+        yield chunk[:cut]
+    if rest.strip():
+        yield rest
+
+
+def iter_datadump(
+    path: str | pathlib.Path, chunk_bytes: int = 4 * 2**20
+) -> Iterator[Datadump]:
+    """Parse a datadump chunk by chunk, with memory bounded by chunk_bytes."""
+    with open(path, "rb") as f:
+        first_line = f.readline()
+        layout = detect_layout(first_line)
+        if layout is None:
+            raise ValueError(f"{path} is not a datadump")
+        n_channels = count_channels(first_line) if layout == LAYOUT_DICT else 1
+        f.seek(0)
+        for chunk in iter_chunks(f, chunk_bytes):
+            yield parse_bytes(chunk, layout, n_channels)
+
+
+def read_datadump(path: str | pathlib.Path, chunk_bytes: int = 4 * 2**20) -> Datadump:
+    """Parse a whole datadump."""
+    parts = list(iter_datadump(path, chunk_bytes))
+    if not parts:
+        return Datadump(np.zeros((0, 1), dtype=np.int32))
+    return Datadump(
+        **{
+            key: np.concatenate([p.columns()[key] for p in parts])
+            for key in parts[0].columns()
+        }
+    )
@@ -5,7 +5,7 @@ TODO: figure out how to abstract this file into separate repo.
 """
 
 import struct
-from typing import Generic, TypeVar, ClassVar
+from typing import Generic, TypeVar, ClassVar, Optional
 import dataclasses
 
 
@@ -22,14 +22,17 @@ class ADCConfigData:
     gains: list[int]
 
 
-@dataclasses.dataclass
+# The feed types are made per packet and per sample, slots make them smaller and faster.
+@dataclasses.dataclass(slots=True)
 class FeedHeader:
     """Packet header prepended to each BLE ADC feed notification."""
 
     sample_sequence_number: int  # Running sample counter (uint16, little-endian)
+    # time.monotonic_ns() when the host received the notification, set by FeedSession.
+    arrival_ns: Optional[int] = None
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class FeedData:
     """A single ADC sample."""
 
@@ -39,7 +42,7 @@ class FeedData:
     ch3: int
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class FeedPacket:
     """A full BLE ADC feed notification: header + list of samples."""
 
@@ -47,6 +50,10 @@ class FeedPacket:
     samples: list[FeedData]
 
 
+# Maps the top byte of a 24-bit value to the byte that sign extends it to 32 bits.
+_SIGN_EXTEND = bytes(0xFF if i & 0x80 else 0x00 for i in range(256))
+
+
 ## BLE services and characteristics structure
 # Baseclasses and typing boiler plate stuff to make the actual API a bit more readable.
 class BLEService:
@@ -102,11 +109,14 @@ class DynamiteSampler(BLEService):
         _header_bytes: ClassVar[int] = 2  # ssn (2B)
         _sample_bytes: ClassVar[int] = 12  # 4 channels x 3 bytes each
 
+        _header_struct: ClassVar[struct.Struct] = struct.Struct("<H")
+        # struct.Struct("<{n}i") by number of values n, compiled on first use.
+        _values_structs: ClassVar[dict[int, struct.Struct]] = {}
+
         @staticmethod
         def _unpack_header(b: bytearray | bytes) -> FeedHeader:
-            """Unpack the packet header."""
-            ssn = int.from_bytes(b[0:2], byteorder="little", signed=False)
-            return FeedHeader(ssn)
+            """Unpack the packet header (from the start of b)."""
+            return FeedHeader(*DynamiteSampler.ADCFeed._header_struct.unpack_from(b))
 
         @staticmethod
         def _unpack_single(b: bytearray | bytes) -> FeedData:
@@ -121,22 +131,45 @@ class DynamiteSampler(BLEService):
             return FeedData(ch0, ch1, ch2, ch3)
 
         @staticmethod
-        def unpack(b: bytearray | bytes) -> FeedPacket:
+        def unpack_values(b: bytearray | bytes | memoryview) -> tuple[int, ...]:
+            """Unpack the channel values of a notification packet, flattened:
+            (ch0, ch1, ch2, ch3, ch0, ...). Needs no numpy.
+
+            The whole payload is converted at once: each 3-byte value is spread into 4
+            bytes with extended slice copies, the top byte sign extended with a
+            translate table, and the int32s unpacked with a single struct call.
+            """
+            header_bytes = DynamiteSampler.ADCFeed._header_bytes
+            n_values, rest = divmod(len(b) - header_bytes, 3)
+            assert n_values >= 0 and rest == 0
+
+            values_struct = DynamiteSampler.ADCFeed._values_structs.get(n_values)
+            if values_struct is None:
+                values_struct = struct.Struct(f"<{n_values}i")
+                DynamiteSampler.ADCFeed._values_structs[n_values] = values_struct
+
+            buf = bytearray(4 * n_values)
+            buf[0::4] = b[header_bytes::3]
+            buf[1::4] = b[header_bytes + 1 :: 3]
+            top = bytes(b[header_bytes + 2 :: 3])
+            buf[2::4] = top
+            buf[3::4] = top.translate(_SIGN_EXTEND)
+            return values_struct.unpack(buf)
+
+        @staticmethod
+        def unpack(b: bytearray | bytes | memoryview) -> FeedPacket:
             """Unpack a notification packet: 2-byte header + N x 12-byte samples."""
             header_bytes = DynamiteSampler.ADCFeed._header_bytes
             sample_bytes = DynamiteSampler.ADCFeed._sample_bytes
 
             assert len(b) >= header_bytes
-            header = DynamiteSampler.ADCFeed._unpack_header(b[:header_bytes])
-
-            payload = b[header_bytes:]
-            assert len(payload) % sample_bytes == 0
-
-            samples = []
-            for start in range(0, len(payload), sample_bytes):
-                s = slice(start, start + sample_bytes)
-                samples.append(DynamiteSampler.ADCFeed._unpack_single(payload[s]))
+            assert (len(b) - header_bytes) % sample_bytes == 0
+            header = DynamiteSampler.ADCFeed._unpack_header(b)
 
+            values = DynamiteSampler.ADCFeed.unpack_values(b)
+            samples = list(
+                map(FeedData, values[0::4], values[1::4], values[2::4], values[3::4])
+            )
             return FeedPacket(header, samples)
 
     class ADCConfig(BLECharacteristicRead[ADCConfigData]):
@@ -1,9 +1,19 @@
+from __future__ import annotations
+
 import asyncio
-from typing import Iterable, Optional
+import time
+from typing import TYPE_CHECKING, Iterable, Optional
 
 import dynamite_sampler_api as ds
+import profiling
 
-import bleak
+if TYPE_CHECKING:
+    # Imported where they are used, so the callbacks, FeedSession and offline modes
+    # (e.g. replay.py) work without loading bleak.
+    import bleak
+    from buffer_pool import BufferPool, PooledBlock
+    from link_telemetry import LinkTelemetry
+    from pipeline_metrics import PipelineMetrics
 
 
 class NotifyCallbackRawData:
@@ -42,11 +52,87 @@ class NotifyCallbackFeeddatas:
         pass
 
 
+class NotifyCallbackSamples(NotifyCallbackFeeddatas):
+    """Feeddata callback class that takes the samples as an array instead of FeedData.
+
+    FeedSession decodes the feed straight into pooled (n, 4) int32 blocks for these
+    callbacks (see buffer_pool.py), without making FeedData objects. block.samples is
+    read-only and only valid during the call: to keep the samples longer, copy them, or
+    block.retain() and block.release() when done.
+
+    Called with FeedData (e.g. after a pipeline stage) the samples are converted first.
+    """
+
+    def callback(
+        self, header: ds.FeedHeader, feeddatas: list[ds.FeedData], missing: int
+    ):
+        import buffer_pool
+        import feed_arrays
+
+        samples = feed_arrays.feeddatas_to_array(feeddatas)
+        self.callback_block(header, buffer_pool.PooledBlock.wrap(samples), missing)
+
+    def callback_block(self, header: ds.FeedHeader, block: PooledBlock, missing: int):
+        """Parsed header with the sample sequence number unwrapped
+        Block of the samples, block.samples is an (n, 4) int32 array
+        Count of samples missed (BLE dropped) since the last time this callback was called
+        """
+        pass
+
+
+class AsyncNotifyCallbackRawData:
+    """Async version of NotifyCallbackRawData, for sinks doing network or disk I/O.
+
+    FeedSession runs each callback as a task on its event loop, so the sink's I/O
+    overlaps with BLE reception. At most max_in_flight callbacks of the sink run at
+    once; with 1 (the default) they run one at a time, in order. While a sink has
+    max_in_flight callbacks running the pump waits for it, and the notifications queue
+    up meanwhile."""
+
+    max_in_flight: int = 1
+
+    async def setup(self, device_dict: dict):
+        """Setup is called after being connected to a dynamite sampler.
+        device_dict contains meta data about the device."""
+        pass
+
+    async def callback(self, rawdata: bytes):
+        pass
+
+    async def cleanup(self):
+        """Cleanup is called once the callbacks still running have finished."""
+        pass
+
+
+class AsyncNotifyCallbackFeeddatas:
+    """Async version of NotifyCallbackFeeddatas, see AsyncNotifyCallbackRawData."""
+
+    max_in_flight: int = 1
+
+    async def setup(self, device_dict: dict):
+        """Setup is called after being connected to a dynamite sampler.
+        device_dict contains meta data about the device."""
+        pass
+
+    async def callback(
+        self, header: ds.FeedHeader, feeddatas: list[ds.FeedData], missing: int
+    ):
+        """Same arguments as NotifyCallbackFeeddatas.callback. The feeddatas are shared
+        with the other callbacks, so must not be modified."""
+        pass
+
+    async def cleanup(self):
+        """Cleanup is called once the callbacks still running have finished."""
+        pass
+
+
 async def find_dynamite_samplers() -> (
     list[tuple[bleak.BLEDevice, bleak.AdvertisementData]]
 ):
     """Return a list of devices & advertising that have a Dynamite sampler UUID.
     List is sorted by RSSI"""
+    import bleak
+
     devices_and_adv = await bleak.BleakScanner.discover(
         return_adv=True, service_uuids=[ds.DynamiteSampler.UUID]
     )
@@ -84,6 +170,8 @@ async def read_characteristic(
     client: bleak.BleakClient, cls: type[ds.BLECharacteristicRead[ds._UnpackResultT]]
 ) -> Optional[ds._UnpackResultT]:
     """Read characteristic, and unpacks the values. Returns None if it doesn't exist"""
+    import bleak
+
     try:
         b = await client.read_gatt_char(cls.UUID)
     except bleak.exc.BleakCharacteristicNotFoundError:
@@ -122,14 +210,21 @@ class SsnUnwrapper:
         (unwrapped) value in place; return samples missed since the previous
         packet. Downstream callbacks can then treat sequence numbers as
         linear/infinite."""
-        ssn = feed_packet.header.sample_sequence_number
+        unwrapped, missed_samples = self.unwrap(
+            feed_packet.header.sample_sequence_number, len(feed_packet.samples)
+        )
+        feed_packet.header.sample_sequence_number = unwrapped
+        return missed_samples
+
+    def unwrap(self, ssn: int, n_samples: int) -> tuple[int, int]:
+        """Unwrapped SSN of a packet of n_samples samples, and the samples missed
+        since the previous packet."""
         if self._expected is None:
             self._expected = ssn  # initialize on the first packet
         missed_samples = (ssn - self._expected) % self.UINT16_MODULO
         unwrapped = self._expected + missed_samples
-        feed_packet.header.sample_sequence_number = unwrapped
-        self._expected = unwrapped + len(feed_packet.samples)
-        return missed_samples
+        self._expected = unwrapped + n_samples
+        return unwrapped, missed_samples
 
 
 # Idle-poll cadence for mid-stream disconnect detection in FeedSession.
@@ -139,6 +234,78 @@ class SsnUnwrapper:
 _DISCONNECT_POLL_S = 1.0
 
 
+def _unwrap_header(
+    unwrapper: SsnUnwrapper, raw_data: bytearray, arrival_ns: Optional[int] = None
+) -> tuple[ds.FeedHeader, int]:
+    """Header of a notification with the SSN unwrapped, and the samples missed."""
+    adc_feed = ds.DynamiteSampler.ADCFeed
+    header = adc_feed._unpack_header(raw_data)
+    header.arrival_ns = arrival_ns
+    n_samples = (len(raw_data) - adc_feed._header_bytes) // adc_feed._sample_bytes
+    header.sample_sequence_number, missed_samples = unwrapper.unwrap(
+        header.sample_sequence_number, n_samples
+    )
+    return header, missed_samples
+
+
+def _unpack_feeddatas(raw_data: bytearray) -> list[ds.FeedData]:
+    return ds.DynamiteSampler.ADCFeed.unpack(raw_data).samples
+
+
+def _run_stage(hooks: tuple[profiling.ProfilerHook, ...], stage: str, func, *args):
+    for hook in hooks:
+        hook.start(stage)
+    try:
+        return func(*args)
+    finally:
+        for hook in reversed(hooks):
+            hook.stop(stage)
+
+
+class _AsyncSink:
+    """Schedules the callbacks of one async sink as tasks, at most max_in_flight at a
+    time. An error in a callback disables the sink: it is printed, the later batches
+    are skipped (and counted) so the other sinks keep streaming, and stop() reports
+    it."""
+
+    def __init__(self, cb, name: str, metrics: Optional[PipelineMetrics]):
+        self.cb = cb
+        self.name = name
+        self.metrics = metrics
+        self.semaphore = asyncio.Semaphore(max(1, int(cb.max_in_flight)))
+        self.tasks: set[asyncio.Task] = set()
+        self.error: Optional[BaseException] = None
+        self.skipped = 0  # Batches not given to the sink after its error
+
+    async def submit(self, *args):
+        if self.error is not None:
+            self.skipped += 1
+            return
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self._run(args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, args: tuple):
+        start_ns = time.monotonic_ns()
+        try:
+            await self.cb.callback(*args)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+                print(f"FeedSession: {self.name} failed, disabling it: {e!r}")
+        finally:
+            self.semaphore.release()
+            if self.metrics is not None:
+                # Timed from here rather than with the hooks, as these overlap.
+                self.metrics.stage(self.name).record(time.monotonic_ns() - start_ns)
+
+    async def drain(self):
+        """Wait for the callbacks still running."""
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
 class FeedSession:
     """ADC feed streaming on an already-connected client, caller-controlled.
 
@@ -149,6 +316,26 @@ class FeedSession:
     On a mid-stream disconnect the pump drains the buffered packets and
     exits within _DISCONNECT_POLL_S instead of blocking on the queue
     forever; the caller observes it as "no more data arrives".
+
+    Pass a PipelineMetrics to time every stage (queue wait, unpack, unwrap,
+    each callback) and track the queue depth, and/or a ProfilerHook to run
+    around every stage; without either the pump runs uninstrumented.
+
+    The callbacks can also be async (AsyncNotifyCallbackRawData /
+    AsyncNotifyCallbackFeeddatas): the pump schedules them as tasks after the
+    sync ones, up to each sink's max_in_flight, and stop() waits for them.
+    They are timed by the PipelineMetrics but not run inside profiler hooks.
+
+    NotifyCallbackSamples callbacks get the samples decoded into blocks from a
+    BufferPool (one is made if not given) instead of FeedData. FeedData are
+    only unpacked when some callback takes them.
+
+    Every notification is stamped with time.monotonic_ns() when it arrives
+    (FeedHeader.arrival_ns). Link telemetry is opt-in: the notifications are
+    recorded in a LinkTelemetry (see link_telemetry.py) when one is given, or
+    one is made when there are metrics or callbacks with a link_telemetry
+    attribute, which get it set to the session's before setup(). Otherwise the
+    pump doesn't record anything.
     """
 
     def __init__(
@@ -157,14 +344,67 @@ class FeedSession:
         callbacks_raw: Iterable[NotifyCallbackRawData] = (),
         callbacks_feeddata: Iterable[NotifyCallbackFeeddatas] = (),
         device_info: Optional[dict] = None,
+        metrics: Optional[PipelineMetrics] = None,
+        profiler: Optional[profiling.ProfilerHook] = None,
+        pool: Optional[BufferPool] = None,
+        telemetry: Optional[LinkTelemetry] = None,
     ):
         self._client = client
-        self._callbacks_raw = list(callbacks_raw)
-        self._callbacks_feeddata = list(callbacks_feeddata)
+        callbacks_raw = list(callbacks_raw)
+        callbacks_feeddata = list(callbacks_feeddata)
+        self._callbacks_raw = [
+            cb for cb in callbacks_raw if not isinstance(cb, AsyncNotifyCallbackRawData)
+        ]
+        self._callbacks_feeddata = [
+            cb
+            for cb in callbacks_feeddata
+            if not isinstance(cb, (AsyncNotifyCallbackFeeddatas, NotifyCallbackSamples))
+        ]
+        self._callbacks_samples = [
+            cb for cb in callbacks_feeddata if isinstance(cb, NotifyCallbackSamples)
+        ]
+        self._pool = pool
+        wants_telemetry = metrics is not None or any(
+            hasattr(cb, "link_telemetry")
+            for cb in (*callbacks_raw, *callbacks_feeddata)
+        )
+        if telemetry is None and wants_telemetry:
+            import link_telemetry
+
+            telemetry = link_telemetry.LinkTelemetry()
+        self._telemetry = telemetry
+        self._async_callbacks_raw = [
+            cb for cb in callbacks_raw if isinstance(cb, AsyncNotifyCallbackRawData)
+        ]
+        self._async_callbacks_feeddata = [
+            cb
+            for cb in callbacks_feeddata
+            if isinstance(cb, AsyncNotifyCallbackFeeddatas)
+        ]
+        self._async_raw: list[_AsyncSink] = []
+        self._async_feeddata: list[_AsyncSink] = []
         # Passed to the callbacks' setup(); read from the device when not given.
         self._device_info = device_info
+        self._metrics = metrics
+        self._profiler = profiler
         self._queue: Optional[asyncio.Queue] = None
         self._pump_task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @property
+    def metrics(self) -> Optional[PipelineMetrics]:
+        return self._metrics
+
+    @property
+    def pool(self) -> Optional[BufferPool]:
+        """The pool NotifyCallbackSamples blocks are decoded into."""
+        return self._pool
+
+    @property
+    def telemetry(self) -> Optional[LinkTelemetry]:
+        """Link statistics from the arrival times of the notifications, None when
+        nothing asked for them."""
+        return self._telemetry
 
     @property
     def device_info(self) -> Optional[dict]:
@@ -188,36 +428,184 @@ class FeedSession:
         if self._device_info is None:
             await self.fetch_device_info()
 
-        for cb in (*self._callbacks_raw, *self._callbacks_feeddata):
+        if self._callbacks_samples and self._pool is None:
+            import buffer_pool
+
+            self._pool = buffer_pool.BufferPool()
+        if self._metrics is not None:
+            self._metrics.buffer_pool = self._pool
+            self._metrics.link_telemetry = self._telemetry
+        self._unpack_feeddatas = bool(
+            self._callbacks_feeddata or self._async_callbacks_feeddata
+        )
+
+        for cb in (
+            *self._callbacks_raw,
+            *self._callbacks_feeddata,
+            *self._callbacks_samples,
+            *self._async_callbacks_raw,
+            *self._async_callbacks_feeddata,
+        ):
+            if hasattr(cb, "link_telemetry"):
+                cb.link_telemetry = self._telemetry
+
+        for cb in (
+            *self._callbacks_raw,
+            *self._callbacks_feeddata,
+            *self._callbacks_samples,
+        ):
             cb.setup(self._device_info)
+        for cb in (*self._async_callbacks_raw, *self._async_callbacks_feeddata):
+            await cb.setup(self._device_info)
+        names_raw = profiling.stage_names(self._async_callbacks_raw, "async_raw")
+        self._async_raw = [
+            _AsyncSink(cb, name, self._metrics)
+            for cb, name in zip(self._async_callbacks_raw, names_raw)
+        ]
+        names_feeddata = profiling.stage_names(
+            self._async_callbacks_feeddata, "async_feeddata"
+        )
+        self._async_feeddata = [
+            _AsyncSink(cb, name, self._metrics)
+            for cb, name in zip(self._async_callbacks_feeddata, names_feeddata)
+        ]
 
         self._queue = asyncio.Queue()
 
         def notify_callback(sender: bleak.BleakGATTCharacteristic, data: bytearray):
-            self._queue.put_nowait(data)
+            # Stamped on arrival so the pump can measure how long it waited.
+            self._queue.put_nowait((time.monotonic_ns(), data))
 
         await self._client.start_notify(
             ds.DynamiteSampler.ADCFeed.UUID, notify_callback
         )
+        self._stopping = False
         self._pump_task = asyncio.create_task(self._pump())
 
     async def _pump(self):
         unwrapper = SsnUnwrapper()
-        while True:
+        hooks = tuple(h for h in (self._metrics, self._profiler) if h is not None)
+        names_raw = profiling.stage_names(self._callbacks_raw, "raw")
+        names_feeddata = profiling.stage_names(self._callbacks_feeddata, "feeddata")
+        names_samples = profiling.stage_names(self._callbacks_samples, "samples")
+        while not self._stopping:
+            # Only wait when the queue is empty: before Python 3.12 wait_for() can
+            # swallow the cancellation from stop() when the get() is already done.
+            try:
+                enqueue_ns, raw_data = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                try:
+                    enqueue_ns, raw_data = await asyncio.wait_for(
+                        self._queue.get(), _DISCONNECT_POLL_S
+                    )
+                except asyncio.TimeoutError:
+                    if not self._client.is_connected:
+                        print("FeedSession: device disconnected, feed pump stopped")
+                        return
+                    continue
+            if self._telemetry is not None:
+                dequeue_ns = time.monotonic_ns()
+            if not hooks:
+                header, feeddatas, missed_samples = self._dispatch(
+                    unwrapper, raw_data, enqueue_ns
+                )
+            else:
+                header, feeddatas, missed_samples = self._dispatch_hooked(
+                    unwrapper,
+                    raw_data,
+                    enqueue_ns,
+                    hooks,
+                    names_raw,
+                    names_feeddata,
+                    names_samples,
+                )
+            if self._telemetry is not None:
+                adc_feed = ds.DynamiteSampler.ADCFeed
+                self._telemetry.record(
+                    header.sample_sequence_number,
+                    enqueue_ns,
+                    (len(raw_data) - adc_feed._header_bytes) // adc_feed._sample_bytes,
+                    missed_samples,
+                    dequeue_ns,
+                )
+            if self._async_raw or self._async_feeddata:
+                await self._dispatch_async(raw_data, header, feeddatas, missed_samples)
+
+    def _dispatch(
+        self, unwrapper: SsnUnwrapper, raw_data: bytearray, enqueue_ns: int
+    ) -> tuple[ds.FeedHeader, Optional[list[ds.FeedData]], int]:
+        feeddatas = None
+        if self._unpack_feeddatas:
+            feeddatas = _unpack_feeddatas(raw_data)
+        header, missed_samples = _unwrap_header(unwrapper, raw_data, enqueue_ns)
+
+        for cbr in self._callbacks_raw:
+            cbr.callback(raw_data)
+        for cbfd in self._callbacks_feeddata:
+            cbfd.callback(header, feeddatas, missed_samples)
+        if self._callbacks_samples:
+            block = self._pool.decode(raw_data)
             try:
-                raw_data = await asyncio.wait_for(self._queue.get(), _DISCONNECT_POLL_S)
-            except asyncio.TimeoutError:
-                if not self._client.is_connected:
-                    print("FeedSession: device disconnected, feed pump stopped")
-                    return
-                continue
-            feed_packet = ds.DynamiteSampler.ADCFeed.unpack(raw_data)
-            missed_samples = unwrapper.unwrap_and_modify(feed_packet)
-
-            for cbr in self._callbacks_raw:
-                cbr.callback(raw_data)
-            for cbfd in self._callbacks_feeddata:
-                cbfd.callback(feed_packet.header, feed_packet.samples, missed_samples)
+                for cbs in self._callbacks_samples:
+                    cbs.callback_block(header, block, missed_samples)
+            finally:
+                block.release()
+        return header, feeddatas, missed_samples
+
+    async def _dispatch_async(
+        self,
+        raw_data: bytearray,
+        header: ds.FeedHeader,
+        feeddatas: list[ds.FeedData],
+        missed_samples: int,
+    ):
+        for sink in self._async_raw:
+            await sink.submit(raw_data)
+        for sink in self._async_feeddata:
+            await sink.submit(header, feeddatas, missed_samples)
+
+    def _dispatch_hooked(
+        self,
+        unwrapper: SsnUnwrapper,
+        raw_data: bytearray,
+        enqueue_ns: int,
+        hooks: tuple[profiling.ProfilerHook, ...],
+        names_raw: list[str],
+        names_feeddata: list[str],
+        names_samples: list[str],
+    ) -> tuple[ds.FeedHeader, Optional[list[ds.FeedData]], int]:
+        """Same as _dispatch, with the hooks started and stopped around every stage."""
+        metrics = self._metrics
+        if metrics is not None:
+            metrics.record_packet(enqueue_ns, self._queue.qsize())
+
+        feeddatas = None
+        if self._unpack_feeddatas:
+            feeddatas = _run_stage(hooks, "unpack", _unpack_feeddatas, raw_data)
+        header, missed_samples = _run_stage(
+            hooks, "unwrap", _unwrap_header, unwrapper, raw_data, enqueue_ns
+        )
+        if metrics is not None:
+            adc_feed = ds.DynamiteSampler.ADCFeed
+            n_samples = (
+                len(raw_data) - adc_feed._header_bytes
+            ) // adc_feed._sample_bytes
+            metrics.record_unpacked(len(raw_data), n_samples, missed_samples)
+
+        for cbr, name in zip(self._callbacks_raw, names_raw):
+            _run_stage(hooks, name, cbr.callback, raw_data)
+        for cbfd, name in zip(self._callbacks_feeddata, names_feeddata):
+            _run_stage(hooks, name, cbfd.callback, header, feeddatas, missed_samples)
+        if self._callbacks_samples:
+            block = _run_stage(hooks, "decode_block", self._pool.decode, raw_data)
+            try:
+                for cbs, name in zip(self._callbacks_samples, names_samples):
+                    _run_stage(
+                        hooks, name, cbs.callback_block, header, block, missed_samples
+                    )
+            finally:
+                block.release()
+        return header, feeddatas, missed_samples
 
     async def wait_done(self):
         """Block until the feed pump exits — on a mid-stream disconnect, or
@@ -227,6 +615,7 @@ class FeedSession:
 
     async def stop(self):
         """Stop streaming. Safe to call twice, and after a partial start."""
+        self._stopping = True
         if self._pump_task is not None:
             self._pump_task.cancel()
             try:
@@ -239,18 +628,43 @@ class FeedSession:
                 await self._client.stop_notify(ds.DynamiteSampler.ADCFeed.UUID)
             except Exception:
                 pass  # never subscribed, or the backend already tore it down
-        for cb in (*self._callbacks_raw, *self._callbacks_feeddata):
+        for sink in (*self._async_raw, *self._async_feeddata):
+            await sink.drain()
+            if sink.error is not None:
+                print(
+                    f"  callback error for {sink.cb}: {sink.error}, "
+                    f"{sink.skipped} batches skipped"
+                )
+        if self._telemetry is not None:
+            self._telemetry.flush()  # So the cleanups see the last window
+        for cb in (
+            *self._callbacks_raw,
+            *self._callbacks_feeddata,
+            *self._callbacks_samples,
+        ):
             try:
                 cb.cleanup()
             except Exception as e:
                 print(f"  cleanup error for {cb}: {e}")
+        for cb in (*self._async_callbacks_raw, *self._async_callbacks_feeddata):
+            try:
+                await cb.cleanup()
+            except Exception as e:
+                print(f"  cleanup error for {cb}: {e}")
+        self._async_raw = []
+        self._async_feeddata = []
 
 
 async def dynamite_sampler_connect_notify(
     callbacks_raw: Iterable[NotifyCallbackRawData],
     callbacks_feeddata: Iterable[NotifyCallbackFeeddatas],
     tx_power: Optional[int] = None,
+    metrics: Optional[PipelineMetrics] = None,
+    profiler: Optional[profiling.ProfilerHook] = None,
+    adaptive_tx_power: Optional[dict] = None,
 ):
+    """adaptive_tx_power: keyword args of a tx_power.AdaptiveTxPower to adjust the TX
+    power while streaming, starting from tx_power. None to leave it fixed."""
     print("Looking for dynamite sampler devices")
     devices_and_adv = await find_dynamite_samplers()
 
@@ -259,6 +673,8 @@ async def dynamite_sampler_connect_notify(
     if not device:
         return
 
+    import bleak
+
     print("Connecting to:", device)
     async with bleak.BleakClient(device) as client:
         print("Connected!")
@@ -268,7 +684,23 @@ async def dynamite_sampler_connect_notify(
             print(f"Setting TX power to {tx_power} dBm")
             await write_characteristic(client, ds.TxPower.TxPowerSet, tx_power)
 
-        session = FeedSession(client, callbacks_raw, callbacks_feeddata)
+        if adaptive_tx_power is not None:
+            import tx_power as tx_power_module
+
+            callbacks_feeddata = [
+                *callbacks_feeddata,
+                tx_power_module.AdaptiveTxPower(
+                    client, initial_dbm=tx_power, **adaptive_tx_power
+                ),
+            ]
+
+        session = FeedSession(
+            client,
+            callbacks_raw,
+            callbacks_feeddata,
+            metrics=metrics,
+            profiler=profiler,
+        )
         await session.fetch_device_info()
         # TODO figure out how to best print this?
         print("Device information:")
@@ -0,0 +1,173 @@
+"""NumPy helpers for working with the ADC feed as arrays instead of lists of FeedData.
+
+Arrays are shaped (n_samples, n_channels), one row per sample, as int32 ADC counts.
+"""
+
+import dataclasses
+from typing import Iterable, Optional
+
+import numpy as np
+
+import dynamite_sampler_api as ds
+
+N_CHANNELS = 4
+
+
+def feeddatas_to_array(feeddatas: Iterable[ds.FeedData]) -> np.ndarray:
+    """Convert a list of FeedData to an (n, 4) int32 array."""
+    rows = [(d.ch0, d.ch1, d.ch2, d.ch3) for d in feeddatas]
+    return np.array(rows, dtype=np.int32).reshape(-1, N_CHANNELS)
+
+
+def array_to_feeddatas(samples: np.ndarray) -> list[ds.FeedData]:
+    """Convert an (n, 4) array back to a list of FeedData, the inverse of
+    feeddatas_to_array."""
+    return [ds.FeedData(*row) for row in np.asarray(samples).tolist()]
+
+
+UINT16_MODULO = 2**16
+
+
+@dataclasses.dataclass
+class UnwrappedSsns:
+    """Result of unwrap_ssns(), one entry per packet."""
+
+    ssns: np.ndarray  # int64 unwrapped SSN of each packet's first sample
+    missing: np.ndarray  # int64 samples dropped right before each packet
+    duplicate: np.ndarray  # bool, packet starts at an SSN already seen
+    reordered: np.ndarray  # bool, packet arrived after later samples (not a duplicate)
+    next_expected: Optional[int]  # Pass to the next call to continue the stream
+
+    @property
+    def total_missing(self) -> int:
+        return int(self.missing.sum())
+
+
+def unwrap_ssns(
+    raw_ssns: Iterable[int],
+    n_samples: Iterable[int] | int,
+    expected: Optional[int] = None,
+    reorder_window: int = 4096,
+) -> UnwrappedSsns:
+    """Vectorized SsnUnwrapper over a batch of packets: unwrap the 16-bit sample
+    sequence numbers to a linear counter, count missed samples, and flag duplicate and
+    out of order packets.
+
+    raw_ssns:       16-bit SSN of each packet, in arrival order.
+    n_samples:      Samples in each packet (or one count for all packets).
+    expected:       next_expected of the previous batch, to continue a stream. None
+                    starts at the first packet, like a fresh SsnUnwrapper.
+    reorder_window: A packet starting at most this many samples before the end of the
+                    stream so far is taken as a late/duplicate packet, not as a forward
+                    jump of almost a whole 16-bit cycle. Forward gaps must be shorter
+                    than 2**16 - reorder_window samples.
+
+    For in-order streams this gives the same SSNs and missed counts as SsnUnwrapper.
+    Late packets don't count as missing, don't advance the stream, and don't reduce
+    the missing count of the gap they fall into.
+    """
+    raw = np.asarray(raw_ssns, dtype=np.int64).reshape(-1)
+    n = np.broadcast_to(np.asarray(n_samples, dtype=np.int64), raw.shape)
+    if len(raw) == 0:
+        empty_i = np.zeros(0, dtype=np.int64)
+        empty_b = np.zeros(0, dtype=bool)
+        return UnwrappedSsns(empty_i, empty_i, empty_b, empty_b, expected)
+    if expected is None:
+        expected = int(raw[0])
+
+    # Step of each packet from the previous one (from expected for the first), in
+    # [-reorder_window, 2**16 - reorder_window).
+    prev = np.concatenate(([expected], raw[:-1]))
+    steps = (raw - prev) % UINT16_MODULO
+    steps[steps >= UINT16_MODULO - reorder_window] -= UINT16_MODULO
+    ssns = expected + np.cumsum(steps)
+
+    # The stream's end before each packet is the furthest any earlier packet reached.
+    ends = np.maximum.accumulate(ssns + n)
+    end_before = np.concatenate(([expected], np.maximum(ends[:-1], expected)))
+
+    late = ssns < end_before
+    missing = np.where(late, 0, ssns - end_before)
+
+    # A late packet is a duplicate if an earlier packet of the batch started at the
+    # same SSN.
+    order = np.argsort(ssns, kind="stable")
+    sorted_ssns = ssns[order]
+    repeat = np.zeros(len(ssns), dtype=bool)
+    repeat[order[1:]] = sorted_ssns[1:] == sorted_ssns[:-1]
+    duplicate = late & repeat
+
+    return UnwrappedSsns(
+        ssns=ssns,
+        missing=missing,
+        duplicate=duplicate,
+        reordered=late & ~duplicate,
+        next_expected=int(max(end_before[-1], ssns[-1] + n[-1])),
+    )
+
+
+@dataclasses.dataclass
+class FilledBatch:
+    """A batch of samples with the gap in front of it reconstructed by GapFiller."""
+
+    data: np.ndarray  # (n, n_channels), synthesized rows first
+    valid: np.ndarray  # bool (n,), False for synthesized rows
+    gap: int  # Samples missing in front of this batch, filled or not
+
+
+class GapFiller:
+    """Reconstructs the samples dropped in front of each batch (the `missing` count from
+    SsnUnwrapper), keeping a validity mask so downstream filters and statistics can
+    ignore the synthesized samples.
+
+    Policies:
+    - "zero":   fill with 0, the legacy behaviour; shows up as a spike to zero force.
+    - "hold":   repeat the last received sample.
+    - "linear": interpolate from the last received sample to the first new one.
+    - "nan":    fill with NaN; data becomes float64.
+    - "skip":   don't insert anything, only report the gap.
+    Before the first batch there is no last sample, so "hold" and "linear" fill with the
+    first sample of the batch.
+    """
+
+    POLICIES = ("zero", "hold", "linear", "nan", "skip")
+
+    def __init__(self, policy: str = "hold", n_channels: int = N_CHANNELS):
+        assert policy in self.POLICIES, f"Gap policy must be one of {self.POLICIES}"
+        self.policy = policy
+        self.n_channels = n_channels
+        self.dtype = np.float64 if policy == "nan" else np.int32
+        self._last: Optional[np.ndarray] = None
+        self.total_filled = 0
+
+    def fill(self, samples: np.ndarray, missing: int) -> FilledBatch:
+        samples = np.asarray(samples).reshape(-1, self.n_channels)
+        if len(samples):
+            last, self._last = self._last, samples[-1].copy()
+        else:
+            last = self._last
+
+        if missing == 0 or self.policy == "skip" or (last is None and not len(samples)):
+            data = samples.astype(self.dtype, copy=False)
+            return FilledBatch(data, np.ones(len(data), dtype=bool), missing)
+
+        first = samples[0] if len(samples) else last
+        if last is None:
+            last = first
+
+        if self.policy == "zero":
+            fill = np.zeros((missing, self.n_channels), dtype=self.dtype)
+        elif self.policy == "nan":
+            fill = np.full((missing, self.n_channels), np.nan)
+        elif self.policy == "hold":
+            fill = np.broadcast_to(last, (missing, self.n_channels))
+        else:  # linear
+            # Fractions strictly between the last and the first new sample.
+            t = np.arange(1, missing + 1)[:, np.newaxis] / (missing + 1)
+            fill = np.rint(last + t * (first.astype(np.float64) - last))
+
+        self.total_filled += missing
+        data = np.concatenate((fill, samples)).astype(self.dtype, copy=False)
+        valid = np.ones(len(data), dtype=bool)
+        valid[:missing] = False
+        return FilledBatch(data, valid, missing)
@@ -0,0 +1,256 @@
+"""BLE link telemetry of a FeedSession, from the host arrival time of each notification.
+
+FeedSession stamps every notification with time.monotonic_ns() as it arrives (also in
+FeedHeader.arrival_ns) and feeds the stamps to a LinkTelemetry, which tracks
+incrementally:
+- connection events: notifications arriving less than burst_gap_s apart are taken as
+  one burst, sent in the same BLE connection event. The time between bursts is the
+  connection interval, its standard deviation the jitter.
+- packets per connection event (burst length),
+- the queue wait of each notification, from arrival to the pump taking it,
+- missed samples, over the session and per window of window_s.
+
+A link losing packets shows up as missed samples with a steady interval, a host falling
+behind as growing queue waits. Closed windows are kept as LinkWindow rows, which
+FeedDataRecorder writes next to the recording (see read_link_log()).
+
+Callbacks get the session's LinkTelemetry by having a link_telemetry attribute: the
+FeedSession sets it before calling setup().
+"""
+
+import collections
+import dataclasses
+import json
+import math
+import pathlib
+import time
+from typing import Optional
+
+from pipeline_metrics import LatencyHistogram
+
+# Bursts longer than this are counted together.
+MAX_BURST_COUNTED = 64
+
+
+@dataclasses.dataclass
+class LinkWindow:
+    """Link statistics over one window of time."""
+
+    time: float  # [Seconds] Wall clock time of the window's first packet
+    t_s: float  # [Seconds] Since the session's first packet
+    first_ssn: int  # SSN of the window's first packet
+    packets: int = 0
+    samples: int = 0
+    missed_samples: int = 0
+    bursts: int = 0  # Connection events started in the window
+    max_burst: int = 0  # Most packets in one of them
+    interval_ms: float = math.nan  # Mean time between connection events
+    jitter_ms: float = math.nan  # Standard deviation of that time
+    queue_wait_ms: float = math.nan  # Mean queue wait
+    max_queue_wait_ms: float = math.nan
+    # Sums the means are made from, not saved.
+    _intervals: list = dataclasses.field(default_factory=lambda: [0, 0.0, 0.0])
+    _waits: list = dataclasses.field(default_factory=lambda: [0, 0.0, 0.0])
+
+    @property
+    def missed_rate(self) -> float:
+        """Fraction of the samples sent that were missed."""
+        total = self.samples + self.missed_samples
+        return self.missed_samples / total if total else 0.0
+
+    def to_dict(self) -> dict:
+        row = {
+            field.name: getattr(self, field.name)
+            for field in dataclasses.fields(self)
+            if not field.name.startswith("_")
+        }
+        row["missed_rate"] = self.missed_rate
+        return row
+
+    def _close(self):
+        n, total, total_sq = self._intervals
+        if n:
+            self.interval_ms = total / n
+            self.jitter_ms = math.sqrt(max(0.0, total_sq / n - self.interval_ms**2))
+        n, total, max_wait = self._waits
+        if n:
+            self.queue_wait_ms = total / n
+            self.max_queue_wait_ms = max_wait
+
+
+class LinkTelemetry:
+    """Incremental link statistics of one session. record() is called once per
+    notification, in arrival order."""
+
+    def __init__(
+        self,
+        burst_gap_s: float = 0.0025,
+        window_s: float = 1.0,
+        history_len: int = 3600,
+    ):
+        """
+        burst_gap_s:    [Seconds] Notifications arriving closer than this are in the
+                        same connection event. Keep it below the connection interval
+                        (7.5 ms at the shortest).
+        window_s:       [Seconds] Length of the windows of the history.
+        history_len:    How many closed windows to keep.
+        """
+        self.burst_gap_ns = int(burst_gap_s * 1e9)
+        self.window_ns = int(window_s * 1e9)
+        self.windows: collections.deque[LinkWindow] = collections.deque((), history_len)
+        self.windows_closed = 0  # Windows closed in total, some no longer kept
+
+        self.packets = 0
+        self.samples = 0
+        self.missed_samples = 0
+        self.burst_sizes: collections.Counter = collections.Counter()
+        self.interval = LatencyHistogram()
+        self.queue_wait = LatencyHistogram()
+        # Welford's running mean and variance of the interval, in ms
+        self._interval_mean = 0.0
+        self._interval_m2 = 0.0
+
+        # time.time() - time.monotonic(), to give the windows a wall clock time
+        self._wall_offset_s = time.time() - time.monotonic()
+        self._first_ns: Optional[int] = None
+        self._prev_arrival_ns: Optional[int] = None
+        self._burst_start_ns: Optional[int] = None
+        self._burst_packets = 0
+        self._window: Optional[LinkWindow] = None
+        self._window_end_ns = 0
+
+    def record(
+        self,
+        ssn: int,
+        arrival_ns: int,
+        n_samples: int,
+        missed_samples: int,
+        dequeue_ns: Optional[int] = None,
+    ):
+        """Record a notification: its unwrapped SSN, time.monotonic_ns() when it
+        arrived and when it was taken off the queue (if known), its samples and the
+        samples missed right before it."""
+        if self._first_ns is None:
+            self._first_ns = arrival_ns
+        if arrival_ns >= self._window_end_ns:
+            self._close_window()
+            self._window = LinkWindow(
+                time=self._wall_offset_s + arrival_ns / 1e9,
+                t_s=(arrival_ns - self._first_ns) / 1e9,
+                first_ssn=ssn,
+            )
+            self._window_end_ns = arrival_ns + self.window_ns
+        window = self._window
+
+        prev_ns = self._prev_arrival_ns
+        if prev_ns is None or arrival_ns - prev_ns > self.burst_gap_ns:
+            if self._burst_start_ns is not None:
+                self._close_burst()
+                self._record_interval(arrival_ns - self._burst_start_ns)
+            self._burst_start_ns = arrival_ns
+            self._burst_packets = 0
+            window.bursts += 1
+        self._burst_packets += 1
+        window.max_burst = max(window.max_burst, self._burst_packets)
+        self._prev_arrival_ns = arrival_ns
+
+        self.packets += 1
+        self.samples += n_samples
+        self.missed_samples += missed_samples
+        window.packets += 1
+        window.samples += n_samples
+        window.missed_samples += missed_samples
+
+        if dequeue_ns is not None:
+            wait_ns = dequeue_ns - arrival_ns
+            self.queue_wait.record(wait_ns)
+            waits = window._waits
+            waits[0] += 1
+            waits[1] += wait_ns / 1e6
+            waits[2] = max(waits[2], wait_ns / 1e6)
+
+    def flush(self):
+        """Close the current burst and window, e.g. at the end of the session."""
+        if self._burst_start_ns is not None:
+            self._close_burst()
+            self._burst_start_ns = None
+            self._prev_arrival_ns = None
+        self._close_window()
+        self._window_end_ns = 0
+
+    def _close_burst(self):
+        self.burst_sizes[min(self._burst_packets, MAX_BURST_COUNTED)] += 1
+
+    def _record_interval(self, interval_ns: int):
+        self.interval.record(interval_ns)
+        interval_ms = interval_ns / 1e6
+        delta = interval_ms - self._interval_mean
+        self._interval_mean += delta / self.interval.count
+        self._interval_m2 += delta * (interval_ms - self._interval_mean)
+        intervals = self._window._intervals
+        intervals[0] += 1
+        intervals[1] += interval_ms
+        intervals[2] += interval_ms**2
+
+    def _close_window(self):
+        if self._window is not None:
+            self._window._close()
+            self.windows.append(self._window)
+            self.windows_closed += 1
+            self._window = None
+
+    @property
+    def bursts(self) -> int:
+        return sum(self.burst_sizes.values())
+
+    @property
+    def interval_ms(self) -> float:
+        """Mean time between connection events, NaN before the second one."""
+        return self._interval_mean if self.interval.count else math.nan
+
+    @property
+    def jitter_ms(self) -> float:
+        """Standard deviation of the time between connection events."""
+        if self.interval.count < 2:
+            return math.nan
+        return math.sqrt(self._interval_m2 / self.interval.count)
+
+    @property
+    def packets_per_interval(self) -> float:
+        bursts = self.bursts + (self._burst_start_ns is not None)
+        return self.packets / bursts if bursts else math.nan
+
+    @property
+    def missed_rate(self) -> float:
+        total = self.samples + self.missed_samples
+        return self.missed_samples / total if total else 0.0
+
+    def __str__(self):
+        max_burst = max(self.burst_sizes, default=self._burst_packets)
+        return (
+            f"link: interval {self.interval_ms:.2f}ms (jitter {self.jitter_ms:.2f}ms), "
+            f"{self.packets_per_interval:.2f} packets/interval (max {max_burst}), "
+            f"queue wait p99 {self.queue_wait.quantile_ns(0.99) / 1e6:.2f}ms, "
+            f"missed {self.missed_rate:.3%}"
+        )
+
+
+def write_link_log(path: str | pathlib.Path, windows) -> int:
+    """Append LinkWindow rows to a JSON lines file. Returns how many were written."""
+    n = 0
+    with open(path, "a") as f:
+        for window in windows:
+            f.write(json.dumps(window.to_dict()) + "\n")
+            n += 1
+    return n
+
+
+def read_link_log(path: str | pathlib.Path) -> list[dict]:
+    """The LinkWindow rows of a link log, as dicts."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def link_log_path(recording_path: str | pathlib.Path) -> pathlib.Path:
+    """Where FeedDataRecorder writes the link log of a recording."""
+    return pathlib.Path(recording_path).with_suffix(".link.jsonl")
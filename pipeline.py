@@ -0,0 +1,653 @@
+"""Feed pipelines declared in a config: processing stages and sinks, each placed inline,
+on a thread or in a process.
+
+A pipeline config (JSON) looks like:
+
+    {
+      "stages": [
+        {"name": "smooth", "type": "moving_average", "args": {"length": 8}},
+        {"name": "decim", "type": "decimate", "args": {"factor": 8},
+         "placement": "thread", "queue_size": 256, "batch_size": 16}
+      ],
+      "sinks": [
+        {"type": "record"},
+        {"type": "stats", "after": "decim"},
+        {"type": "csv", "after": "decim", "placement": "process"},
+        {"type": "metrics"}
+      ]
+    }
+
+Decoding is done by the FeedSession (or replay) the pipeline is attached to. The stages
+are chained after it, each transforming the batches of samples on their way (filter,
+decimate...). A sink taps the feed after the stage named by "after": by default the
+last one, "decode" for the unprocessed samples. Raw data sinks (e.g. "metrics") always
+get the raw notifications.
+
+"placement" says where a stage (with everything after it) or a sink runs:
+- "inline": in the FeedSession pump, like stream.py's flags, the default.
+- "thread": on a worker thread, fed through a queue of queue_size batches.
+- "process": in a worker process, built there from the config, so it doesn't share the
+  GIL with the pump. Batches are sent as arrays, so this needs numpy.
+Queued workers take up to batch_size waiting batches at a time, and merge runs of
+consecutive ones into a single call. A full queue blocks the pump, or with
+"overflow": "drop" (threads only) the batch is dropped, see ThreadedCallback.
+
+Async sinks (dsbu.AsyncNotifyCallbackFeeddatas) run on the FeedSession's event loop, so
+they can only be inline and tap "decode". Sinks with interactive_setup = True prompt on
+the terminal in setup() (e.g. "socket"), so they can't run in a process, which has no
+stdin.
+
+Stage and sink types are names in REGISTRY, which has the built-ins, whatever was added
+with register(), and plugins installed with a "dynamite_sampler.plugins" entry point. A
+"module:Class" path works too.
+"""
+
+import dataclasses
+import functools
+import importlib
+import json
+import pathlib
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+
+# Type name -> class, or "module:Class" to import on first use.
+REGISTRY: dict[str, type | str] = {
+    # Sinks
+    "metrics": "stream:MetricsPrinter",
+    "tqdm": "stream:TQDMPbar",
+    "stats": "stream:StatsPrinter",
+    "psd": "stream:SpectrumPrinter",
+    "socket": "stream:SocketStream",
+    "csv": "stream:FeedDataCSVWriter",
+    "record": "stream:FeedDataRecorder",
+    "serve": "query_service:QueryService",
+    # Processing stages
+    "moving_average": "pipeline:MovingAverage",
+    "decimate": "pipeline:Decimate",
+}
+ENTRY_POINT_GROUP = "dynamite_sampler.plugins"
+
+PLACEMENTS = ("inline", "thread", "process")
+DECODE = "decode"  # Name of the decoded feed, before any stage
+_ASYNC_CALLBACKS = (dsbu.AsyncNotifyCallbackRawData, dsbu.AsyncNotifyCallbackFeeddatas)
+
+# How often a producer blocked on a full queue checks that the worker is still alive.
+_WORKER_POLL_S = 0.1
+
+
+def register(name: str, target: type | str):
+    """Make a sink or stage class available to configs under name."""
+    REGISTRY[name] = target
+
+
+def resolve(type_name: str) -> type:
+    """The class of a stage or sink type name."""
+    target = REGISTRY.get(type_name)
+    if target is None and ":" in type_name:
+        target = type_name
+    if target is None:
+        from importlib import metadata
+
+        for entry_point in metadata.entry_points(group=ENTRY_POINT_GROUP):
+            if entry_point.name == type_name:
+                return entry_point.load()
+        raise ValueError(
+            f"Unknown pipeline type {type_name!r}, known: {', '.join(REGISTRY)}"
+        )
+    if isinstance(target, str):
+        module_name, _, class_name = target.partition(":")
+        return getattr(importlib.import_module(module_name), class_name)
+    return target
+
+
+class Processor:
+    """Abstract processing stage, transforms the batches of samples for the stages and
+    sinks after it."""
+
+    def setup(self, device_dict: dict) -> dict:
+        """Setup is called before streaming. Returns the device_dict to set up the
+        stages and sinks after this one with, e.g. with a lower sample rate."""
+        return device_dict
+
+    def process(
+        self, header: ds.FeedHeader, feeddatas: list[ds.FeedData], missing: int
+    ) -> Optional[tuple[ds.FeedHeader, list[ds.FeedData], int]]:
+        """Takes the arguments of NotifyCallbackFeeddatas.callback and returns them
+        transformed, or None to pass nothing on this time."""
+        return header, feeddatas, missing
+
+    def cleanup(self):
+        pass
+
+
+class MovingAverage(Processor):
+    """Boxcar low-pass filter: every sample becomes the mean of the last `length`
+    samples. The history restarts after dropped samples."""
+
+    def __init__(self, length: int = 8):
+        # Import inside the class so that numpy is only needed when this is used.
+        import numpy as np
+        import feed_arrays
+
+        self.np = np
+        self.feed_arrays = feed_arrays
+        self.length = int(length)
+        assert self.length > 0, "length must be at least one sample"
+        self._history = None  # Last length - 1 samples
+
+    def process(self, header, feeddatas, missing):
+        np = self.np
+        x = self.feed_arrays.feeddatas_to_array(feeddatas).astype(np.float64)
+        if len(x) == 0:
+            return header, feeddatas, missing
+        if self._history is None or missing:
+            # Start as if the first sample had been there all along.
+            self._history = np.repeat(x[:1], self.length - 1, axis=0)
+
+        extended = np.concatenate([self._history, x])
+        sums = np.cumsum(extended, axis=0)
+        sums = np.concatenate([np.zeros((1, x.shape[1])), sums])
+        y = (sums[self.length :] - sums[: -self.length]) / self.length
+        self._history = extended[len(extended) - (self.length - 1) :]
+
+        y = np.rint(y).astype(np.int32)
+        return header, self.feed_arrays.array_to_feeddatas(y), missing
+
+
+class Decimate(Processor):
+    """Reduces the sample rate by `factor`, averaging each block of factor samples.
+
+    Output sample k is the mean of the input samples with SSN k * factor to
+    (k + 1) * factor - 1, so the output SSNs count at the lower rate. A block with
+    dropped samples in it is skipped, and counted as missing.
+    """
+
+    def __init__(self, factor: int = 8):
+        # Import inside the class so that numpy is only needed when this is used.
+        import numpy as np
+        import feed_arrays
+
+        self.np = np
+        self.feed_arrays = feed_arrays
+        self.factor = int(factor)
+        assert self.factor > 0, "factor must be at least 1"
+        self._carry = None  # Samples of the incomplete block
+        self._carry_ssn = 0  # SSN of the first carried sample
+        self._next_out: Optional[int] = None  # Next output SSN expected
+
+    def setup(self, device_dict):
+        device_dict = dict(device_dict)
+        if device_dict.get("ADCConfig"):
+            adc_config = device_dict["ADCConfig"]
+            device_dict["ADCConfig"] = dataclasses.replace(
+                adc_config, sample_rate=adc_config.sample_rate // self.factor
+            )
+        return device_dict
+
+    def process(self, header, feeddatas, missing):
+        np = self.np
+        f = self.factor
+        x = self.feed_arrays.feeddatas_to_array(feeddatas)
+        ssn = header.sample_sequence_number
+        if self._carry is not None and self._carry_ssn + len(self._carry) == ssn:
+            x = np.concatenate([self._carry, x])
+            ssn = self._carry_ssn
+
+        # Drop the samples before the first block boundary.
+        skip = min((-ssn) % f, len(x))
+        x = x[skip:]
+        ssn += skip
+
+        n_out = len(x) // f
+        self._carry = x[n_out * f :]
+        self._carry_ssn = ssn + n_out * f
+        if n_out == 0:
+            return None
+
+        blocks = x[: n_out * f].reshape(n_out, f, -1).astype(np.float64)
+        y = np.rint(blocks.mean(axis=1)).astype(np.int32)
+        out_ssn = ssn // f
+        missing_out = 0 if self._next_out is None else out_ssn - self._next_out
+        self._next_out = out_ssn + n_out
+        return (
+            ds.FeedHeader(out_ssn),
+            self.feed_arrays.array_to_feeddatas(y),
+            max(missing_out, 0),
+        )
+
+
+class StageNode(dsbu.NotifyCallbackFeeddatas):
+    """Runs a processing stage and passes its output to the stages and sinks after it."""
+
+    def __init__(self, name: str, processor: Processor, downstream: list):
+        self.stage_name = name
+        self.processor = processor
+        self.downstream = downstream
+
+    def setup(self, device_dict):
+        device_dict = self.processor.setup(device_dict)
+        for cb in self.downstream:
+            cb.setup(device_dict)
+
+    def callback(self, header, feeddatas, missing):
+        out = self.processor.process(header, feeddatas, missing)
+        if out is None:
+            return
+        for cb in self.downstream:
+            cb.callback(*out)
+
+    def cleanup(self):
+        self.processor.cleanup()
+        for cb in self.downstream:
+            try:
+                cb.cleanup()
+            except Exception as e:
+                print(f"  cleanup error for {cb}: {e}")
+
+
+def merge_batches(batches: list[tuple]) -> list[tuple]:
+    """Merge runs of consecutive (header, feeddatas, missing) batches into one."""
+    merged = []
+    for header, feeddatas, missing in batches:
+        if merged and missing == 0:
+            prev_header, prev_feeddatas, _ = merged[-1]
+            next_ssn = prev_header.sample_sequence_number + len(prev_feeddatas)
+            if next_ssn == header.sample_sequence_number:
+                prev_feeddatas.extend(feeddatas)
+                continue
+        merged.append((header, list(feeddatas), missing))
+    return merged
+
+
+def _worker_loop(
+    q, sink, batch_size: int, merge: bool, decode: Optional[Callable] = None
+):
+    """Call the sink with the queued batches, until the None sentinel."""
+    done = False
+    while not done:
+        items = [q.get()]
+        while len(items) < batch_size and items[-1] is not None:
+            try:
+                items.append(q.get_nowait())
+            except queue.Empty:
+                break
+        if items[-1] is None:
+            items.pop()
+            done = True
+        if decode is not None:
+            items = [decode(*args) for args in items]
+        if merge and len(items) > 1:
+            items = merge_batches(items)
+        for args in items:
+            sink.callback(*args)
+
+
+def _name(sink) -> str:
+    return getattr(sink, "stage_name", type(sink).__name__)
+
+
+class ThreadedCallback:
+    """Runs a raw or feeddata callback on a worker thread, fed through a bounded queue.
+    Errors on the worker are raised on the next call.
+
+    The batches are queued as they are, not copied, so every sink must treat them as
+    read-only. When the queue is full, overflow="block" waits for the worker (and so
+    holds up the pump), overflow="drop" drops the batch instead, so a slow sink only
+    loses data itself. Dropped samples are added to the missing count of the next batch
+    the sink gets, so to the sink they look like BLE drops.
+    """
+
+    OVERFLOWS = ("block", "drop")
+
+    def __init__(
+        self,
+        sink,
+        kind: str = "feeddata",
+        queue_size: int = 64,
+        batch_size: int = 1,
+        overflow: str = "block",
+    ):
+        assert overflow in self.OVERFLOWS, f"overflow must be one of {self.OVERFLOWS}"
+        self.sink = sink
+        self.kind = kind
+        self.queue_size = int(queue_size)
+        self.batch_size = int(batch_size)
+        self.overflow = overflow
+        self.stage_name = f"{_name(sink)}@thread"
+        if hasattr(sink, "link_telemetry"):
+            self.link_telemetry = None  # Set by FeedSession, passed on to the sink
+        self._error: Optional[BaseException] = None
+        self._thread: Optional[threading.Thread] = None
+
+        # Counters, written by the pump (drops) and the worker (lag)
+        self.batches = 0  # Batches passed to the sink
+        self.dropped_batches = 0
+        self.dropped_samples = 0
+        self.lag_s = 0.0  # Time the latest batch waited in the queue
+        self.max_lag_s = 0.0
+        self._dropped_pending = 0  # Missing samples to add to the next batch
+
+    def stats(self) -> dict:
+        """The lag and drop counters, and the current queue depth."""
+        return dict(
+            queued=self._queue.qsize() if self._thread is not None else 0,
+            batches=self.batches,
+            dropped_batches=self.dropped_batches,
+            dropped_samples=self.dropped_samples,
+            lag_s=self.lag_s,
+            max_lag_s=self.max_lag_s,
+        )
+
+    def setup(self, device_dict):
+        if hasattr(self, "link_telemetry"):
+            self.sink.link_telemetry = self.link_telemetry
+        self.sink.setup(device_dict)
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            merge = self.kind == "feeddata"
+            _worker_loop(self._queue, self.sink, self.batch_size, merge, self._unstamp)
+        except BaseException as e:
+            self._error = e
+
+    def _unstamp(self, enqueued: float, args: tuple) -> tuple:
+        self.lag_s = time.monotonic() - enqueued
+        self.max_lag_s = max(self.max_lag_s, self.lag_s)
+        self.batches += 1
+        return args
+
+    def callback(self, *args):
+        if self._error is not None:
+            raise self._error
+        if self.overflow == "drop":
+            self._put_or_drop(args)
+            return
+        while True:
+            try:
+                self._queue.put((time.monotonic(), args), timeout=_WORKER_POLL_S)
+                return
+            except queue.Full:
+                if self._error is not None:
+                    raise self._error
+
+    def _put_or_drop(self, args: tuple):
+        if self.kind == "feeddata" and self._dropped_pending:
+            header, feeddatas, missing = args
+            args = (header, feeddatas, missing + self._dropped_pending)
+        try:
+            self._queue.put_nowait((time.monotonic(), args))
+            self._dropped_pending = 0
+        except queue.Full:
+            self.dropped_batches += 1
+            if self.kind == "feeddata":
+                _, feeddatas, missing = args
+                self.dropped_samples += len(feeddatas)
+                self._dropped_pending = missing + len(feeddatas)
+
+    def cleanup(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self.overflow == "drop":
+            print(
+                f"{self.stage_name}: {self.batches} batches, dropped "
+                f"{self.dropped_batches} ({self.dropped_samples} samples), "
+                f"max lag {self.max_lag_s * 1000:.1f}ms"
+            )
+        self.sink.cleanup()
+        if self._error is not None:
+            raise self._error
+
+
+def fan_out(
+    callbacks_raw: list,
+    callbacks_feeddata: list,
+    queue_size: int = 256,
+    overflow: str = "drop",
+) -> tuple[list, list]:
+    """Give every callback its own worker thread and queue of queue_size batches, so
+    the pump only queues the decoded batches (shared, not copied) and a slow sink can
+    only hold up itself. Callbacks that already have a worker are left as they are."""
+
+    def wrap(cb, kind):
+        if isinstance(cb, (ThreadedCallback, ProcessCallback, *_ASYNC_CALLBACKS)):
+            return cb  # Async callbacks already run alongside the pump
+        return ThreadedCallback(cb, kind, queue_size, overflow=overflow)
+
+    return (
+        [wrap(cb, "raw") for cb in callbacks_raw],
+        [wrap(cb, "feeddata") for cb in callbacks_feeddata],
+    )
+
+
+def _process_main(factory, q, device_dict: dict, kind: str, batch_size: int):
+    sink = factory()
+    sink.setup(device_dict)
+    decode = None
+    if kind == "feeddata":
+        import feed_arrays
+
+        def decode(ssn, samples, missing):
+            return ds.FeedHeader(ssn), feed_arrays.array_to_feeddatas(samples), missing
+
+    try:
+        _worker_loop(q, sink, batch_size, kind == "feeddata", decode)
+    finally:
+        sink.cleanup()
+
+
+class ProcessCallback:
+    """Runs a raw or feeddata callback in a worker process, fed through a bounded queue.
+
+    The callback is built in the worker by factory(), which has to be picklable (e.g. a
+    functools.partial of a module level function), so the callback itself needn't be.
+    """
+
+    def __init__(
+        self,
+        factory: Callable,
+        kind: str = "feeddata",
+        queue_size: int = 64,
+        batch_size: int = 1,
+        name: str = "",
+    ):
+        self.factory = factory
+        self.kind = kind
+        self.queue_size = int(queue_size)
+        self.batch_size = int(batch_size)
+        self.stage_name = f"{name}@process"
+        self._process = None
+
+        if kind == "feeddata":
+            # Import inside the class so that numpy is only needed when this is used.
+            import feed_arrays
+
+            self.feed_arrays = feed_arrays
+
+    def setup(self, device_dict):
+        import multiprocessing
+
+        # Spawn rather than fork, forking a process running asyncio and threads isn't
+        # safe.
+        ctx = multiprocessing.get_context("spawn")
+        self._queue = ctx.Queue(self.queue_size)
+        self._process = ctx.Process(
+            target=_process_main,
+            args=(self.factory, self._queue, device_dict, self.kind, self.batch_size),
+            daemon=True,
+        )
+        self._process.start()
+
+    def callback(self, *args):
+        if self.kind == "feeddata":
+            header, feeddatas, missing = args
+            samples = self.feed_arrays.feeddatas_to_array(feeddatas)
+            args = (header.sample_sequence_number, samples, missing)
+        while True:
+            try:
+                self._queue.put(args, timeout=_WORKER_POLL_S)
+                return
+            except queue.Full:
+                if not self._process.is_alive():
+                    raise RuntimeError(f"{self.stage_name} worker process died")
+
+    def cleanup(self):
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self._queue.put(None)
+        self._process.join()
+        if self._process.exitcode != 0:
+            raise RuntimeError(
+                f"{self.stage_name} worker process failed, "
+                f"exit code {self._process.exitcode}"
+            )
+
+
+def load_config(path: str | pathlib.Path) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def _is_raw(spec: dict) -> bool:
+    cls = resolve(spec["type"])
+    return issubclass(
+        cls, (dsbu.NotifyCallbackRawData, dsbu.AsyncNotifyCallbackRawData)
+    )
+
+
+def check_config(config: dict):
+    """Raise a ValueError describing the first problem in a pipeline config."""
+    unknown = set(config) - {"stages", "sinks"}
+    if unknown:
+        raise ValueError(f"Unknown pipeline config keys: {sorted(unknown)}")
+    stages = config.get("stages", [])
+    sinks = config.get("sinks", [])
+
+    names = [DECODE]
+    in_process = {DECODE: False}  # Stage name -> runs in a worker process
+    for spec in stages:
+        if "name" not in spec or "type" not in spec:
+            raise ValueError(f"Stage needs a name and a type: {spec}")
+        if spec["name"] in names:
+            raise ValueError(f"Stage name {spec['name']!r} is used twice")
+        if not issubclass(resolve(spec["type"]), Processor):
+            raise ValueError(f"{spec['type']!r} is not a processing stage")
+        if spec.get("placement") == "process" and in_process[names[-1]]:
+            raise ValueError(
+                f"Stage after a process stage can't start a process: {spec}"
+            )
+        in_process[spec["name"]] = (
+            in_process[names[-1]] or spec.get("placement") == "process"
+        )
+        names.append(spec["name"])
+    for spec in [*stages, *sinks]:
+        if "type" not in spec:
+            raise ValueError(f"Sink needs a type: {spec}")
+        allowed = {"name", "type", "args", "after", "placement"}
+        allowed |= {"queue_size", "batch_size", "overflow"}
+        if set(spec) - allowed:
+            raise ValueError(f"Unknown keys {sorted(set(spec) - allowed)} in {spec}")
+        if spec.get("placement", "inline") not in PLACEMENTS:
+            raise ValueError(f"placement must be one of {PLACEMENTS}: {spec}")
+        if spec.get("overflow", "block") not in ThreadedCallback.OVERFLOWS:
+            raise ValueError(f"overflow must be one of {ThreadedCallback.OVERFLOWS}")
+        if "overflow" in spec and spec.get("placement") != "thread":
+            raise ValueError(f"overflow only applies to thread placement: {spec}")
+        for key in ("queue_size", "batch_size"):
+            if not (isinstance(spec.get(key, 1), int) and spec.get(key, 1) > 0):
+                raise ValueError(f"{key} must be a positive integer: {spec}")
+    for spec in sinks:
+        if spec.get("after", names[-1]) not in names:
+            raise ValueError(f"Sink after an unknown stage: {spec}")
+        if issubclass(resolve(spec["type"]), Processor):
+            raise ValueError(f"{spec['type']!r} is a stage, not a sink")
+        if _is_raw(spec) and spec.get("after", DECODE) != DECODE:
+            raise ValueError(f"Raw data sinks can't come after a stage: {spec}")
+        if issubclass(resolve(spec["type"]), _ASYNC_CALLBACKS):
+            # They are run by the FeedSession's event loop.
+            if spec.get("after", names[-1]) != DECODE and not _is_raw(spec):
+                raise ValueError(f"Async sinks can't come after a stage: {spec}")
+            if spec.get("placement", "inline") != "inline":
+                raise ValueError(f"Async sinks can only be placed inline: {spec}")
+        if (
+            spec.get("placement") == "process"
+            and in_process[spec.get("after", names[-1])]
+        ):
+            # Worker processes are daemonic, they can't start processes of their own.
+            raise ValueError(
+                f"Sink after a process stage can't start a process: {spec}"
+            )
+        if getattr(resolve(spec["type"]), "interactive_setup", False) and (
+            spec.get("placement") == "process"
+            or in_process[spec.get("after", names[-1])]
+        ):
+            raise ValueError(
+                f"{spec['type']!r} prompts on the terminal in setup(), it can't run "
+                f"in a process: {spec}"
+            )
+
+
+def _placed(spec: dict, kind: str, factory: functools.partial):
+    """The callback of a stage or sink, at its placement."""
+    placement = spec.get("placement", "inline")
+    queue_kwargs = dict(
+        queue_size=spec.get("queue_size", 64), batch_size=spec.get("batch_size", 1)
+    )
+    if placement == "thread":
+        overflow = spec.get("overflow", "block")
+        return ThreadedCallback(factory(), kind, overflow=overflow, **queue_kwargs)
+    if placement == "process":
+        name = spec.get("name", spec["type"])
+        return ProcessCallback(factory, kind, name=name, **queue_kwargs)
+    return factory()
+
+
+def _build_sink(spec: dict):
+    return resolve(spec["type"])(**spec.get("args", {}))
+
+
+def _build_taps(config: dict, after: str) -> list:
+    stages = config.get("stages", [])
+    last = stages[-1]["name"] if stages else DECODE
+    return [
+        _placed(spec, "feeddata", functools.partial(_build_sink, spec))
+        for spec in config.get("sinks", [])
+        if spec.get("after", last) == after and not _is_raw(spec)
+    ]
+
+
+def _build_stage(config: dict, i: int) -> StageNode:
+    """Stage i of the config, followed by the rest of the pipeline."""
+    stages = config["stages"]
+    spec = stages[i]
+    downstream = _build_taps(config, spec["name"])
+    if i + 1 < len(stages):
+        factory = functools.partial(_build_stage, config, i + 1)
+        downstream.append(_placed(stages[i + 1], "feeddata", factory))
+    processor = resolve(spec["type"])(**spec.get("args", {}))
+    return StageNode(spec["name"], processor, downstream)
+
+
+def build_pipeline(config: dict) -> tuple[list, list]:
+    """Build the callbacks of a pipeline config, returns (callbacks_raw,
+    callbacks_feeddata) to run with a FeedSession or replay."""
+    check_config(config)
+    callbacks_raw = [
+        _placed(spec, "raw", functools.partial(_build_sink, spec))
+        for spec in config.get("sinks", [])
+        if _is_raw(spec)
+    ]
+    callbacks_feeddata = _build_taps(config, DECODE)
+    if config.get("stages"):
+        factory = functools.partial(_build_stage, config, 0)
+        callbacks_feeddata.append(_placed(config["stages"][0], "feeddata", factory))
+    return callbacks_raw, callbacks_feeddata
@@ -0,0 +1,274 @@
+"""Instrumentation of the FeedSession pipeline: where does the time go when a capture lags?
+
+PipelineMetrics is filled in by FeedSession when one is passed to it. It records:
+- a latency histogram per stage: queue wait (notification to pump), unpack, SSN unwrap,
+  and each callback,
+- the notification queue depth over time,
+- packet, byte and cumulative missed sample counters,
+- the hits and misses of the session's BufferPool, if it has one.
+
+It can be read in-process, printed as text, or served in the Prometheus text format on a
+local port with serve_metrics().
+"""
+
+import collections
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from profiling import ProfilerHook
+
+if TYPE_CHECKING:
+    import http.server
+
+
+class LatencyHistogram:
+    """Histogram of durations in nanoseconds with power-of-two buckets, so recording is
+    O(1) and the memory is fixed."""
+
+    MIN_EXP = 8  # First bucket is everything up to 2**8 ns = 256 ns
+    N_BUCKETS = 27  # Last finite bucket ends at 2**34 ns ~ 17 s
+
+    def __init__(self):
+        self.buckets = [0] * (self.N_BUCKETS + 1)  # Last one is +Inf
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, duration_ns: int):
+        i = max(0, duration_ns.bit_length() - self.MIN_EXP)
+        self.buckets[min(i, self.N_BUCKETS)] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    @classmethod
+    def bucket_upper_ns(cls, i: int) -> float:
+        """Upper bound (inclusive) of bucket i."""
+        if i >= cls.N_BUCKETS:
+            return float("inf")
+        return float(2 ** (i + cls.MIN_EXP) - 1)
+
+    @property
+    def mean_ns(self) -> float:
+        return self.total_ns / self.count if self.count else 0.0
+
+    def quantile_ns(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile; an overestimate of at most
+        2x, which is plenty to tell microseconds from milliseconds."""
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for i, n in enumerate(self.buckets):
+            running += n
+            if running >= target:
+                return min(self.bucket_upper_ns(i), float(self.max_ns))
+        return float(self.max_ns)
+
+
+class PipelineMetrics(ProfilerHook):
+    """Counters and histograms of one FeedSession. The stage timing is a ProfilerHook;
+    stages don't nest, so one start stamp is enough."""
+
+    STAGE_QUEUE_WAIT = "queue_wait"
+    STAGE_UNPACK = "unpack"
+    STAGE_UNWRAP = "unwrap"
+
+    def __init__(self, depth_sample_dt: float = 0.1, depth_history_len: int = 600):
+        """
+        depth_sample_dt:    [Seconds] The minimum time between queue depth samples kept
+                            in the history.
+        depth_history_len:  How many (time, depth) samples to keep.
+        """
+        self.stages: dict[str, LatencyHistogram] = {}
+        for stage in (self.STAGE_QUEUE_WAIT, self.STAGE_UNPACK, self.STAGE_UNWRAP):
+            self.stages[stage] = LatencyHistogram()
+
+        self.packets = 0
+        self.bytes = 0
+        self.samples = 0
+        self.missed_samples = 0
+
+        self.queue_depth = 0
+        self.queue_depth_max = 0
+        self.depth_sample_dt = float(depth_sample_dt)
+        # (time.monotonic(), depth) pairs
+        self.queue_depth_history = collections.deque((), depth_history_len)
+        self._prev_depth_sample = 0.0
+
+        self.start_time = time.monotonic()
+        self._stage_start_ns = 0
+        self.buffer_pool = None  # Set by FeedSession when it decodes into a BufferPool
+        self.link_telemetry = None  # The session's LinkTelemetry, set by FeedSession
+
+    def stage(self, name: str) -> LatencyHistogram:
+        """Histogram of the given stage, created on first use."""
+        hist = self.stages.get(name)
+        if hist is None:
+            hist = self.stages[name] = LatencyHistogram()
+        return hist
+
+    def start(self, stage: str):
+        self._stage_start_ns = time.monotonic_ns()
+
+    def stop(self, stage: str):
+        self.stage(stage).record(time.monotonic_ns() - self._stage_start_ns)
+
+    def record_packet(self, enqueue_ns: int, queue_depth: int):
+        """Record a notification taken off the queue: its wait and the depth left."""
+        self.stage(self.STAGE_QUEUE_WAIT).record(time.monotonic_ns() - enqueue_ns)
+        self.record_queue_depth(queue_depth)
+
+    def record_unpacked(self, n_bytes: int, n_samples: int, missed_samples: int):
+        self.packets += 1
+        self.bytes += n_bytes
+        self.samples += n_samples
+        self.missed_samples += missed_samples
+
+    def record_queue_depth(self, depth: int):
+        self.queue_depth = depth
+        if depth > self.queue_depth_max:
+            self.queue_depth_max = depth
+        now = time.monotonic()
+        if now - self._prev_depth_sample >= self.depth_sample_dt:
+            self._prev_depth_sample = now
+            self.queue_depth_history.append((now, depth))
+
+    def to_text(self) -> str:
+        """Human readable summary."""
+        elapsed = time.monotonic() - self.start_time
+        lines = [
+            f"elapsed {elapsed:.1f}s, {self.packets} packets, {self.bytes} bytes, "
+            f"{self.samples} samples, {self.missed_samples} missed samples",
+            f"queue depth {self.queue_depth} (max {self.queue_depth_max})",
+        ]
+        if self.buffer_pool is not None:
+            lines.append(str(self.buffer_pool))
+        if self.link_telemetry is not None:
+            lines.append(str(self.link_telemetry))
+        lines += [
+            f"{'stage':<40} {'count':>10} {'mean':>10} {'p50':>10} "
+            f"{'p99':>10} {'max':>10}",
+        ]
+        for name, hist in list(self.stages.items()):
+            lines.append(
+                f"{name:<40} {hist.count:>10} "
+                f"{hist.mean_ns / 1000:>8.1f}us "
+                f"{hist.quantile_ns(0.5) / 1000:>8.1f}us "
+                f"{hist.quantile_ns(0.99) / 1000:>8.1f}us "
+                f"{hist.max_ns / 1000:>8.1f}us"
+            )
+        return "\n".join(lines)
+
+    def to_prometheus(self) -> str:
+        """Snapshot in the Prometheus text exposition format."""
+        prefix = "dynamite_feed"
+        lines = []
+
+        for metric, value, help_str in (
+            ("packets_total", self.packets, "Notifications processed"),
+            ("bytes_total", self.bytes, "Notification bytes processed"),
+            ("samples_total", self.samples, "Samples received"),
+            ("missed_samples_total", self.missed_samples, "Samples dropped"),
+            *self._pool_counters(),
+        ):
+            lines.append(f"# HELP {prefix}_{metric} {help_str}")
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            lines.append(f"{prefix}_{metric} {value}")
+
+        for metric, value, help_str in (
+            ("queue_depth", self.queue_depth, "Notifications waiting in the queue"),
+            ("queue_depth_max", self.queue_depth_max, "Largest queue depth seen"),
+            *self._pool_gauges(),
+            *self._link_gauges(),
+        ):
+            lines.append(f"# HELP {prefix}_{metric} {help_str}")
+            lines.append(f"# TYPE {prefix}_{metric} gauge")
+            lines.append(f"{prefix}_{metric} {value}")
+
+        metric = f"{prefix}_stage_seconds"
+        lines.append(f"# HELP {metric} Time spent per packet in each pipeline stage")
+        lines.append(f"# TYPE {metric} histogram")
+        for name, hist in list(self.stages.items()):
+            label = f'stage="{name}"'
+            running = 0
+            for i, n in enumerate(hist.buckets):
+                running += n
+                upper = hist.bucket_upper_ns(i)
+                le = "+Inf" if upper == float("inf") else f"{upper / 1e9:.9g}"
+                lines.append(f'{metric}_bucket{{{label},le="{le}"}} {running}')
+            lines.append(f"{metric}_sum{{{label}}} {hist.total_ns / 1e9:.9g}")
+            lines.append(f"{metric}_count{{{label}}} {hist.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def _pool_counters(self) -> list[tuple]:
+        pool = self.buffer_pool
+        if pool is None:
+            return []
+        return [
+            ("pool_hits_total", pool.hits, "Packets decoded into a pooled block"),
+            ("pool_misses_total", pool.misses, "Packets that needed a new block"),
+        ]
+
+    def _pool_gauges(self) -> list[tuple]:
+        pool = self.buffer_pool
+        if pool is None:
+            return []
+        return [("pool_blocks_in_use", pool.in_use, "Pooled blocks held by sinks")]
+
+    def _link_gauges(self) -> list[tuple]:
+        link = self.link_telemetry
+        if link is None or not link.interval.count:
+            return []
+        return [
+            (
+                "link_interval_seconds",
+                f"{link.interval_ms / 1e3:.9g}",
+                "Mean time between connection events",
+            ),
+            (
+                "link_jitter_seconds",
+                f"{link.jitter_ms / 1e3:.9g}",
+                "Standard deviation of the time between connection events",
+            ),
+            (
+                "link_packets_per_interval",
+                f"{link.packets_per_interval:.9g}",
+                "Mean notifications per connection event",
+            ),
+        ]
+
+
+def serve_metrics(
+    metrics: PipelineMetrics, port: int, host: str = "127.0.0.1"
+) -> "http.server.ThreadingHTTPServer":
+    """Serve the metrics from a background thread: `/metrics` in the Prometheus format,
+    anything else as text. Call .shutdown() on the returned server to stop it."""
+    # Imported here, it's slow to import and only needed when serving.
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] == "/metrics":
+                body = metrics.to_prometheus()
+                content_type = "text/plain; version=0.0.4"
+            else:
+                body = metrics.to_text() + "\n"
+                content_type = "text/plain"
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass  # Don't print every scrape over the stream output
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,213 @@
+"""Profiler hooks run around each stage of the FeedSession pump.
+
+FeedSession calls hook.start(stage) / hook.stop(stage) around the decode ("unpack", or
+"decode_block" into a pooled block), the SSN unwrapping ("unwrap") and every callback
+("raw:<class>" / "feeddata:<class>" / "samples:<class>").
+
+Two on-demand profilers are included. They cost next to nothing until triggered, by
+trigger() or a signal (`kill -USR1 <pid>`), then profile the stages for a bounded
+interval and write the result to a file, so a running capture can be profiled without
+restarting it:
+- CProfileProfiler: deterministic, writes a .prof file (`python -m pstats` or snakeviz).
+- SamplingProfiler: samples the pump's stack from a thread, writes collapsed stacks
+  (one "stage;frame;frame count" line per stack, the input of flamegraph.pl/speedscope).
+"""
+
+import collections
+import cProfile
+import datetime
+import os
+import pathlib
+import signal
+import sys
+import threading
+import time
+from typing import Iterable, Optional
+
+
+class ProfilerHook:
+    """Abstract hook called by FeedSession around each pipeline stage."""
+
+    def start(self, stage: str):
+        pass
+
+    def stop(self, stage: str):
+        pass
+
+
+def stage_names(callbacks: Iterable, kind: str) -> list[str]:
+    """Stage names for a list of callbacks, e.g. "feeddata:FeedDataCSVWriter".
+    Callbacks can name themselves with a stage_name attribute, otherwise their class
+    name is used. Repeated names get a #n suffix so they can be told apart."""
+    names = []
+    for cb in callbacks:
+        name = f"{kind}:{getattr(cb, 'stage_name', type(cb).__name__)}"
+        n = 1
+        unique = name
+        while unique in names:
+            n += 1
+            unique = f"{name}#{n}"
+        names.append(unique)
+    return names
+
+
+class OnDemandProfiler(ProfilerHook):
+    """Base class for profilers that are armed for a bounded interval on request.
+
+    trigger() only flags the request, so it is safe to call from a signal handler or
+    another thread; profiling begins at the next stage start, in the pump.
+    """
+
+    suffix = ".txt"
+
+    def __init__(self, output_dir: str = "./profiles", duration_s: float = 10.0):
+        """
+        output_dir: Directory the profile files are written to.
+        duration_s: [Seconds] Default length of a profiling interval.
+        """
+        self.output_dir = pathlib.Path(output_dir).resolve()
+        self.duration_s = float(duration_s)
+        self._requested: Optional[float] = None  # Duration of a pending request
+        self._deadline: Optional[float] = None  # Set while profiling
+        self.last_output: Optional[pathlib.Path] = None
+
+    @property
+    def active(self) -> bool:
+        return self._deadline is not None
+
+    def trigger(self, duration_s: Optional[float] = None):
+        """Request profiling for duration_s seconds (defaults to self.duration_s)."""
+        self._requested = self.duration_s if duration_s is None else float(duration_s)
+
+    def install_signal_handler(self, signum: int = getattr(signal, "SIGUSR1", None)):
+        """Trigger profiling when the process receives signum (SIGUSR1 by default,
+        which only exists on POSIX). Must be called from the main thread."""
+        if signum is None:
+            raise RuntimeError("No default profiling signal on this platform")
+        signal.signal(signum, lambda *_: self.trigger())
+        print(
+            f"Profiling: `kill -{signal.Signals(signum).name[3:]} {os.getpid()}` "
+            f"profiles the feed for {self.duration_s:g}s into {self.output_dir}"
+        )
+
+    def start(self, stage: str):
+        if self._requested is not None:
+            duration_s, self._requested = self._requested, None
+            if not self.active:
+                self._deadline = time.monotonic() + duration_s
+                self._begin()
+        if self.active:
+            self._start_stage(stage)
+
+    def stop(self, stage: str):
+        if not self.active:
+            return
+        self._stop_stage(stage)
+        if time.monotonic() >= self._deadline:
+            self.finish()
+
+    def finish(self):
+        """End the current profiling interval early and write its output."""
+        if not self.active:
+            return
+        self._deadline = None
+        date_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        path = self.output_dir / f"profile_{date_str}{self.suffix}"
+        self._end(path)
+        self.last_output = path
+        print(f"Profiling: wrote {path}")
+
+    # Implemented by subclasses.
+    def _begin(self):
+        pass
+
+    def _start_stage(self, stage: str):
+        pass
+
+    def _stop_stage(self, stage: str):
+        pass
+
+    def _end(self, path: pathlib.Path):
+        pass
+
+
+class CProfileProfiler(OnDemandProfiler):
+    """cProfile, enabled only while a stage runs, so the event loop waiting for
+    notifications doesn't drown out the sinks."""
+
+    suffix = ".prof"
+
+    def _begin(self):
+        self._profile = cProfile.Profile()
+
+    def _start_stage(self, stage: str):
+        self._profile.enable()
+
+    def _stop_stage(self, stage: str):
+        self._profile.disable()
+
+    def _end(self, path: pathlib.Path):
+        self._profile.dump_stats(path)
+        self._profile = None
+
+
+class SamplingProfiler(OnDemandProfiler):
+    """Statistical profiler: a background thread samples the pump thread's stack every
+    interval_s while a stage runs, and counts the collapsed stacks.
+
+    Much lower overhead than cProfile for the profiled code, at the cost of only seeing
+    where time is spent, not call counts.
+    """
+
+    suffix = ".collapsed.txt"
+
+    def __init__(
+        self,
+        output_dir: str = "./profiles",
+        duration_s: float = 10.0,
+        interval_s: float = 0.001,
+    ):
+        """interval_s: [Seconds] Time between stack samples."""
+        super().__init__(output_dir, duration_s)
+        self.interval_s = float(interval_s)
+        self._stage: Optional[str] = None  # Stage currently running in the pump
+        self._thread_id: Optional[int] = None
+        self._counts: collections.Counter = collections.Counter()
+        self._sampler: Optional[threading.Thread] = None
+        self._stop_sampling = threading.Event()
+
+    def _begin(self):
+        self._thread_id = threading.get_ident()
+        self._counts = collections.Counter()
+        self._stop_sampling.clear()
+        self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+
+    def _start_stage(self, stage: str):
+        self._stage = stage
+
+    def _stop_stage(self, stage: str):
+        self._stage = None
+
+    def _sample_loop(self):
+        while not self._stop_sampling.wait(self.interval_s):
+            stage = self._stage
+            if stage is None:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(stage)
+            self._counts[";".join(reversed(stack))] += 1
+
+    def _end(self, path: pathlib.Path):
+        self._stop_sampling.set()
+        self._sampler.join()
+        with open(path, "w") as f:
+            for stack, count in self._counts.most_common():
+                print(stack, count, file=f)
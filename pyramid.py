@@ -0,0 +1,371 @@
+"""Multi-resolution min/max/mean summary of a capture, for browsing long recordings.
+
+Level 0 summarizes every bin of base_samples consecutive SSNs (min, max, sum and count
+per channel), and every following level merges factor bins of the level below. Bins are
+aligned on multiples of their size in SSN, so dropped samples only leave bins out or
+partially filled.
+
+The pyramid is built incrementally as samples are added; RecordingWriter builds one
+while writing and saves it next to the recording (see pyramid_path()). With
+max_live_bins, only the latest bins of each level stay in memory and the older ones are
+spilled to a temporary file, so a long recording doesn't grow the writer's memory.
+
+query() returns a range of samples summarized into pixels from the coarsest level with
+at least one bin per pixel, so its cost depends on the width asked for, not on the
+length of the capture. Ranges zoomed in past level 0 are summarized from the raw
+samples instead, when a function to read them is given.
+
+Build the pyramids of existing recordings with `python pyramid.py capture.dynrec`.
+"""
+
+import dataclasses
+import pathlib
+import tempfile
+import threading
+import weakref
+from typing import Callable, Optional
+
+import numpy as np
+
+_FIELDS = ("index", "min", "max", "sum", "count")
+
+
+@dataclasses.dataclass
+class Overview:
+    """A range of samples summarized into pixels, the result of Pyramid.query()."""
+
+    edges: np.ndarray  # int64 (width + 1,): first SSN of each pixel, then the end SSN
+    min: np.ndarray  # (width, n_channels) int32, 0 where count is 0
+    max: np.ndarray  # (width, n_channels) int32, 0 where count is 0
+    mean: np.ndarray  # (width, n_channels) float64, NaN where count is 0
+    count: np.ndarray  # int64 (width,): samples summarized in each pixel
+    bin_samples: int  # Samples per bin of the level used, 1 for raw samples
+
+    @property
+    def valid(self) -> np.ndarray:
+        """bool (width,), False for the pixels without samples (dropped or no data)."""
+        return self.count > 0
+
+
+def pyramid_path(recording_path: str | pathlib.Path) -> pathlib.Path:
+    """Where RecordingWriter saves the pyramid of a recording."""
+    return pathlib.Path(recording_path).with_suffix(".pyramid.npz")
+
+
+def _reduce(keys, mins, maxs, sums, counts) -> tuple[np.ndarray, ...]:
+    """Merge the rows with equal keys, the keys being sorted."""
+    if len(keys) == 0:
+        return keys, mins, maxs, sums, counts
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return (
+        keys[starts],
+        np.minimum.reduceat(mins, starts),
+        np.maximum.reduceat(maxs, starts),
+        np.add.reduceat(sums, starts),
+        np.add.reduceat(counts, starts),
+    )
+
+
+class _Level:
+    """The bins of one level, sorted by index (SSN // bin_samples), in arrays that
+    grow by doubling.
+
+    With max_live_bins, once there are more bins in the arrays the older half is
+    appended to a temporary file as records, and read back from it by range(). Bins
+    added before the last spilled one bring the spilled bins from there on back.
+    """
+
+    def __init__(
+        self,
+        bin_samples: int,
+        n_channels: int,
+        capacity: int = 64,
+        max_live_bins: Optional[int] = None,
+    ):
+        self.bin_samples = bin_samples
+        self.max_live_bins = max_live_bins
+        self.n = 0  # Bins in the arrays, after the n_spilled ones
+        self.index = np.zeros(capacity, np.int64)
+        self.min = np.zeros((capacity, n_channels), np.int32)
+        self.max = np.zeros((capacity, n_channels), np.int32)
+        self.sum = np.zeros((capacity, n_channels), np.float64)
+        self.count = np.zeros(capacity, np.int64)
+
+        self.n_spilled = 0
+        self._record = np.dtype(
+            [
+                (name, getattr(self, name).dtype, getattr(self, name).shape[1:])
+                for name in _FIELDS
+            ]
+        )
+        self._spill = None  # Temporary file of the spilled bins, created when needed
+        self._last_spilled = 0  # Index of the last spilled bin, if any
+
+    def __len__(self) -> int:
+        return self.n_spilled + self.n
+
+    def arrays(self, lo: int = 0, hi: Optional[int] = None) -> tuple[np.ndarray, ...]:
+        """Views of the bins lo:hi of the arrays, not counting the spilled ones."""
+        hi = self.n if hi is None else hi
+        return tuple(getattr(self, name)[lo:hi] for name in _FIELDS)
+
+    def bins(self, lo: int = 0, hi: Optional[int] = None) -> tuple[np.ndarray, ...]:
+        """Copies of the bins lo:hi, counting the spilled ones."""
+        hi = len(self) if hi is None else hi
+        live = self.arrays(max(lo - self.n_spilled, 0), max(hi - self.n_spilled, 0))
+        if lo >= self.n_spilled:
+            return tuple(a.copy() for a in live)
+        records = self._spilled()[lo : min(hi, self.n_spilled)]
+        return tuple(
+            np.concatenate((records[name], a)) for name, a in zip(_FIELDS, live)
+        )
+
+    def searchsorted(self, index: int, side: str = "left") -> int:
+        """Position of a bin index among all the bins, like np.searchsorted."""
+        if (
+            self.n_spilled == 0
+            or index > self._last_spilled
+            or (side == "right" and index == self._last_spilled)
+        ):
+            live = self.index[: self.n]
+            return self.n_spilled + int(np.searchsorted(live, index, side))
+        return int(np.searchsorted(self._spilled()["index"], index, side))
+
+    def add(self, *bins: np.ndarray):
+        """Merge sorted bins into the level. Normally they start at or after the last
+        bin, so only that one is merged again."""
+        if self.n_spilled and bins[0][0] <= self._last_spilled:
+            self._unspill(self.searchsorted(bins[0][0]))
+        pos = int(np.searchsorted(self.index[: self.n], bins[0][0]))
+        if pos < self.n:
+            merged = [np.concatenate(ab) for ab in zip(self.arrays(pos), bins)]
+            order = np.argsort(merged[0], kind="stable")
+            bins = _reduce(*(a[order] for a in merged))
+
+        n = pos + len(bins[0])
+        if n > len(self.index):
+            capacity = max(n, 2 * len(self.index))
+            for name in _FIELDS:
+                old = getattr(self, name)
+                new = np.zeros((capacity,) + old.shape[1:], old.dtype)
+                new[: self.n] = old[: self.n]
+                setattr(self, name, new)
+        for name, values in zip(_FIELDS, bins):
+            getattr(self, name)[pos:n] = values
+        self.n = n
+        if self.max_live_bins is not None and self.n > self.max_live_bins:
+            self._spill_oldest(self.n - self.max_live_bins // 2)
+
+    def range(self, start_ssn: int, end_ssn: int) -> tuple[np.ndarray, ...]:
+        """Copies of the bins overlapping start_ssn <= ssn < end_ssn."""
+        lo = self.searchsorted(start_ssn // self.bin_samples)
+        hi = self.searchsorted((end_ssn - 1) // self.bin_samples, side="right")
+        return self.bins(lo, hi)
+
+    def _spilled(self) -> np.ndarray:
+        """The spilled bins, as a read only memory map of records."""
+        return np.memmap(self._spill, self._record, "r", shape=(self.n_spilled,))
+
+    def _spill_oldest(self, k: int):
+        """Move the first k bins of the arrays to the end of the spill file."""
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+            weakref.finalize(self, self._spill.close)
+        records = np.empty(k, self._record)
+        for name, values in zip(_FIELDS, self.arrays(0, k)):
+            records[name] = values
+        self._spill.seek(self.n_spilled * self._record.itemsize)
+        self._spill.write(records.tobytes())
+        self._spill.flush()
+        self.n_spilled += k
+        self._last_spilled = int(self.index[k - 1])
+        for name in _FIELDS:
+            values = getattr(self, name)
+            values[: self.n - k] = values[k : self.n]
+        self.n -= k
+
+    def _unspill(self, pos: int):
+        """Move the spilled bins from pos on back to the start of the arrays."""
+        records = self._spilled()[pos:].copy()
+        if pos:
+            self._last_spilled = int(self._spilled()["index"][pos - 1])
+        self.n_spilled = pos
+        self._spill.truncate(pos * self._record.itemsize)
+        for name in _FIELDS:
+            values = np.concatenate((records[name], getattr(self, name)[: self.n]))
+            setattr(self, name, values)
+        self.n += len(records)
+
+
+class Pyramid:
+    """Min/max/mean pyramid of a stream of samples, built incrementally with add()."""
+
+    def __init__(
+        self,
+        n_channels: int = 4,
+        base_samples: int = 256,
+        factor: int = 4,
+        n_levels: int = 8,
+        max_live_bins: Optional[int] = None,
+    ):
+        """
+        base_samples:   Samples per bin of level 0, the finest level. A level 0 bin
+                        takes 80 bytes, so about 36 MB per hour at 32 kHz.
+        factor:         Bins of a level merged into one bin of the next level.
+        n_levels:       Number of levels; the coarsest bins are
+                        base_samples * factor**(n_levels - 1) samples long.
+        max_live_bins:  Bins of each level kept in memory, the older ones are spilled
+                        to a temporary file. None keeps every bin in memory.
+        """
+        assert base_samples >= 1 and factor >= 2 and n_levels >= 1
+        self.n_channels = n_channels
+        self.base_samples = int(base_samples)
+        self.factor = int(factor)
+        self.levels = [
+            _Level(
+                self.base_samples * self.factor**i,
+                n_channels,
+                max_live_bins=max_live_bins,
+            )
+            for i in range(n_levels)
+        ]
+        self.n_samples = 0
+        self.first_ssn: Optional[int] = None
+        self.end_ssn: Optional[int] = None  # One past the last SSN added
+        # Samples can be added from a writer thread while another thread queries.
+        self._lock = threading.Lock()
+
+    def add(self, first_ssn: int, samples: np.ndarray):
+        """Add (n, n_channels) consecutive samples starting at the (unwrapped)
+        first_ssn. Batches should come in SSN order, out of order ones cost more."""
+        samples = np.asarray(samples, dtype=np.int32).reshape(-1, self.n_channels)
+        n = len(samples)
+        if n == 0:
+            return
+        ssns = np.arange(first_ssn, first_ssn + n)
+        bins = _reduce(
+            ssns // self.base_samples,
+            samples,
+            samples,
+            samples.astype(np.float64),
+            np.ones(n, np.int64),
+        )
+        with self._lock:
+            for i, level in enumerate(self.levels):
+                if i:
+                    bins = _reduce(bins[0] // self.factor, *bins[1:])
+                level.add(*bins)
+            self.n_samples += n
+            if self.first_ssn is None or first_ssn < self.first_ssn:
+                self.first_ssn = first_ssn
+            if self.end_ssn is None or first_ssn + n > self.end_ssn:
+                self.end_ssn = first_ssn + n
+
+    def query(
+        self,
+        start_ssn: int,
+        end_ssn: int,
+        width: int,
+        raw: Optional[Callable[[int, int], tuple[np.ndarray, np.ndarray]]] = None,
+    ) -> Overview:
+        """Samples start_ssn <= ssn < end_ssn summarized into width pixels.
+
+        Uses the coarsest level with at least one bin per pixel, so at most factor
+        bins are merged per pixel. A bin goes to the pixel it starts in.
+        raw:    Function (start_ssn, end_ssn) -> (ssns, samples), like
+                RecordingReader.read. If given, it is used when the range is zoomed in
+                past level 0, so each sample goes to its own pixel.
+        """
+        assert end_ssn > start_ssn and width > 0
+        span = end_ssn - start_ssn
+        level = None
+        for candidate in self.levels:
+            if candidate.bin_samples * width <= span:
+                level = candidate
+
+        if level is None and raw is not None:
+            ssns, samples = raw(start_ssn, end_ssn)
+            bin_samples = 1
+            starts = np.asarray(ssns, np.int64)
+            bins = (
+                samples,
+                samples,
+                samples.astype(np.float64),
+                np.ones(len(starts), np.int64),
+            )
+        else:
+            level = level or self.levels[0]
+            bin_samples = level.bin_samples
+            with self._lock:
+                index, *bins = level.range(start_ssn, end_ssn)
+            starts = index * bin_samples
+
+        pixels = np.clip((starts - start_ssn) * width // span, 0, width - 1)
+        pixels, mins, maxs, sums, counts = _reduce(pixels, *bins)
+
+        overview = Overview(
+            edges=start_ssn - (-np.arange(width + 1, dtype=np.int64) * span // width),
+            min=np.zeros((width, self.n_channels), np.int32),
+            max=np.zeros((width, self.n_channels), np.int32),
+            mean=np.full((width, self.n_channels), np.nan),
+            count=np.zeros(width, np.int64),
+            bin_samples=bin_samples,
+        )
+        overview.min[pixels] = mins
+        overview.max[pixels] = maxs
+        overview.mean[pixels] = sums / counts[:, np.newaxis]
+        overview.count[pixels] = counts
+        return overview
+
+    def save(self, path: str | pathlib.Path):
+        """Save to a .npz file, replacing it at once so readers never see half of it.
+        The spilled bins are read back for it, and loaded ones are all in memory."""
+        path = pathlib.Path(path)
+        arrays = {}
+        with self._lock:
+            for i, level in enumerate(self.levels):
+                for name, values in zip(_FIELDS, level.bins()):
+                    arrays[f"{name}_{i}"] = values
+            extent = [] if self.first_ssn is None else [self.first_ssn, self.end_ssn]
+            tmp_path = path.with_name(path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.savez_compressed(
+                    f,
+                    shape=[self.n_channels, self.base_samples, self.factor],
+                    n_samples=self.n_samples,
+                    extent=np.array(extent, np.int64),
+                    **arrays,
+                )
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: str | pathlib.Path) -> "Pyramid":
+        with np.load(path) as f:
+            n_channels, base_samples, factor = (int(x) for x in f["shape"])
+            n_levels = sum(1 for name in f.files if name.startswith("index_"))
+            pyramid = cls(n_channels, base_samples, factor, n_levels)
+            for i, level in enumerate(pyramid.levels):
+                for name in _FIELDS:
+                    setattr(level, name, f[f"{name}_{i}"])
+                level.n = len(level.index)
+            pyramid.n_samples = int(f["n_samples"])
+            if len(f["extent"]):
+                pyramid.first_ssn, pyramid.end_ssn = (int(x) for x in f["extent"])
+        return pyramid
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import recording
+
+    parser = argparse.ArgumentParser(
+        description="Build the min/max pyramids of recordings made without one."
+    )
+    parser.add_argument("paths", nargs="+", type=pathlib.Path)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        with recording.RecordingReader(path) as reader:
+            reader.read_pyramid().save(pyramid_path(path))
+        print("Wrote", pyramid_path(path))
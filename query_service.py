@@ -0,0 +1,475 @@
+"""Local HTTP service to query the live feed and the recordings on demand.
+
+QueryService is a feeddata sink that keeps the latest seconds of samples in a ring
+buffer, and serves them from a background thread along with the device info and
+downsampled ranges of the recordings in a directory:
+
+    GET /info                       Device info (ADCConfig...), sample rate and the
+                                    SSNs held by the ring, as JSON
+    GET /latest?seconds=S           The latest S seconds of samples, at most the ring's
+                                    (binary)
+    GET /recordings                 The recordings in recordings_dir, as JSON
+    GET /range?name=N&start=A&end=B&width=W
+                                    Samples A <= SSN < B of recording N summarized into
+                                    W pixels (at most MAX_WIDTH), see
+                                    RecordingReader.overview() (binary)
+
+Recordings stay open between requests, and a recording still being written is only
+indexed as far as it grew since. Its pyramid is the writer's when the writer runs in
+this process (e.g. `stream.py --record --serve`), otherwise only the new chunks are added
+to it, so a /range request costs about the same at any length of capture.
+
+Binary responses are a small header followed by little-endian arrays, see
+unpack_samples() and unpack_overview(). They are gzip compressed when the request
+accepts it (and compress is on). The server speaks HTTP/1.1 with keep-alive, so a
+client can make all its requests over one connection, which Client does.
+
+Dashboards and scripts can then pull data without a BLE session of their own:
+
+    python stream.py --record --serve '{"port": 8200}'
+    python query_service.py --recordings-dir ./data   # Recordings only, no device
+"""
+
+import dataclasses
+import json
+import math
+import pathlib
+import struct
+import threading
+import urllib.parse
+from typing import TYPE_CHECKING, Optional
+
+import dynamite_sampler_bleak_util as dsbu
+
+if TYPE_CHECKING:
+    # Imported where they are used, so that numpy is only needed when serving.
+    import http.server
+
+    import numpy as np
+
+    import pyramid
+    import recording
+
+# magic, n_samples, n_channels; then int64 ssns[n], int32 samples[n, n_channels]
+_SAMPLES_HEADER = struct.Struct("<4sIH")
+_SAMPLES_MAGIC = b"DSMP"
+# magic, width, n_channels, bin_samples; then int64 edges[width + 1], int64 count[width],
+# int32 min[width, n_channels], int32 max[width, n_channels], float64 mean[...]
+_OVERVIEW_HEADER = struct.Struct("<4sIHI")
+_OVERVIEW_MAGIC = b"DOVW"
+
+BINARY_CONTENT_TYPE = "application/octet-stream"
+MAX_WIDTH = 10000  # Pixels of a /range response, wider requests get this many
+
+
+def pack_samples(ssns, samples) -> bytes:
+    """Binary /latest response of (n,) SSNs and (n, n_channels) samples."""
+    n, n_channels = samples.shape
+    return b"".join(
+        (
+            _SAMPLES_HEADER.pack(_SAMPLES_MAGIC, n, n_channels),
+            ssns.astype("<i8").tobytes(),
+            samples.astype("<i4").tobytes(),
+        )
+    )
+
+
+def unpack_samples(b: bytes) -> tuple["np.ndarray", "np.ndarray"]:
+    """(ssns, samples) of a /latest response."""
+    import numpy as np
+
+    magic, n, n_channels = _SAMPLES_HEADER.unpack_from(b)
+    assert magic == _SAMPLES_MAGIC, "Not a samples response"
+    offset = _SAMPLES_HEADER.size
+    ssns = np.frombuffer(b, "<i8", n, offset)
+    samples = np.frombuffer(b, "<i4", n * n_channels, offset + 8 * n)
+    return ssns, samples.reshape(n, n_channels)
+
+
+def pack_overview(overview) -> bytes:
+    """Binary /range response of a pyramid.Overview."""
+    width, n_channels = overview.min.shape
+    return b"".join(
+        (
+            _OVERVIEW_HEADER.pack(
+                _OVERVIEW_MAGIC, width, n_channels, overview.bin_samples
+            ),
+            overview.edges.astype("<i8").tobytes(),
+            overview.count.astype("<i8").tobytes(),
+            overview.min.astype("<i4").tobytes(),
+            overview.max.astype("<i4").tobytes(),
+            overview.mean.astype("<f8").tobytes(),
+        )
+    )
+
+
+def unpack_overview(b: bytes) -> "pyramid.Overview":
+    """pyramid.Overview of a /range response."""
+    import numpy as np
+
+    import pyramid
+
+    magic, width, n_channels, bin_samples = _OVERVIEW_HEADER.unpack_from(b)
+    assert magic == _OVERVIEW_MAGIC, "Not an overview response"
+    offset = _OVERVIEW_HEADER.size
+    arrays = []
+    for dtype, count in (
+        ("<i8", width + 1),
+        ("<i8", width),
+        ("<i4", width * n_channels),
+        ("<i4", width * n_channels),
+        ("<f8", width * n_channels),
+    ):
+        arrays.append(np.frombuffer(b, dtype, count, offset))
+        offset += arrays[-1].nbytes
+    edges, count, mins, maxs, mean = arrays
+    shape = (width, n_channels)
+    return pyramid.Overview(
+        edges,
+        mins.reshape(shape),
+        maxs.reshape(shape),
+        mean.reshape(shape),
+        count,
+        bin_samples,
+    )
+
+
+def _to_json(obj) -> bytes:
+    def default(o):
+        if dataclasses.is_dataclass(o):
+            return dataclasses.asdict(o)
+        return str(o)
+
+    return json.dumps(obj, default=default).encode()
+
+
+class SampleRing:
+    """The latest capacity samples and their SSNs, in preallocated arrays. Appended to
+    by the feed, read from the server's threads."""
+
+    def __init__(self, capacity: int, n_channels: int = 4):
+        # Import inside the class so that numpy is only needed when this is used.
+        import numpy as np
+
+        self.np = np
+        self.capacity = max(1, int(capacity))
+        self.ssns = np.zeros(self.capacity, np.int64)
+        self.samples = np.zeros((self.capacity, n_channels), np.int32)
+        self.total = 0  # Samples appended in total
+        self.total_missing = 0
+        self._lock = threading.Lock()
+
+    def append(self, first_ssn: int, samples, missing: int = 0):
+        n = len(samples)
+        if n > self.capacity:
+            first_ssn += n - self.capacity
+            samples = samples[-self.capacity :]
+            n = self.capacity
+        with self._lock:
+            pos = self.total % self.capacity
+            first = min(n, self.capacity - pos)  # Up to the end of the arrays
+            ssns = self.np.arange(first_ssn, first_ssn + n)
+            self.ssns[pos : pos + first] = ssns[:first]
+            self.samples[pos : pos + first] = samples[:first]
+            self.ssns[: n - first] = ssns[first:]
+            self.samples[: n - first] = samples[first:]
+            self.total += n
+            self.total_missing += missing
+
+    def latest(self, n: int) -> tuple["np.ndarray", "np.ndarray"]:
+        """Copies of the last n samples (fewer if the ring holds less), oldest first."""
+        with self._lock:
+            n = max(0, min(n, self.total, self.capacity))
+            idx = self.np.arange(self.total - n, self.total) % self.capacity
+            return self.ssns[idx], self.samples[idx]
+
+    def extent(self) -> Optional[tuple[int, int]]:
+        """First SSN held and one past the last, None when empty."""
+        with self._lock:
+            if self.total == 0:
+                return None
+            first = self.total - min(self.total, self.capacity)
+            last = (self.total - 1) % self.capacity
+            return int(self.ssns[first % self.capacity]), int(self.ssns[last]) + 1
+
+
+class QueryService(dsbu.NotifyCallbackSamples):
+    """Serves the latest samples, the device info and the recordings over HTTP, see
+    the module docstring."""
+
+    def __init__(
+        self,
+        port: int = 8200,
+        host: str = "127.0.0.1",
+        seconds: float = 10.0,
+        recordings_dir: str = "./data",
+        compress: bool = True,
+    ):
+        """
+        port, host:     Where to serve, localhost by default. Port 0 picks a free one.
+        seconds:        [Seconds] Length of the live ring buffer.
+        recordings_dir: Directory of the .dynrec recordings /range can read.
+        compress:       Gzip responses for clients that accept it.
+        """
+        # Import inside the class so that numpy is only needed when this is used.
+        import recording
+
+        self.recording = recording
+        self.port = int(port)
+        self.host = host
+        self.seconds = float(seconds)
+        self.recordings_dir = pathlib.Path(recordings_dir).resolve()
+        self.compress = compress
+        self.device_dict: dict = {}
+        self.sample_rate = 32000
+        self.ring: Optional[SampleRing] = None
+        self.server = None
+        # Open readers by path, kept across requests and refreshed with the chunks
+        # written since. A reader seeks its file, so they are used one request at a
+        # time.
+        self._readers: dict[pathlib.Path, "recording.RecordingReader"] = {}
+        self._readers_lock = threading.Lock()
+
+    def setup(self, device_dict):
+        self.device_dict = device_dict
+        if device_dict.get("ADCConfig"):
+            self.sample_rate = device_dict["ADCConfig"].sample_rate
+        self.ring = SampleRing(self.seconds * self.sample_rate)
+        self.server = serve_queries(self, self.port, self.host)
+        self.port = self.server.server_address[1]
+        print(f"Serving queries on http://{self.host}:{self.port}/")
+
+    def callback_block(self, header, block, missing):
+        self.ring.append(header.sample_sequence_number, block.samples, missing)
+
+    def cleanup(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        with self._readers_lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+
+    # The requests, answered from the server's threads once set up.
+    def info(self) -> dict:
+        return dict(
+            device_info=self.device_dict,
+            sample_rate=self.sample_rate,
+            ring_seconds=self.seconds,
+            ring_ssns=self.ring.extent(),
+            total_samples=self.ring.total,
+            total_missing=self.ring.total_missing,
+        )
+
+    def latest(self, seconds: float) -> bytes:
+        if not (math.isfinite(seconds) and seconds >= 0):
+            raise ValueError(f"seconds must be finite and >= 0, got {seconds}")
+        seconds = min(seconds, self.seconds)
+        ssns, samples = self.ring.latest(int(seconds * self.sample_rate))
+        return pack_samples(ssns, samples)
+
+    def _reader(self, path: pathlib.Path) -> "recording.RecordingReader":
+        """The cached reader of path, with the chunks written since the last request
+        indexed. Call with _readers_lock held."""
+        reader = self._readers.get(path)
+        if reader is not None and path.stat().st_size < reader.indexed_size:
+            reader.close()  # Replaced by a new recording
+            reader = None
+        if reader is None:
+            reader = self._readers[path] = self.recording.RecordingReader(path)
+        else:
+            reader.refresh()
+        return reader
+
+    def recordings(self) -> list[dict]:
+        found = []
+        paths = sorted(self.recordings_dir.rglob("*.dynrec"))
+        with self._readers_lock:
+            for gone in self._readers.keys() - set(paths):
+                self._readers.pop(gone).close()
+            for path in paths:
+                reader = self._reader(path)
+                found.append(
+                    dict(
+                        name=path.relative_to(self.recordings_dir).as_posix(),
+                        sample_rate=reader.sample_rate,
+                        n_samples=reader.n_samples,
+                        first_ssn=reader.chunks[0].first_ssn if reader.chunks else None,
+                    )
+                )
+        return found
+
+    def overview(
+        self,
+        name: str,
+        start_ssn: Optional[int],
+        end_ssn: Optional[int],
+        width: int,
+    ) -> bytes:
+        path = (self.recordings_dir / name).resolve()
+        if (
+            not path.is_relative_to(self.recordings_dir)
+            or path.suffix != ".dynrec"
+            or not path.is_file()
+        ):
+            raise FileNotFoundError(f"No recording {name!r}")
+        if width < 1:
+            raise ValueError(f"width must be at least 1, got {width}")
+        width = min(width, MAX_WIDTH)
+        with self._readers_lock:
+            overview = self._reader(path).overview(start_ssn, end_ssn, width)
+        return pack_overview(overview)
+
+
+def serve_queries(
+    service: QueryService, port: int, host: str = "127.0.0.1"
+) -> "http.server.ThreadingHTTPServer":
+    """Serve the queries of service from a background thread. Call .shutdown() on the
+    returned server to stop it."""
+    # Imported here, it's slow to import and only needed when serving.
+    import gzip
+    import http.server
+
+    def int_param(params: dict, name: str, default=None):
+        values = params.get(name)
+        return int(values[0]) if values else default
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        # Keep-alive, so clients can reuse their connection.
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            params = urllib.parse.parse_qs(url.query)
+            try:
+                if url.path == "/info":
+                    body, content_type = _to_json(service.info()), "application/json"
+                elif url.path == "/latest":
+                    seconds = float(params.get("seconds", ["1"])[0])
+                    body, content_type = service.latest(seconds), BINARY_CONTENT_TYPE
+                elif url.path == "/recordings":
+                    body = _to_json(service.recordings())
+                    content_type = "application/json"
+                elif url.path == "/range":
+                    body = service.overview(
+                        params["name"][0],
+                        int_param(params, "start"),
+                        int_param(params, "end"),
+                        int_param(params, "width", 1000),
+                    )
+                    content_type = BINARY_CONTENT_TYPE
+                else:
+                    self.send_error(404, "Unknown endpoint")
+                    return
+            except FileNotFoundError as e:
+                self.send_error(404, str(e))
+                return
+            except (KeyError, ValueError, OverflowError, AssertionError) as e:
+                self.send_error(400, f"Bad query: {e!r}")
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            accept = self.headers.get("Accept-Encoding", "")
+            if service.compress and "gzip" in accept:
+                body = gzip.compress(body, compresslevel=1)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Don't print every request over the stream output
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Client:
+    """Client of a QueryService. All requests go over one kept-alive connection."""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8200,
+        compress: bool = True,
+        timeout: float = 10.0,
+    ):
+        import http.client
+
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.compress = compress
+
+    def get(self, path: str, **params) -> bytes:
+        """Body of a GET request, decompressed. Raises RuntimeError on an error
+        status."""
+        query = urllib.parse.urlencode(
+            {k: v for k, v in params.items() if v is not None}
+        )
+        headers = {"Accept-Encoding": "gzip"} if self.compress else {}
+        self.connection.request("GET", f"{path}?{query}", headers=headers)
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{path}: {response.status} {response.reason}")
+        if response.getheader("Content-Encoding") == "gzip":
+            import gzip
+
+            body = gzip.decompress(body)
+        return body
+
+    def info(self) -> dict:
+        return json.loads(self.get("/info"))
+
+    def latest(self, seconds: float = 1.0) -> tuple["np.ndarray", "np.ndarray"]:
+        """(ssns, samples) of the latest seconds of the feed."""
+        return unpack_samples(self.get("/latest", seconds=seconds))
+
+    def recordings(self) -> list[dict]:
+        return json.loads(self.get("/recordings"))
+
+    def overview(
+        self,
+        name: str,
+        start_ssn: Optional[int] = None,
+        end_ssn: Optional[int] = None,
+        width: int = 1000,
+    ) -> "pyramid.Overview":
+        """Range of a recording summarized into width pixels."""
+        return unpack_overview(
+            self.get("/range", name=name, start=start_ssn, end=end_ssn, width=width)
+        )
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Serve the recordings of a directory, without a device."
+    )
+    parser.add_argument("--port", default=8200, type=int)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--recordings-dir", default="./data")
+    args = parser.parse_args()
+
+    service = QueryService(args.port, args.host, recordings_dir=args.recordings_dir)
+    service.setup({})
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        service.cleanup()
@@ -46,9 +46,10 @@ while(1){
             channelDatas[i].push(val);
         }
     
-        // Trim - keep only the latest data, and remove old data
-        while(channelDatas[i].length > maxLenData){
-            channelDatas[i].shift();
+        // Trim - keep only the latest data, and remove old data in one go (shift()
+        // moves every value, once per value removed)
+        if(channelDatas[i].length > maxLenData){
+            channelDatas[i].splice(0, channelDatas[i].length - maxLenData);
         }
     
         scopes[i].setData(channelDatas[i], 1000);
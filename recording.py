@@ -0,0 +1,457 @@
+"""Compressed binary recordings of the ADC feed.
+
+A recording is a file header followed by independently decodable chunks, each a run of
+consecutive samples (a dropped sample always starts a new chunk):
+
+    file header:  magic "DYNREC", version, n_channels, sample_rate, metadata (JSON)
+    chunk header: magic "CHNK", first SSN, n_samples, codec, payload length, CRC32
+    chunk payload: codec(byte planes of the 24-bit per-channel sample deltas)
+
+The encoding is tuned for 24-bit load cell data: consecutive samples differ by a small
+noise-sized amount, so the deltas mostly fit in one byte. Splitting the 3 bytes of each
+delta into planes puts the (mostly constant) high bytes next to each other, which a
+general purpose codec then squeezes well. Codecs are from the standard library.
+
+RecordingWriter compresses and writes in a background thread so that the FeedSession
+loop never waits on the codec or the disk. RecordingReader indexes the chunk headers
+when opened, so a range of samples can be read without decoding the whole file.
+
+The writer also builds a min/max/mean pyramid of the samples (see pyramid.py), saved
+next to the recording when it is closed, which RecordingReader.overview() uses to
+summarize any range of a long recording quickly.
+"""
+
+import bz2
+import dataclasses
+import json
+import lzma
+import os
+import pathlib
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, Optional
+
+import numpy as np
+
+import pyramid
+
+_FILE_MAGIC = b"DYNREC"
+_FILE_VERSION = 1
+# magic, version, n_channels, sample_rate, metadata length
+_FILE_HEADER = struct.Struct("<6sHHII")
+_CHUNK_MAGIC = b"CHNK"
+# magic, first ssn, n_samples, codec id, payload length, crc32 of the payload
+_CHUNK_HEADER = struct.Struct("<4sqIBII")
+
+_BYTES_PER_VALUE = 3
+_MASK_24 = 0xFFFFFF
+_SIGN_24 = 0x800000
+
+CODECS = {
+    "none": (0, lambda b, level: b, lambda b: b),
+    "zlib": (1, lambda b, level: zlib.compress(b, level), zlib.decompress),
+    "bz2": (2, lambda b, level: bz2.compress(b, level), bz2.decompress),
+    "lzma": (3, lambda b, level: lzma.compress(b, preset=level), lzma.decompress),
+}
+_CODEC_BY_ID = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+# Pyramid bins per level a RecordingWriter keeps in memory, about 30 s of level 0 at
+# 32 kHz, so its memory stays bounded however long the recording.
+LIVE_PYRAMID_BINS = 4096
+
+# Pyramids of the recordings being written in this process, by resolved path, so that
+# readers can use them instead of decoding the chunks written so far.
+_LIVE_PYRAMIDS: dict[pathlib.Path, pyramid.Pyramid] = {}
+
+
+def encode_samples(samples: np.ndarray) -> bytes:
+    """(n, n_channels) 24-bit samples to byte planes of the per-channel deltas."""
+    per_channel = np.ascontiguousarray(np.asarray(samples, dtype="<i4").T)
+    # Deltas wrap modulo 2**24, which the cumulative sum when decoding undoes.
+    deltas = np.diff(per_channel, axis=1, prepend=0).astype("<i4")  # (n_channels, n)
+    delta_bytes = deltas.view(np.uint8).reshape(*deltas.shape, 4)
+    planes = np.moveaxis(delta_bytes[..., :_BYTES_PER_VALUE], -1, 0)
+    return planes.tobytes()  # (3 planes, n_channels, n)
+
+
+def decode_samples(b: bytes, n_samples: int, n_channels: int) -> np.ndarray:
+    """Inverse of encode_samples, returns (n, n_channels) int32."""
+    planes = np.frombuffer(b, dtype=np.uint8).reshape(
+        _BYTES_PER_VALUE, n_channels, n_samples
+    )
+    delta_bytes = np.zeros((n_channels, n_samples, 4), dtype=np.uint8)
+    delta_bytes[..., :_BYTES_PER_VALUE] = np.moveaxis(planes, 0, -1)
+    deltas = delta_bytes.view("<i4")[..., 0]
+    values = np.cumsum(deltas, axis=1, dtype=np.int64) & _MASK_24
+    values = (values ^ _SIGN_24) - _SIGN_24  # Sign extend the 24 bits
+    return values.astype(np.int32).T
+
+
+def _to_json(metadata: dict) -> bytes:
+    def default(o):
+        if dataclasses.is_dataclass(o):
+            return dataclasses.asdict(o)
+        return str(o)
+
+    return json.dumps(metadata, default=default).encode()
+
+
+@dataclasses.dataclass
+class WriterStats:
+    """Throughput of a RecordingWriter, vs. storing the samples as plain int32."""
+
+    samples: int = 0
+    chunks: int = 0
+    raw_bytes: int = 0  # Samples as int32, the uncompressed reference
+    written_bytes: int = 0  # Chunk headers and payloads
+    encode_seconds: float = 0.0  # Time spent encoding + compressing
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.written_bytes if self.written_bytes else 0.0
+
+    @property
+    def throughput_mb_s(self) -> float:
+        """Raw MB encoded per second of background thread time."""
+        if not self.encode_seconds:
+            return 0.0
+        return self.raw_bytes / self.encode_seconds / 1e6
+
+    def add(self, other: "WriterStats"):
+        """Accumulate the stats of another writer, e.g. of the next file segment."""
+        for field in dataclasses.fields(self):
+            setattr(
+                self, field.name, getattr(self, field.name) + getattr(other, field.name)
+            )
+
+    def __str__(self):
+        return (
+            f"{self.samples} samples in {self.chunks} chunks, "
+            f"{self.raw_bytes} bytes as int32 -> {self.written_bytes} bytes "
+            f"(ratio {self.ratio:.2f}), {self.throughput_mb_s:.1f} MB/s"
+        )
+
+
+class RecordingWriter:
+    """Writes samples to a recording, compressing full chunks in a background thread."""
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        n_channels: int = 4,
+        sample_rate: int = 0,
+        metadata: Optional[dict] = None,
+        codec: str = "zlib",
+        level: int = 6,
+        chunk_samples: int = 32768,
+        background: bool = True,
+        build_pyramid: bool = True,
+    ):
+        """
+        path:           File to create, overwritten if it exists.
+        sample_rate:    [Hz] Stored in the header for readers, 0 if unknown.
+        metadata:       JSON-able dict stored in the header, e.g. the device info.
+                        Dataclasses are stored as dicts, anything else as str().
+        codec, level:   One of CODECS and its compression level.
+        chunk_samples:  Samples per chunk. Larger chunks compress slightly better, but
+                        seeking then decodes more.
+        background:     Compress and write in a background thread.
+        build_pyramid:  Build a pyramid.Pyramid of the samples as their chunks are
+                        written (self.pyramid, can be queried while writing) and save
+                        it next to the file when closed. Past LIVE_PYRAMID_BINS bins
+                        per level, the older ones are kept in a temporary file.
+        """
+        assert codec in CODECS, f"codec must be one of {list(CODECS)}"
+        self.path = pathlib.Path(path)
+        self.n_channels = n_channels
+        self.codec = codec
+        self.level = level
+        self.chunk_samples = int(chunk_samples)
+        self.stats = WriterStats()
+        self.pyramid = None
+        if build_pyramid:
+            self.pyramid = pyramid.Pyramid(n_channels, max_live_bins=LIVE_PYRAMID_BINS)
+
+        self._file = open(self.path, "wb")
+        if self.pyramid is not None:
+            _LIVE_PYRAMIDS[self.path.resolve()] = self.pyramid
+        metadata_bytes = _to_json(metadata or {})
+        self._file.write(
+            _FILE_HEADER.pack(
+                _FILE_MAGIC, _FILE_VERSION, n_channels, sample_rate, len(metadata_bytes)
+            )
+        )
+        self._file.write(metadata_bytes)
+        self._header_bytes = _FILE_HEADER.size + len(metadata_bytes)
+
+        self._pending: list[np.ndarray] = []  # Runs of the chunk being filled
+        self._pending_samples = 0
+        self._pending_ssn: Optional[int] = None  # SSN of the chunk being filled
+        self._next_ssn: Optional[int] = None
+
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None  # Raised by the background thread
+        if background:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+
+    @property
+    def size(self) -> int:
+        """Bytes written to the file so far, not counting queued chunks."""
+        return self._header_bytes + self.stats.written_bytes
+
+    @property
+    def pending_chunks(self) -> int:
+        """Chunks waiting for the background thread."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def write(self, first_ssn: int, samples: np.ndarray):
+        """Append (n, n_channels) samples starting at the (unwrapped) first_ssn. A jump
+        in the SSN closes the current chunk."""
+        samples = np.asarray(samples).reshape(-1, self.n_channels)
+        if len(samples) == 0:
+            return
+        if self._next_ssn is not None and first_ssn != self._next_ssn:
+            self.flush()
+        if self._pending_ssn is None:
+            self._pending_ssn = first_ssn
+
+        self._pending.append(samples)
+        self._pending_samples += len(samples)
+        self._next_ssn = first_ssn + len(samples)
+
+        while self._pending_samples >= self.chunk_samples:
+            run = np.concatenate(self._pending)
+            self._submit(self._pending_ssn, run[: self.chunk_samples])
+            rest = run[self.chunk_samples :]
+            self._pending = [rest] if len(rest) else []
+            self._pending_samples = len(rest)
+            self._pending_ssn += self.chunk_samples
+
+    def flush(self):
+        """Close the chunk being filled, even if it isn't full. Without the background
+        thread, the file is flushed to the OS as well."""
+        if self._pending:
+            self._submit(self._pending_ssn, np.concatenate(self._pending))
+        self._pending = []
+        self._pending_samples = 0
+        self._pending_ssn = None
+        if self._queue is None:
+            self._file.flush()
+
+    def close(self):
+        """Flush, wait for the background thread and close the file."""
+        if self._file.closed:
+            return
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+        _LIVE_PYRAMIDS.pop(self.path.resolve(), None)
+        if self._error is not None:
+            raise self._error
+        if self.pyramid is not None:
+            self.pyramid.save(pyramid.pyramid_path(self.path))
+
+    def _submit(self, first_ssn: int, samples: np.ndarray):
+        if self._error is not None:
+            raise self._error
+        if self._queue is not None:
+            self._queue.put((first_ssn, samples))
+        else:
+            self._write_chunk(first_ssn, samples)
+
+    def _write_loop(self):
+        try:
+            while (item := self._queue.get()) is not None:
+                self._write_chunk(*item)
+        except BaseException as e:
+            self._error = e
+
+    def _write_chunk(self, first_ssn: int, samples: np.ndarray):
+        t0 = time.perf_counter()
+        codec_id, compress, _ = CODECS[self.codec]
+        payload = compress(encode_samples(samples), self.level)
+        header = _CHUNK_HEADER.pack(
+            _CHUNK_MAGIC,
+            first_ssn,
+            len(samples),
+            codec_id,
+            len(payload),
+            zlib.crc32(payload),
+        )
+        self.stats.encode_seconds += time.perf_counter() - t0
+
+        self._file.write(header)
+        self._file.write(payload)
+        if self.pyramid is not None:
+            self.pyramid.add(first_ssn, samples)
+        self.stats.samples += len(samples)
+        self.stats.chunks += 1
+        self.stats.raw_bytes += samples.size * 4
+        self.stats.written_bytes += len(header) + len(payload)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@dataclasses.dataclass
+class ChunkInfo:
+    offset: int  # File offset of the payload
+    first_ssn: int
+    n_samples: int
+    codec: str
+    payload_len: int
+    crc: int
+
+
+class RecordingReader:
+    """Reads a recording. The chunk index is built from the chunk headers alone, so
+    opening is cheap, and reads only decode the chunks they need.
+
+    A chunk cut short (e.g. by a crash while recording) ends the index. refresh() picks
+    up the chunks appended since, to follow a recording while it is written.
+    """
+
+    def __init__(self, path: str | pathlib.Path):
+        self.path = pathlib.Path(path)
+        self._file = open(self.path, "rb")
+
+        header = self._file.read(_FILE_HEADER.size)
+        magic, version, self.n_channels, self.sample_rate, meta_len = (
+            _FILE_HEADER.unpack(header)
+        )
+        assert magic == _FILE_MAGIC, f"{self.path} is not a recording"
+        assert version == _FILE_VERSION, "Can't parse this version"
+        self.metadata = json.loads(self._file.read(meta_len))
+        self.chunks: list[ChunkInfo] = []
+        self.indexed_size = self._file.tell()  # Bytes of the file indexed so far
+        self.refresh()
+        self._pyramid: Optional[pyramid.Pyramid] = None
+        self._pyramid_chunks = 0  # Chunks added to _pyramid, None if a writer's
+
+    def refresh(self) -> int:
+        """Index the chunks appended to the file since it was last indexed, returns
+        how many."""
+        file_size = os.fstat(self._file.fileno()).st_size
+        offset = self.indexed_size
+        new = 0
+        while offset + _CHUNK_HEADER.size <= file_size:
+            self._file.seek(offset)
+            magic, first_ssn, n_samples, codec_id, payload_len, crc = (
+                _CHUNK_HEADER.unpack(self._file.read(_CHUNK_HEADER.size))
+            )
+            offset += _CHUNK_HEADER.size
+            if magic != _CHUNK_MAGIC or offset + payload_len > file_size:
+                break
+            codec = _CODEC_BY_ID[codec_id]
+            self.chunks.append(
+                ChunkInfo(offset, first_ssn, n_samples, codec, payload_len, crc)
+            )
+            offset += payload_len
+            self.indexed_size = offset
+            new += 1
+        return new
+
+    @property
+    def n_samples(self) -> int:
+        return sum(c.n_samples for c in self.chunks)
+
+    def read_chunk(self, i: int) -> tuple[int, np.ndarray]:
+        """Decode chunk i, returns (first ssn, (n, n_channels) int32 samples)."""
+        info = self.chunks[i]
+        self._file.seek(info.offset)
+        payload = self._file.read(info.payload_len)
+        if zlib.crc32(payload) != info.crc:
+            raise ValueError(f"Chunk {i} of {self.path} is corrupted")
+        _, _, decompress = CODECS[info.codec]
+        samples = decode_samples(decompress(payload), info.n_samples, self.n_channels)
+        return info.first_ssn, samples
+
+    def __iter__(self) -> Iterator[tuple[int, np.ndarray]]:
+        for i in range(len(self.chunks)):
+            yield self.read_chunk(i)
+
+    def read(
+        self, start_ssn: Optional[int] = None, end_ssn: Optional[int] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Samples with start_ssn <= ssn < end_ssn, as (ssns, samples). Dropped samples
+        are absent, so ssns has jumps where samples were missed."""
+        ssns = []
+        samples = []
+        for i, info in enumerate(self.chunks):
+            if end_ssn is not None and info.first_ssn >= end_ssn:
+                continue
+            if start_ssn is not None and info.first_ssn + info.n_samples <= start_ssn:
+                continue
+            first_ssn, chunk = self.read_chunk(i)
+            chunk_ssns = np.arange(first_ssn, first_ssn + len(chunk))
+            keep = np.ones(len(chunk), dtype=bool)
+            if start_ssn is not None:
+                keep &= chunk_ssns >= start_ssn
+            if end_ssn is not None:
+                keep &= chunk_ssns < end_ssn
+            ssns.append(chunk_ssns[keep])
+            samples.append(chunk[keep])
+        if not samples:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.n_channels), np.int32)
+        return np.concatenate(ssns), np.concatenate(samples)
+
+    def read_pyramid(self) -> pyramid.Pyramid:
+        """The min/max pyramid of the recording. While a RecordingWriter of this
+        process is writing it, that's the writer's. Otherwise it's loaded from the
+        file the writer saved, or built from the chunks if there is none (or it
+        doesn't match), and the chunks indexed by later refresh() calls are added."""
+        if self._pyramid is None:
+            live = _LIVE_PYRAMIDS.get(self.path.resolve())
+            path = pyramid.pyramid_path(self.path)
+            if live is not None:
+                self._pyramid, self._pyramid_chunks = live, None
+            elif path.exists():
+                self._pyramid = pyramid.Pyramid.load(path)
+                self._pyramid_chunks = len(self.chunks)
+            if self._pyramid is None or (
+                self._pyramid_chunks is not None
+                and self._pyramid.n_samples != self.n_samples
+            ):
+                self._pyramid = pyramid.Pyramid(self.n_channels)
+                self._pyramid_chunks = 0
+        if self._pyramid_chunks is not None:
+            for i in range(self._pyramid_chunks, len(self.chunks)):
+                self._pyramid.add(*self.read_chunk(i))
+            self._pyramid_chunks = len(self.chunks)
+        return self._pyramid
+
+    def overview(
+        self,
+        start_ssn: Optional[int] = None,
+        end_ssn: Optional[int] = None,
+        width: int = 1000,
+    ) -> pyramid.Overview:
+        """Samples with start_ssn <= ssn < end_ssn (the whole recording by default)
+        summarized into width pixels, see pyramid.Pyramid.query(). Ranges shorter than
+        width level 0 bins are summarized from the samples themselves."""
+        pyr = self.read_pyramid()
+        start_ssn = pyr.first_ssn if start_ssn is None else start_ssn
+        end_ssn = pyr.end_ssn if end_ssn is None else end_ssn
+        if start_ssn is None:
+            start_ssn, end_ssn = 0, 1  # Empty recording
+        return pyr.query(start_ssn, end_ssn, width, raw=self.read)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
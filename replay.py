@@ -0,0 +1,111 @@
+"""Replay a compressed recording (see recording.py) through the FeedSession pipeline,
+without a device and without importing bleak.
+
+ReplayClient stands in for a connected bleak.BleakClient: it re-packs the recorded
+samples into ADC feed notifications, so the sinks, pipeline metrics and profilers see
+exactly what they would see live, dropped samples (SSN gaps) included.
+"""
+
+import asyncio
+import pathlib
+from typing import Iterable, Optional
+
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+import recording
+
+
+def pack_feed_packet(ssn: int, samples) -> bytearray:
+    """ADC feed notification of the (n, 4) int samples, the inverse of ADCFeed.unpack."""
+    # Little-endian int32, minus the top byte of each value, is the 24-bit encoding.
+    b = samples.astype("<i4").reshape(-1, 1).view("u1")[:, :3].tobytes()
+    return bytearray((ssn % 2**16).to_bytes(2, "little") + b)
+
+
+def device_info_from_metadata(metadata: dict) -> dict:
+    """The device info a recording was made with, as FeedSession would read it."""
+    device_info = dict(metadata)
+    if isinstance(device_info.get("ADCConfig"), dict):
+        device_info["ADCConfig"] = ds.ADCConfigData(**device_info["ADCConfig"])
+    return device_info
+
+
+class ReplayClient:
+    """Minimal stand-in for a connected bleak.BleakClient that notifies the recorded
+    samples, then disconnects at the end of the recording."""
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        speed: float = 1.0,
+        samples_per_packet: int = 20,
+    ):
+        """
+        speed:              Playback speed relative to the recorded sample rate. 0
+                            replays as fast as possible.
+        samples_per_packet: Samples per notification.
+        """
+        self.reader = recording.RecordingReader(path)
+        self.speed = float(speed)
+        self.samples_per_packet = int(samples_per_packet)
+        self.is_connected = True
+        self.packets = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start_notify(self, uuid, callback):
+        self._task = asyncio.create_task(self._notify_loop(callback))
+
+    async def stop_notify(self, uuid):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _notify_loop(self, callback):
+        loop = asyncio.get_running_loop()
+        sample_rate = self.reader.sample_rate or 32000
+        t_start = loop.time()
+        first_ssn = None
+        try:
+            for chunk_ssn, samples in self.reader:
+                if first_ssn is None:
+                    first_ssn = chunk_ssn
+                for start in range(0, len(samples), self.samples_per_packet):
+                    ssn = chunk_ssn + start
+                    packet = samples[start : start + self.samples_per_packet]
+                    if self.speed > 0:
+                        t_due = (ssn - first_ssn) / sample_rate / self.speed
+                        await asyncio.sleep(t_start + t_due - loop.time())
+                    else:
+                        await asyncio.sleep(0)  # Let the pump keep up
+                    callback(None, pack_feed_packet(ssn, packet))
+                    self.packets += 1
+        finally:
+            self.is_connected = False
+            self.reader.close()
+
+
+async def replay_recording(
+    path: str | pathlib.Path,
+    callbacks_raw: Iterable[dsbu.NotifyCallbackRawData],
+    callbacks_feeddata: Iterable[dsbu.NotifyCallbackFeeddatas],
+    speed: float = 1.0,
+    metrics=None,
+    profiler=None,
+):
+    """Run the callbacks on a recording, like dsbu.dynamite_sampler_connect_notify does
+    on a device."""
+    client = ReplayClient(path, speed)
+    print("Replaying:", client.reader.path, f"({client.reader.n_samples} samples)")
+    session = dsbu.FeedSession(
+        client,
+        callbacks_raw,
+        callbacks_feeddata,
+        device_info=device_info_from_metadata(client.reader.metadata),
+        metrics=metrics,
+        profiler=profiler,
+    )
+    await session.start()
+    try:
+        await session.wait_done()  # Returns once the recording has been played
+    finally:
+        await session.stop()
+    print(f"Replay finished, {client.packets} packets")
@@ -0,0 +1,197 @@
+"""Streaming per-channel statistics of the ADC sample values over rolling windows.
+
+Every window keeps a ring buffer of its last N samples plus running sums, so a batch of
+k samples costs O(k) vectorized work no matter how long the window is. Queries are
+cheap enough to be polled at a few Hz while streaming at full rate.
+"""
+
+import dataclasses
+import math
+from typing import Iterable, Optional
+
+import numpy as np
+
+
+@dataclasses.dataclass
+class WindowStats:
+    """Statistics over one rolling window. Array fields have one entry per channel."""
+
+    window: int  # Window length in samples
+    count: int  # Samples currently in the window, less than window while warming up
+    mean: np.ndarray
+    std: np.ndarray
+    rms: np.ndarray
+    min: np.ndarray
+    max: np.ndarray
+    noise: np.ndarray  # White noise RMS, estimated from successive differences
+
+
+class _RollingWindow:
+    """Ring buffer of the last `window` rows with running sum, sum of squares and
+    (optionally) min/max.
+
+    Min/max are kept per block of ~sqrt(window) rows: a push only rescans the blocks it
+    touched, and a query reduces over the blocks. The window is rounded up to a whole
+    number of blocks.
+    """
+
+    def __init__(self, window: int, n_channels: int, extrema: bool = True):
+        assert window > 0, "window must hold at least one sample"
+        self.block = max(1, math.isqrt(window))
+        self.n_blocks = -(-window // self.block)
+        self.window = self.n_blocks * self.block
+        self.extrema = extrema
+
+        self.count = 0
+        self._pos = 0  # Next ring slot to write
+        self._ring = np.zeros((self.window, n_channels))
+        self.sum = np.zeros(n_channels)
+        self.sumsq = np.zeros(n_channels)
+        self._block_min = np.zeros((self.n_blocks, n_channels))
+        self._block_max = np.zeros((self.n_blocks, n_channels))
+
+    def push(self, x: np.ndarray):
+        k = len(x)
+        if k == 0:
+            return
+        if k >= self.window:
+            # The batch replaces the whole window.
+            self._ring[:] = x[-self.window :]
+            self._pos = 0
+            self.count = self.window
+            self._resum()
+            self._update_blocks(0, self.n_blocks)
+            return
+
+        # Unfilled slots are zero, so subtracting them is harmless while warming up.
+        first = min(k, self.window - self._pos)
+        old_a = self._ring[self._pos : self._pos + first]
+        old_b = self._ring[: k - first]
+        self.sum += x.sum(axis=0) - old_a.sum(axis=0) - old_b.sum(axis=0)
+        self.sumsq += (
+            np.square(x).sum(axis=0)
+            - np.square(old_a).sum(axis=0)
+            - np.square(old_b).sum(axis=0)
+        )
+        self._ring[self._pos : self._pos + first] = x[:first]
+        self._ring[: k - first] = x[first:]
+
+        start = self._pos
+        self._pos = (self._pos + k) % self.window
+        self.count = min(self.count + k, self.window)
+
+        if start + k >= self.window:
+            # Wrapped: recompute the sums exactly so float error can't accumulate.
+            # This is O(window) once per window, so amortized O(1) per sample.
+            self._resum()
+            self._update_blocks(start // self.block, self.n_blocks)
+            self._update_blocks(0, -(-self._pos // self.block))
+        else:
+            self._update_blocks(start // self.block, -(-(start + k) // self.block))
+
+    def _resum(self):
+        self.sum = self._ring.sum(axis=0)
+        self.sumsq = np.square(self._ring).sum(axis=0)
+
+    def _update_blocks(self, b0: int, b1: int):
+        if not self.extrema or b0 >= b1:
+            return
+        blocks = self._ring.reshape(self.n_blocks, self.block, -1)[b0:b1]
+        self._block_min[b0:b1] = blocks.min(axis=1)
+        self._block_max[b0:b1] = blocks.max(axis=1)
+
+    def minmax(self) -> tuple[np.ndarray, np.ndarray]:
+        if self.count < self.window:
+            # Warming up: slots past count are not samples yet.
+            filled = self._ring[: self.count]
+            return filled.min(axis=0), filled.max(axis=0)
+        return self._block_min.min(axis=0), self._block_max.max(axis=0)
+
+
+class RollingStats:
+    """Per-channel rolling mean, std, RMS, min/max and noise floor over one or more
+    windows (in samples).
+
+    Values are stored relative to the first sample seen, so the large DC offset of a
+    loaded cell doesn't eat into the float precision of the variance.
+    """
+
+    def __init__(self, windows: Iterable[int] = (1024,), n_channels: int = 4):
+        self.n_channels = n_channels
+        self.windows = [int(w) for w in windows]
+        assert self.windows, "At least one window is needed"
+        self._values = {w: _RollingWindow(w, n_channels) for w in self.windows}
+        self._abs_diffs = {
+            w: _RollingWindow(w, n_channels, extrema=False) for w in self.windows
+        }
+        self._offset: Optional[np.ndarray] = None
+        # Last sample, to take differences across batches
+        self._last: Optional[np.ndarray] = None
+
+        self.total_samples = 0
+        self.total_missing = 0
+
+    def update(self, samples: np.ndarray, missing: int = 0):
+        """Add a batch of samples, shaped (n, n_channels).
+        missing: samples dropped right before this batch. Differences are not taken
+        across a gap, so drops don't show up as noise."""
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.n_channels)
+        self.total_missing += missing
+        if len(samples) == 0:
+            return
+        self.total_samples += len(samples)
+
+        if self._offset is None:
+            self._offset = samples[0].copy()
+        x = samples - self._offset
+
+        if self._last is not None and missing == 0:
+            diffs = np.abs(np.diff(x, axis=0, prepend=self._last[np.newaxis]))
+        else:
+            diffs = np.abs(np.diff(x, axis=0))
+        self._last = x[-1].copy()
+
+        for w in self.windows:
+            self._values[w].push(x)
+            self._abs_diffs[w].push(diffs)
+
+    def stats(self, window: Optional[int] = None) -> Optional[WindowStats]:
+        """Statistics over the given window (defaults to the first one). Returns None
+        before any samples have arrived."""
+        if window is None:
+            window = self.windows[0]
+        values = self._values[window]
+        n = values.count
+        if n == 0:
+            return None
+
+        offset = self._offset
+        mean_rel = values.sum / n
+        var = np.maximum(values.sumsq / n - np.square(mean_rel), 0.0)
+        mean = mean_rel + offset
+        # sum((x_rel + offset)^2) expanded, so RMS is of the actual readings.
+        meansq = values.sumsq / n + 2 * offset * mean_rel + np.square(offset)
+        vmin, vmax = values.minmax()
+
+        diffs = self._abs_diffs[window]
+        if diffs.count:
+            # For white noise of std s, E|x[n] - x[n-1]| = 2s / sqrt(pi). Slow signal
+            # changes (loading the cell) barely move this, unlike the std.
+            noise = diffs.sum / diffs.count * math.sqrt(math.pi) / 2
+        else:
+            noise = np.full(self.n_channels, np.nan)
+
+        return WindowStats(
+            window=values.window,
+            count=n,
+            mean=mean,
+            std=np.sqrt(var),
+            rms=np.sqrt(np.maximum(meansq, 0.0)),
+            min=vmin + offset,
+            max=vmax + offset,
+            noise=noise,
+        )
+
+    def snapshot(self) -> dict[int, Optional[WindowStats]]:
+        """Statistics for every window, keyed by the requested window length."""
+        return {w: self.stats(w) for w in self.windows}
@@ -0,0 +1,179 @@
+"""Background writing with size/time based file rotation for the file sinks.
+
+RotatingWriter takes batches from the FeedSession loop through a queue; a writer thread
+writes them to the current segment file, flushes it at least every flush_interval
+seconds (so a crash loses at most that much), and starts a new segment once the current
+one passes max_bytes or max_seconds.
+
+With rotation enabled, segments are named <stem>_0000<suffix>, <stem>_0001<suffix>...
+next to a <stem>.manifest.jsonl sidecar, which gets one JSON line per closed segment
+with its SSN range, so a day long capture can be split up and read in parallel.
+"""
+
+import datetime
+import json
+import pathlib
+import queue
+import threading
+import time
+from typing import Any, Optional
+
+
+class SegmentFormat:
+    """Abstract file format of a rotating sink. All methods are called from the writer
+    thread."""
+
+    def open(self, path: pathlib.Path):
+        """Start a new segment file, e.g. writing its header."""
+        pass
+
+    def write(self, first_ssn: int, batch: Any):
+        pass
+
+    def flush(self):
+        """Push everything written so far to the OS."""
+        pass
+
+    def close(self):
+        pass
+
+    def size(self) -> int:
+        """Bytes written to the current segment."""
+        return 0
+
+
+class RotatingWriter:
+    """Writes batches in a background thread, rotating segments by size or duration."""
+
+    def __init__(
+        self,
+        path: str | pathlib.Path,
+        segment_format: SegmentFormat,
+        max_bytes: Optional[int] = None,
+        max_seconds: Optional[float] = None,
+        flush_interval: float = 1.0,
+    ):
+        """
+        path:           File path; with rotation it only gives the stem and suffix of the
+                        segment names.
+        max_bytes:      Start a new segment once one reaches this size.
+        max_seconds:    [Seconds] Start a new segment once one is open this long.
+        flush_interval: [Seconds] The maximum time written data stays buffered.
+        """
+        self.path = pathlib.Path(path)
+        self.format = segment_format
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.flush_interval = float(flush_interval)
+        self.rotating = max_bytes is not None or max_seconds is not None
+        self.manifest_path = self.path.with_name(f"{self.path.stem}.manifest.jsonl")
+
+        self.segments: list[dict] = []  # Manifest entries of the closed segments
+        self._segment: Optional[dict] = None  # Manifest entry of the open segment
+        self._segment_opened = 0.0
+
+        self._queue: queue.Queue = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self) -> int:
+        """Batches waiting for the writer thread."""
+        return self._queue.qsize()
+
+    def submit(self, first_ssn: int, batch: Any, n_samples: int, missing: int = 0):
+        """Queue a batch of n_samples samples starting at first_ssn for writing."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put((first_ssn, batch, n_samples, missing))
+
+    def close(self):
+        """Write out everything queued, close the last segment and wait for the thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _write_loop(self):
+        try:
+            next_flush = time.monotonic() + self.flush_interval
+            while True:
+                timeout = max(0.0, next_flush - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if item:
+                    self._write(*item)
+                if time.monotonic() >= next_flush:
+                    if self._segment is not None:
+                        self.format.flush()
+                    next_flush = time.monotonic() + self.flush_interval
+            self._close_segment()
+        except BaseException as e:
+            self._error = e
+
+    def _write(self, first_ssn: int, batch: Any, n_samples: int, missing: int):
+        if self._segment is not None and self._needs_rotation():
+            self._close_segment()
+        if self._segment is None:
+            self._open_segment(first_ssn)
+
+        self.format.write(first_ssn, batch)
+        segment = self._segment
+        if segment["first_ssn"] is None:
+            segment["first_ssn"] = first_ssn
+        else:
+            segment["missing"] += missing
+        segment["end_ssn"] = first_ssn + n_samples
+        segment["n_samples"] += n_samples
+
+    def _needs_rotation(self) -> bool:
+        if self.max_bytes is not None and self.format.size() >= self.max_bytes:
+            return True
+        if self.max_seconds is not None:
+            return time.monotonic() - self._segment_opened >= self.max_seconds
+        return False
+
+    def _open_segment(self, first_ssn: int):
+        if self.rotating:
+            index = len(self.segments)
+            path = self.path.with_name(f"{self.path.stem}_{index:04}{self.path.suffix}")
+        else:
+            path = self.path
+        self.format.open(path)
+        self._segment_opened = time.monotonic()
+        self._segment = {
+            "path": path.name,
+            "first_ssn": None,
+            "end_ssn": None,  # Exclusive
+            "n_samples": 0,
+            "missing": 0,  # Samples dropped inside the segment
+            "start": datetime.datetime.now().isoformat(),
+        }
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        segment = self._segment
+        segment["bytes"] = self.format.size()
+        self.format.close()
+        segment["end"] = datetime.datetime.now().isoformat()
+        self.segments.append(segment)
+        self._segment = None
+        if self.rotating:
+            with open(self.manifest_path, "a") as f:
+                print(json.dumps(segment), file=f)
+
+
+def read_manifest(path: str | pathlib.Path) -> list[dict]:
+    """Manifest entries of a rotated capture, given the manifest or the capture path."""
+    path = pathlib.Path(path)
+    if not path.name.endswith(".manifest.jsonl"):
+        path = path.with_name(f"{path.stem}.manifest.jsonl")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
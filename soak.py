@@ -0,0 +1,553 @@
+"""Soak test: run a FeedSession against a simulated high rate device for a long time and
+check that memory, queue depth and the per packet cost stay flat.
+
+Unbounded growth (the notification queue, deques, file buffers) or a per packet cost
+creeping up only shows after hours of streaming. run_soak() streams for duration_s from
+a SimulatedDevice, which notifies synthetic samples at the real rate in connection event
+bursts, and samples every sample_interval_s:
+- the process RSS, and the memory traced by tracemalloc,
+- the notification queue depth (the largest since the previous sample),
+- the mean time per packet of each pipeline stage (see pipeline_metrics.py).
+
+After warmup_s the run is split in quarters, and the first and last ones are compared:
+RSS and traced memory growth, latency drift (last / first mean time of each stage but
+the queue wait, the median over the sample intervals of a quarter so a busy moment of
+the machine doesn't count) and the largest queue depth are checked against Thresholds.
+The report is a compact JSON dict with the summary, the allocations that grew the most,
+a downsampled timeline and the git version, to compare runs between versions (see
+compare_reports()).
+
+`python soak.py --duration 3600 --report soak.json` soaks the sinks of a pipeline config
+(--pipeline, see pipeline.py), by default a rotated recording in a temporary directory,
+and exits with status 1 when a threshold is passed.
+"""
+
+import asyncio
+import dataclasses
+import json
+import os
+import pathlib
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Iterable, Optional
+
+import numpy as np
+
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+import pipeline_metrics
+import replay
+
+TIMELINE_ROWS = 120  # Timeline rows kept in the report
+TOP_ALLOCATIONS = 10
+
+
+@dataclasses.dataclass
+class Thresholds:
+    """Limits of a passing soak, comparing the last quarter of the run (after warmup)
+    to the first one."""
+
+    max_rss_growth_mb: float = 20.0
+    max_traced_growth_mb: float = 10.0
+    max_queue_depth: int = 1600  # 1 s of notifications at 32 kHz
+    max_latency_drift: float = 1.5  # Last / first mean time of a stage per interval
+    latency_floor_us: float = 5.0  # Smaller increases don't count as drift
+
+
+class SimulatedDevice:
+    """Stand-in for a connected bleak.BleakClient notifying synthetic ADC feed packets
+    at sample_rate, samples_per_packet at a time, in one burst per connection
+    interval."""
+
+    def __init__(
+        self,
+        sample_rate: int = 32000,
+        samples_per_packet: int = 20,
+        interval_s: float = 0.0075,
+        drop_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        """
+        interval_s:     [Seconds] BLE connection interval, the packets due are sent
+                        together every interval.
+        drop_rate:      Fraction of the packets dropped, to exercise the missed sample
+                        handling.
+        """
+        self.sample_rate = int(sample_rate)
+        self.samples_per_packet = int(samples_per_packet)
+        self.interval_s = float(interval_s)
+        self.drop_rate = float(drop_rate)
+        self.random = random.Random(seed)
+        self.is_connected = True
+        self.packets = 0
+        self.dropped = 0
+        self._task: Optional[asyncio.Task] = None
+
+        # One second of load cell like samples, packed once and sent in a loop.
+        rng = np.random.default_rng(seed)
+        n = self.sample_rate - self.sample_rate % self.samples_per_packet
+        t = np.arange(n) / self.sample_rate
+        signal = 20_000 * np.sin(2 * np.pi * t)[:, np.newaxis] * [1, 0, 0.5, 0]
+        noise = rng.normal(0, 20, (n, 4))
+        samples = np.rint(signal + noise).astype(np.int32)
+        self._payloads = [
+            bytes(replay.pack_feed_packet(0, samples[i : i + self.samples_per_packet]))
+            for i in range(0, n, self.samples_per_packet)
+        ]
+
+    @property
+    def device_info(self) -> dict:
+        """Device info to give the FeedSession, as read from a device."""
+        return {
+            "FirmwareRevision": "simulated",
+            "ManufacturerName": "soak.py",
+            "TxPowerLevel": 0,
+            "ADCConfig": ds.ADCConfigData(
+                4, "HIGH_RESOLUTION", self.sample_rate, [1, 1, 1, 1]
+            ),
+        }
+
+    async def start_notify(self, uuid, callback):
+        self._task = asyncio.create_task(self._notify_loop(callback))
+
+    async def stop_notify(self, uuid):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _notify_loop(self, callback):
+        loop = asyncio.get_running_loop()
+        packet_rate = self.sample_rate / self.samples_per_packet
+        t_start = loop.time()
+        sent = 0
+        while True:
+            due = int((loop.time() - t_start) * packet_rate)
+            for i in range(sent, due):
+                if self.drop_rate and self.random.random() < self.drop_rate:
+                    self.dropped += 1
+                    continue
+                packet = bytearray(self._payloads[i % len(self._payloads)])
+                ssn = i * self.samples_per_packet % 2**16
+                packet[0:2] = ssn.to_bytes(2, "little")
+                callback(None, packet)
+                self.packets += 1
+            sent = max(sent, due)
+            await asyncio.sleep(self.interval_s)
+
+
+def _rss_bytes() -> int:
+    """Resident set size of this process, or the peak one where it isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # Bytes on macOS
+
+
+def _git_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=pathlib.Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            timeout=10,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+@dataclasses.dataclass
+class _Sample:
+    t_s: float
+    rss: int
+    traced: int
+    queue_depth_max: int  # Since the previous sample
+    packets: int
+    stages: dict[str, tuple[int, int]]  # Stage -> cumulative (count, total_ns)
+
+
+def _take_sample(t_s: float, metrics: pipeline_metrics.PipelineMetrics) -> _Sample:
+    depth_max = metrics.queue_depth_max
+    metrics.queue_depth_max = metrics.queue_depth
+    return _Sample(
+        t_s=t_s,
+        rss=_rss_bytes(),
+        traced=tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0,
+        queue_depth_max=depth_max,
+        packets=metrics.packets,
+        stages={
+            name: (hist.count, hist.total_ns)
+            for name, hist in list(metrics.stages.items())
+        },
+    )
+
+
+def _mean_us(first: _Sample, last: _Sample, stage: str) -> Optional[float]:
+    """Mean time of a stage between two samples."""
+    count0, total0 = first.stages.get(stage, (0, 0))
+    count1, total1 = last.stages.get(stage, (0, 0))
+    if count1 == count0:
+        return None
+    return (total1 - total0) / (count1 - count0) / 1000
+
+
+def _median_mean_us(samples: list[_Sample], stage: str) -> Optional[float]:
+    """Median over the intervals between the samples of the mean time of a stage."""
+    means = [_mean_us(a, b, stage) for a, b in zip(samples, samples[1:])]
+    means = [mean for mean in means if mean is not None]
+    return float(np.median(means)) if means else None
+
+
+def _allocation_growth(start, end) -> tuple[int, list[dict]]:
+    """Growth of the traced memory between two tracemalloc snapshots, and the
+    allocations that grew the most, leaving out the soak harness and tracemalloc."""
+    filters = [
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ]
+    stats = end.filter_traces(filters).compare_to(
+        start.filter_traces(filters), "lineno"
+    )
+    top = [
+        {
+            "where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_diff_kb": round(stat.size_diff / 1024, 1),
+            "count_diff": stat.count_diff,
+        }
+        for stat in sorted(stats, key=lambda stat: -stat.size_diff)[:TOP_ALLOCATIONS]
+    ]
+    return sum(stat.size_diff for stat in stats), top
+
+
+def analyze(
+    samples: list[_Sample],
+    warmup_s: float,
+    thresholds: Thresholds,
+    traced_growth: Optional[int] = None,
+) -> dict:
+    """Summary of the samples taken after warmup_s, with the thresholds passed."""
+    steady = [s for s in samples if s.t_s >= warmup_s]
+    if len(steady) < 4:
+        raise ValueError("Too few samples after the warmup, run longer")
+    quarter = len(steady) // 4
+    first, last = steady[: quarter + 1], steady[-quarter - 1 :]
+
+    def mean(values) -> float:
+        return sum(values) / len(values)
+
+    rss_growth_mb = (mean([s.rss for s in last]) - mean([s.rss for s in first])) / 1e6
+    if traced_growth is None:
+        traced_growth = mean([s.traced for s in last]) - mean([s.traced for s in first])
+    t = np.array([s.t_s for s in steady])
+    rss = np.array([s.rss for s in steady]) / 1e6
+    slope = float(np.polyfit(t, rss, 1)[0]) if np.ptp(t) > 0 else 0.0
+
+    latency = {}
+    for stage in steady[-1].stages:
+        early = _median_mean_us(first, stage)
+        late = _median_mean_us(last, stage)
+        if early is None or late is None:
+            continue
+        latency[stage] = {
+            "first_mean_us": round(early, 2),
+            "last_mean_us": round(late, 2),
+            "drift": round(late / early, 3) if early > 0 else None,
+        }
+
+    elapsed = steady[-1].t_s - steady[0].t_s
+    summary = {
+        "rss_mb": round(steady[-1].rss / 1e6, 1),
+        "rss_growth_mb": round(rss_growth_mb, 2),
+        "rss_slope_mb_per_hour": round(slope * 3600, 2),
+        "traced_growth_mb": round(traced_growth / 1e6, 2),
+        "queue_depth_max": max(s.queue_depth_max for s in steady),
+        "queue_depth_max_last_quarter": max(s.queue_depth_max for s in last),
+        "packets_per_s": round((steady[-1].packets - steady[0].packets) / elapsed, 1),
+        "latency": latency,
+    }
+
+    failures = []
+    if rss_growth_mb > thresholds.max_rss_growth_mb:
+        failures.append(
+            f"RSS grew {rss_growth_mb:.1f} MB > {thresholds.max_rss_growth_mb} MB"
+        )
+    if traced_growth / 1e6 > thresholds.max_traced_growth_mb:
+        failures.append(
+            f"Traced memory grew {traced_growth / 1e6:.1f} MB > "
+            f"{thresholds.max_traced_growth_mb} MB"
+        )
+    if summary["queue_depth_max_last_quarter"] > thresholds.max_queue_depth:
+        failures.append(
+            f"Queue depth reached {summary['queue_depth_max_last_quarter']} > "
+            f"{thresholds.max_queue_depth}"
+        )
+    for stage, stats in latency.items():
+        if stage == pipeline_metrics.PipelineMetrics.STAGE_QUEUE_WAIT:
+            continue  # Varies with the bursts, falling behind shows as queue depth
+        early, late = stats["first_mean_us"], stats["last_mean_us"]
+        if (
+            late > early * thresholds.max_latency_drift
+            and late - early > thresholds.latency_floor_us
+        ):
+            failures.append(
+                f"Stage {stage} drifted from {early:.1f} us to {late:.1f} us per packet"
+            )
+    return dict(summary=summary, failures=failures, passed=not failures)
+
+
+def _timeline(samples: list[_Sample]) -> dict:
+    """Samples downsampled to at most TIMELINE_ROWS, the first and last included, as
+    columns. The queue depth of a row is the largest since the previous row."""
+    rows = np.linspace(0, len(samples) - 1, min(len(samples), TIMELINE_ROWS))
+    rows = np.rint(rows).astype(int).tolist()
+    kept = [samples[i] for i in rows]
+    timeline = {
+        "t_s": [round(s.t_s, 1) for s in kept],
+        "rss_mb": [round(s.rss / 1e6, 2) for s in kept],
+        "traced_mb": [round(s.traced / 1e6, 2) for s in kept],
+        "queue_depth_max": [
+            max(s.queue_depth_max for s in samples[previous + 1 : row + 1])
+            for previous, row in zip([-1, *rows], rows)
+        ],
+    }
+    stage_means = {}
+    for stage in samples[-1].stages:
+        stage_means[stage] = [
+            None if mean is None else round(mean, 2)
+            for mean in (_mean_us(a, b, stage) for a, b in zip(kept, kept[1:]))
+        ]
+    timeline["stage_mean_us"] = stage_means
+    return timeline
+
+
+async def run_soak(
+    duration_s: float,
+    callbacks_raw: Iterable[dsbu.NotifyCallbackRawData] = (),
+    callbacks_feeddata: Iterable[dsbu.NotifyCallbackFeeddatas] = (),
+    device: Optional[SimulatedDevice] = None,
+    sample_interval_s: float = 1.0,
+    warmup_s: Optional[float] = None,
+    thresholds: Optional[Thresholds] = None,
+    trace_allocations: bool = True,
+) -> dict:
+    """Stream from the device (a 32 kHz SimulatedDevice by default) through the
+    callbacks for duration_s and return the report.
+
+    warmup_s:           [Seconds] Left out of the comparison, while caches and buffers
+                        fill up. By default 10% of the duration, at most a minute.
+    trace_allocations:  Trace the allocations with tracemalloc. It slows allocations
+                        down, so leave it off to measure the latency alone.
+    """
+    callbacks_raw = list(callbacks_raw)
+    callbacks_feeddata = list(callbacks_feeddata)
+    device = device or SimulatedDevice()
+    thresholds = thresholds or Thresholds()
+    if warmup_s is None:
+        warmup_s = min(60.0, 0.1 * duration_s)
+    started_tracing = trace_allocations and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    metrics = pipeline_metrics.PipelineMetrics()
+    session = dsbu.FeedSession(
+        device,
+        callbacks_raw,
+        callbacks_feeddata,
+        device_info=device.device_info,
+        metrics=metrics,
+    )
+    samples: list[_Sample] = []
+    snapshot_start = snapshot_end = None
+    try:
+        await session.start()
+        t_start = time.monotonic()
+        while True:
+            await asyncio.sleep(sample_interval_s)
+            t_s = time.monotonic() - t_start
+            samples.append(_take_sample(t_s, metrics))
+            if trace_allocations and snapshot_start is None and t_s >= warmup_s:
+                snapshot_start = tracemalloc.take_snapshot()
+            if t_s >= duration_s:
+                break
+        if snapshot_start is not None:
+            snapshot_end = tracemalloc.take_snapshot()
+    finally:
+        await session.stop()
+        device.is_connected = False
+        if started_tracing:
+            tracemalloc.stop()
+
+    traced_growth = None
+    top_allocations = []
+    if snapshot_end is not None:
+        traced_growth, top_allocations = _allocation_growth(
+            snapshot_start, snapshot_end
+        )
+
+    report = {
+        "version": _git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "duration_s": duration_s,
+            "warmup_s": warmup_s,
+            "sample_interval_s": sample_interval_s,
+            "sample_rate": device.sample_rate,
+            "samples_per_packet": device.samples_per_packet,
+            "drop_rate": device.drop_rate,
+            "trace_allocations": trace_allocations,
+            "callbacks": [
+                getattr(cb, "stage_name", type(cb).__name__)
+                for cb in (*callbacks_raw, *callbacks_feeddata)
+            ],
+        },
+        "thresholds": dataclasses.asdict(thresholds),
+        "packets": metrics.packets,
+        "samples": metrics.samples,
+        "missed_samples": metrics.missed_samples,
+        **analyze(samples, warmup_s, thresholds, traced_growth),
+        "top_allocations": top_allocations,
+        "timeline": _timeline(samples),
+    }
+    return report
+
+
+def format_report(report: dict) -> str:
+    """Human readable summary of a report."""
+    summary = report["summary"]
+    lines = [
+        f"soak of {report['config']['duration_s']:.0f}s at {summary['packets_per_s']} "
+        f"packets/s ({report['version'] or 'unknown version'}): "
+        + ("PASSED" if report["passed"] else "FAILED"),
+        f"RSS {summary['rss_mb']} MB, grew {summary['rss_growth_mb']} MB "
+        f"({summary['rss_slope_mb_per_hour']} MB/hour), traced memory grew "
+        f"{summary['traced_growth_mb']} MB",
+        f"queue depth max {summary['queue_depth_max']} "
+        f"(last quarter {summary['queue_depth_max_last_quarter']})",
+    ]
+    for stage, stats in summary["latency"].items():
+        lines.append(
+            f"  {stage:<40} {stats['first_mean_us']:>8.1f}us -> "
+            f"{stats['last_mean_us']:>8.1f}us"
+        )
+    if report["top_allocations"]:
+        lines.append("top allocation growth:")
+        for alloc in report["top_allocations"][:5]:
+            lines.append(
+                f"  {alloc['size_diff_kb']:>10.1f} KB {alloc['count_diff']:>+8} "
+                f"{alloc['where']}"
+            )
+    lines += [f"FAIL: {failure}" for failure in report["failures"]]
+    return "\n".join(lines)
+
+
+def compare_reports(old: dict, new: dict) -> str:
+    """Side by side summary of two reports, e.g. of two versions."""
+    lines = [f"{'':<40} {old['version'] or 'old':>14} {new['version'] or 'new':>14}"]
+    keys = (
+        "rss_mb",
+        "rss_growth_mb",
+        "rss_slope_mb_per_hour",
+        "traced_growth_mb",
+        "queue_depth_max",
+        "packets_per_s",
+    )
+    for key in keys:
+        lines.append(
+            f"{key:<40} {old['summary'][key]!s:>14} {new['summary'][key]!s:>14}"
+        )
+    stages = dict.fromkeys((*old["summary"]["latency"], *new["summary"]["latency"]))
+    for stage in stages:
+        before = old["summary"]["latency"].get(stage, {}).get("last_mean_us", "-")
+        after = new["summary"]["latency"].get(stage, {}).get("last_mean_us", "-")
+        lines.append(f"{stage + ' us':<40} {before!s:>14} {after!s:>14}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+
+    import pipeline
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--duration", default=600.0, type=float, help="[Seconds]")
+    parser.add_argument("--sample-interval", default=1.0, type=float, help="[Seconds]")
+    parser.add_argument("--warmup", default=None, type=float, help="[Seconds]")
+    parser.add_argument("--sample-rate", default=32000, type=int)
+    parser.add_argument("--samples-per-packet", default=20, type=int)
+    parser.add_argument("--drop-rate", default=0.0, type=float)
+    parser.add_argument(
+        "--pipeline",
+        metavar="CONFIG",
+        help="JSON pipeline config of the sinks to soak (see pipeline.py). By default "
+        "a recording rotated every minute, in a temporary directory",
+    )
+    parser.add_argument(
+        "--thresholds",
+        default="{}",
+        type=json.loads,
+        help="JSON of Thresholds to override, e.g. '{\"max_rss_growth_mb\": 50}'",
+    )
+    parser.add_argument(
+        "--no-tracemalloc",
+        action="store_true",
+        help="Don't trace allocations, which slows them down",
+    )
+    parser.add_argument("--report", type=pathlib.Path, help="Write the JSON report")
+    parser.add_argument(
+        "--compare", type=pathlib.Path, help="Report of a previous run to compare to"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.pipeline:
+            config = pipeline.load_config(args.pipeline)
+        else:
+            config = {
+                "sinks": [
+                    {
+                        "type": "record",
+                        "args": {
+                            "file_path_str": f"{tmp}/soak.dynrec",
+                            "max_seconds": 60,
+                        },
+                    }
+                ]
+            }
+        callbacks_raw, callbacks_feeddata = pipeline.build_pipeline(config)
+        device = SimulatedDevice(
+            args.sample_rate, args.samples_per_packet, drop_rate=args.drop_rate
+        )
+        report = asyncio.run(
+            run_soak(
+                args.duration,
+                callbacks_raw,
+                callbacks_feeddata,
+                device=device,
+                sample_interval_s=args.sample_interval,
+                warmup_s=args.warmup,
+                thresholds=Thresholds(**args.thresholds),
+                trace_allocations=not args.no_tracemalloc,
+            )
+        )
+
+    print(format_report(report))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, separators=(",", ":"))
+        print("Wrote", args.report)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare_reports(json.load(f), report))
+    sys.exit(0 if report["passed"] else 1)
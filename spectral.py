@@ -0,0 +1,126 @@
+"""Streaming power spectral density (Welch's method) of the ADC channels.
+
+Samples are cut into overlapping, windowed segments as they arrive; each segment's
+periodogram is folded into an exponential average. Only one buffer of about two
+segments is kept, and the FFT count per second of data is fixed by the segment length
+and overlap, so the cost is bounded no matter how long the capture runs.
+"""
+
+from typing import Optional
+
+import numpy as np
+
+
+class WelchPSD:
+    """Per-channel one-sided PSD in ADC counts^2/Hz, the same scaling as
+    scipy.signal.welch(scaling="density", detrend="constant")."""
+
+    def __init__(
+        self,
+        sample_rate: float,
+        segment_len: int = 4096,
+        overlap: float = 0.5,
+        averaging: float = 0.1,
+        n_channels: int = 4,
+    ):
+        """
+        sample_rate:    [Hz] Sample rate of the feed.
+        segment_len:    Samples per FFT segment; sets the frequency resolution.
+        overlap:        Fraction of each segment shared with the next one, in [0, 1).
+        averaging:      Weight of each new segment in the exponential average, in (0, 1].
+                        1 keeps only the latest segment.
+        """
+        assert segment_len >= 2, "segment_len must be at least 2"
+        assert 0 <= overlap < 1, "overlap must be in [0, 1)"
+        assert 0 < averaging <= 1, "averaging must be in (0, 1]"
+
+        self.sample_rate = float(sample_rate)
+        self.segment_len = int(segment_len)
+        self.hop = max(1, int(round(self.segment_len * (1 - overlap))))
+        self.averaging = float(averaging)
+        self.n_channels = n_channels
+
+        self.window = np.hanning(self.segment_len)
+        self.freqs = np.fft.rfftfreq(self.segment_len, 1 / self.sample_rate)
+        self._scale = 1 / (self.sample_rate * np.square(self.window).sum())
+        # One-sided spectrum: fold the negative frequencies into the positive ones.
+        self._scale_bins = np.full(len(self.freqs), 2 * self._scale)
+        self._scale_bins[0] = self._scale
+        if self.segment_len % 2 == 0:
+            self._scale_bins[-1] = self._scale
+
+        self._buf = np.zeros((2 * self.segment_len, n_channels))
+        self._fill = 0
+
+        self.psd: Optional[np.ndarray] = None  # (n_freqs, n_channels)
+        self.n_segments = 0
+
+    def update(self, samples: np.ndarray, missing: int = 0) -> int:
+        """Add a batch of samples, shaped (n, n_channels). Returns how many new
+        segments were folded into the average.
+        missing: samples dropped right before this batch. A segment never spans a gap,
+        the partial one is discarded instead."""
+        samples = np.asarray(samples).reshape(-1, self.n_channels)
+        if missing:
+            self._fill = 0
+
+        n_new = 0
+        pos = 0
+        while pos < len(samples):
+            take = min(len(self._buf) - self._fill, len(samples) - pos)
+            self._buf[self._fill : self._fill + take] = samples[pos : pos + take]
+            self._fill += take
+            pos += take
+            if self._fill >= self.segment_len:
+                n_new += self._process_buffer()
+        return n_new
+
+    def _process_buffer(self) -> int:
+        n_seg = 1 + (self._fill - self.segment_len) // self.hop
+        # (n_seg, n_channels, segment_len) views into the buffer, no copies.
+        segments = np.lib.stride_tricks.sliding_window_view(
+            self._buf[: self._fill], self.segment_len, axis=0
+        )[:: self.hop][:n_seg]
+
+        detrended = segments - segments.mean(axis=-1, keepdims=True)
+        spectra = np.fft.rfft(detrended * self.window, axis=-1)
+        # (n_seg, n_freqs, n_channels)
+        periodograms = np.swapaxes(np.square(np.abs(spectra)), 1, 2)
+        periodograms *= self._scale_bins[:, np.newaxis]
+        self._average(periodograms)
+
+        # Keep the tail that the next segment overlaps with.
+        consumed = n_seg * self.hop
+        leftover = self._fill - consumed
+        self._buf[:leftover] = self._buf[consumed : self._fill]
+        self._fill = leftover
+        return n_seg
+
+    def _average(self, periodograms: np.ndarray):
+        if self.psd is None:
+            self.psd = periodograms[0].copy()
+            self.n_segments += 1
+            periodograms = periodograms[1:]
+        m = len(periodograms)
+        if m == 0:
+            return
+        # Same as applying psd = (1 - a) * psd + a * p for each segment in order.
+        a = self.averaging
+        weights = a * (1 - a) ** np.arange(m - 1, -1, -1)
+        self.psd = (1 - a) ** m * self.psd + np.tensordot(weights, periodograms, 1)
+        self.n_segments += m
+
+    def peaks(
+        self, n: int = 3, min_freq: float = 1.0
+    ) -> list[list[tuple[float, float]]]:
+        """The n strongest bins above min_freq for each channel, as (Hz, counts^2/Hz)."""
+        if self.psd is None:
+            return [[] for _ in range(self.n_channels)]
+        valid = self.freqs >= min_freq
+        freqs = self.freqs[valid]
+        result = []
+        for ch in range(self.n_channels):
+            psd = self.psd[valid, ch]
+            top = np.argsort(psd)[::-1][:n]
+            result.append([(float(freqs[i]), float(psd[i])) for i in top])
+        return result
@@ -6,25 +6,91 @@ import asyncio
 import datetime
 import collections
 import time
-import csv
 import inspect
-import socket
+import io
+import operator
 import json
 import pathlib
-import itertools
+import sys
 
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 import dynamite_sampler_api as ds
 import dynamite_sampler_bleak_util as dsbu
 
+if TYPE_CHECKING:
+    # Imported by the sinks that use them, so only the selected sinks' are loaded.
+    import link_telemetry
+
 # TODO add pretty class prints
 
 
+class CSVSegment:
+    """CSV file format for FeedDataCSVWriter (a rotation.SegmentFormat): batches are
+    lists of FeedData."""
+
+    def __init__(self, device_dict: dict):
+        import csv
+
+        self.csv = csv
+        self.device_dict = device_dict
+        # fieldnames_feedheader = inspect.getfullargspec(ds.FeedHeader.__init__).args[1:]
+        self.fieldnames_feeddata = inspect.getfullargspec(ds.FeedData.__init__).args[1:]
+        self.get_fields = operator.attrgetter(*self.fieldnames_feeddata)
+
+    def open(self, path):
+        # https://docs.python.org/3/library/csv.html#id4
+        # for csvwriter, the newline="" has to be used for proper line ending quotes
+        # Unclear if this is actually needed in this use case
+        self.csv_file = open(path, "w", newline="")
+        self.bytes = 0
+
+        buf = io.StringIO()
+        print("#", "CSV setup:", datetime.datetime.now(), file=buf)
+        print("#", self.device_dict, file=buf)
+        self.csv.writer(buf).writerow(
+            ["Sample Sequence Number"] + self.fieldnames_feeddata
+        )
+        self._write_str(buf.getvalue())
+
+    def write(self, first_ssn, feeddatas):
+        # Format the whole batch in memory, which also gives its size without tell().
+        buf = io.StringIO()
+        self.csv.writer(buf).writerows(
+            (first_ssn + i, *self.get_fields(data)) for i, data in enumerate(feeddatas)
+        )
+        self._write_str(buf.getvalue())
+
+    def _write_str(self, s: str):
+        self.csv_file.write(s)
+        self.bytes += len(s)
+
+    def flush(self):
+        self.csv_file.flush()
+
+    def close(self):
+        self.csv_file.close()
+
+    def size(self):
+        return self.bytes
+
+
 class FeedDataCSVWriter(dsbu.NotifyCallbackFeeddatas):
-    """This class writes FeedData to a CSV file"""
+    """This class writes FeedData to a CSV file.
+    The file is written from a background thread, optionally rotated (see rotation.py)
+    """
 
-    def __init__(self, file_path_str: Optional[str] = None):
+    def __init__(
+        self,
+        file_path_str: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        max_seconds: Optional[float] = None,
+        flush_interval: float = 1.0,
+    ):
+        """
+        max_bytes, max_seconds: Start a new file once one gets this big / this old.
+        flush_interval: [Seconds] The maximum time written data stays buffered.
+        """
         if not file_path_str:
             # Use a default file path
             date_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -36,31 +102,145 @@ class FeedDataCSVWriter(dsbu.NotifyCallbackFeeddatas):
         # Make sure that the directory for the file exists, if it doesn't make it
         self.file_path.parent.mkdir(parents=True, exist_ok=True)
 
-        # https://docs.python.org/3/library/csv.html#id4
-        # for csvwriter, the newline="" has to be used for proper line ending quotes
-        # Unclear if this is actually needed in this use case
-        self.csv_file = open(self.file_path, "w", newline="")
+        self.rotation_kwargs = dict(
+            max_bytes=max_bytes, max_seconds=max_seconds, flush_interval=flush_interval
+        )
 
     def setup(self, device_dict):
-        print("#", "CSV setup:", datetime.datetime.now(), file=self.csv_file)
-        print("#", device_dict, file=self.csv_file)
-
-        # fieldnames_feedheader = inspect.getfullargspec(ds.FeedHeader.__init__).args[1:]
-        fieldnames_feeddata = inspect.getfullargspec(ds.FeedData.__init__).args[1:]
-        fieldnames = ["Sample Sequence Number"] + fieldnames_feeddata
+        import rotation
 
-        self.writer = csv.DictWriter(self.csv_file, fieldnames)
-        self.writer.writeheader()
+        self.writer = rotation.RotatingWriter(
+            self.file_path, CSVSegment(device_dict), **self.rotation_kwargs
+        )
 
     def callback(self, header: ds.FeedHeader, feeddatas: list[ds.FeedData], missing):
-        # print("callback in csv writer")
-        for i, data in enumerate(feeddatas):
-            ssn_dict = {"Sample Sequence Number": header.sample_sequence_number + i}
-            self.writer.writerow(collections.ChainMap(ssn_dict, data.__dict__))
+        self.writer.submit(
+            header.sample_sequence_number, feeddatas, len(feeddatas), missing
+        )
 
     def cleanup(self):
         print("Closing csv file")
-        self.csv_file.close()
+        self.writer.close()
+
+
+class RecordingSegment:
+    """Compressed recording format for FeedDataRecorder (a rotation.SegmentFormat):
+    batches are (n, 4) arrays."""
+
+    def __init__(self, device_dict: dict, writer_kwargs: dict):
+        # Import inside the class so that numpy is only needed when this is used.
+        import recording
+
+        self.recording = recording
+        self.device_dict = device_dict
+        self.writer_kwargs = writer_kwargs
+        self.stats = recording.WriterStats()  # Summed over all segments
+
+    def open(self, path):
+        sample_rate = 0
+        if self.device_dict.get("ADCConfig"):
+            sample_rate = self.device_dict["ADCConfig"].sample_rate
+        # Already on the rotating writer's thread, so no need for another one.
+        self.writer = self.recording.RecordingWriter(
+            path,
+            sample_rate=sample_rate,
+            metadata=self.device_dict,
+            background=False,
+            **self.writer_kwargs,
+        )
+
+    def write(self, first_ssn, samples):
+        self.writer.write(first_ssn, samples)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        self.stats.add(self.writer.stats)
+
+    def size(self):
+        return self.writer.size
+
+
+class FeedDataRecorder(dsbu.NotifyCallbackSamples):
+    """This class writes FeedData to a compressed binary recording (see recording.py).
+    The file is written from a background thread, optionally rotated (see rotation.py)
+    The link telemetry of the session is written next to it, one line per window (see
+    link_telemetry.py).
+    """
+
+    def __init__(
+        self,
+        file_path_str: Optional[str] = None,
+        codec: str = "zlib",
+        level: int = 6,
+        chunk_samples: int = 32768,
+        max_bytes: Optional[int] = None,
+        max_seconds: Optional[float] = None,
+        flush_interval: float = 1.0,
+    ):
+        """
+        codec, level, chunk_samples: see recording.RecordingWriter
+        max_bytes, max_seconds: Start a new file once one gets this big / this old.
+        flush_interval: [Seconds] The maximum time written data stays buffered. Each
+                        flush ends a chunk, so this also bounds the chunk length.
+        """
+        self.writer_kwargs = dict(codec=codec, level=level, chunk_samples=chunk_samples)
+        self.rotation_kwargs = dict(
+            max_bytes=max_bytes, max_seconds=max_seconds, flush_interval=flush_interval
+        )
+
+        if not file_path_str:
+            # Use a default file path
+            date_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            file_path_str = f"./data/feeddata_{date_str}.dynrec"
+
+        # resolve the path so .parent works properly
+        self.file_path = pathlib.Path(file_path_str).resolve()
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.link_telemetry: Optional["link_telemetry.LinkTelemetry"] = None
+
+    def setup(self, device_dict):
+        import link_telemetry
+        import rotation
+
+        self.link_log_path = link_telemetry.link_log_path(self.file_path)
+        self.write_link_log = link_telemetry.write_link_log
+        self.windows_written = 0
+        self.segment_format = RecordingSegment(device_dict, self.writer_kwargs)
+        self.writer = rotation.RotatingWriter(
+            self.file_path, self.segment_format, **self.rotation_kwargs
+        )
+
+    def callback_block(self, header: ds.FeedHeader, block, missing):
+        # Copied: the writer thread and the recording keep the samples after the call.
+        samples = block.samples.copy()
+        self.writer.submit(
+            header.sample_sequence_number, samples, len(samples), missing
+        )
+        telemetry = self.link_telemetry
+        if telemetry is not None and telemetry.windows_closed > self.windows_written:
+            self.write_link_windows()
+
+    def write_link_windows(self):
+        """Append the windows closed since the last call to the link log."""
+        telemetry = self.link_telemetry
+        new = min(
+            telemetry.windows_closed - self.windows_written, len(telemetry.windows)
+        )
+        if new > 0:
+            windows = list(telemetry.windows)[-new:]
+            self.write_link_log(self.link_log_path, windows)
+        self.windows_written = telemetry.windows_closed
+
+    def cleanup(self):
+        print("Closing recording", self.file_path)
+        self.writer.close()
+        print("Recording:", self.segment_format.stats)
+        if self.link_telemetry is not None:
+            self.write_link_windows()
+            print("Link telemetry:", self.link_log_path)
 
 
 class TQDMPbar(dsbu.NotifyCallbackRawData):
@@ -101,6 +281,8 @@ class MetricsPrinter(dsbu.NotifyCallbackRawData):
         """
         self.queue_len = int(n_sample_avg)
         self.print_dt = float(print_dt)
+        # Set by FeedSession; adds the connection interval and jitter to the line.
+        self.link_telemetry: Optional["link_telemetry.LinkTelemetry"] = None
 
     def setup(self, device_dict):
         self.prev_time = time.time()  # The previous time a callback was called
@@ -152,37 +334,186 @@ class MetricsPrinter(dsbu.NotifyCallbackRawData):
                 f"{avg_bytes:3} bytes/packet, "
                 f"{avg_bytes / avg_dt:5.1f} bytes/sec "
             )
+            link = self.link_telemetry
+            if link is not None:
+                metric_str += (
+                    f"interval: {link.interval_ms:5.1f}ms "
+                    f"(jitter {link.jitter_ms:4.1f}ms, "
+                    f"{link.packets_per_interval:3.1f} packets), "
+                    f"missed {link.missed_rate:.2%} "
+                )
 
             print(metric_str, end="\r")
 
     def cleanup(self):
         print()
+        if self.link_telemetry is not None:
+            print(self.link_telemetry)
         print("cleaned up printer")
 
 
-class SocketStream(dsbu.NotifyCallbackFeeddatas):
+class StatsPrinter(dsbu.NotifyCallbackSamples):
+    """Print rolling per-channel statistics of the sample values"""
+
+    def __init__(self, windows_s: Optional[list[float]] = None, print_dt: float = 1.0):
+        """
+        windows_s:  [Seconds] Lengths of the rolling windows to compute statistics over.
+        print_dt:   [Seconds] The minimum time between printing the statistics.
+        """
+        # Import inside the class so that numpy is only needed when this is used.
+        import rolling_stats
+
+        self.rolling_stats = rolling_stats
+        self.windows_s = windows_s if windows_s else [0.1, 1.0]
+        self.print_dt = float(print_dt)
+
+    def setup(self, device_dict):
+        if device_dict.get("ADCConfig"):
+            self.sample_rate = device_dict["ADCConfig"].sample_rate
+        else:
+            self.sample_rate = 32000
+        self.windows = [max(1, int(w * self.sample_rate)) for w in self.windows_s]
+        self.stats = self.rolling_stats.RollingStats(self.windows)
+        self.prev_time_print = time.time()
+
+    def callback_block(self, header, block, missing):
+        self.stats.update(block.samples, missing)
+
+        cur_time = time.time()
+        if cur_time - self.prev_time_print > self.print_dt:
+            self.prev_time_print = cur_time
+            self.print_stats()
+
+    def print_stats(self):
+        print(f"{self.stats.total_samples} samples, {self.stats.total_missing} missing")
+        snapshot = self.stats.snapshot()  # By window length in samples
+        for window_s, window in zip(self.windows_s, self.windows):
+            stats = snapshot[window]
+            if stats is None:
+                continue
+            for ch in range(len(stats.mean)):
+                print(
+                    f"  [{window_s:g}s] ch{ch}: "
+                    f"mean {stats.mean[ch]:11.1f}, "
+                    f"std {stats.std[ch]:8.1f}, "
+                    f"rms {stats.rms[ch]:11.1f}, "
+                    f"noise {stats.noise[ch]:8.1f}, "
+                    f"min {stats.min[ch]:9.0f}, "
+                    f"max {stats.max[ch]:9.0f}"
+                )
+
+    def cleanup(self):
+        print("Final statistics:")
+        self.print_stats()
+
+
+class SpectrumPrinter(dsbu.NotifyCallbackSamples):
+    """Estimate the noise spectrum of each channel live (Welch PSD), and periodically
+    print its strongest peaks, e.g. to spot mains hum or mechanical resonances."""
+
+    def __init__(
+        self,
+        segment_len: int = 4096,
+        overlap: float = 0.5,
+        averaging: float = 0.1,
+        publish_dt: float = 2.0,
+        n_peaks: int = 3,
+        npz_path: Optional[str] = None,
+    ):
+        """
+        segment_len, overlap, averaging: see spectral.WelchPSD
+        publish_dt: [Seconds] The minimum time between publishing the spectrum.
+        n_peaks:    How many peaks to print per channel.
+        npz_path:   If given, the latest spectrum is also saved there (freqs & psd),
+                    replacing the previous one, so other tools can watch it.
+        """
+        # Import inside the class so that numpy is only needed when this is used.
+        import numpy as np
+        import spectral
+
+        self.np = np
+        self.spectral = spectral
+        self.psd_kwargs = dict(
+            segment_len=segment_len, overlap=overlap, averaging=averaging
+        )
+        self.publish_dt = float(publish_dt)
+        self.n_peaks = int(n_peaks)
+        self.npz_path = pathlib.Path(npz_path).resolve() if npz_path else None
+
+    def setup(self, device_dict):
+        if device_dict.get("ADCConfig"):
+            sample_rate = device_dict["ADCConfig"].sample_rate
+        else:
+            sample_rate = 32000
+        self.psd = self.spectral.WelchPSD(sample_rate, **self.psd_kwargs)
+        self.prev_time_publish = time.time()
+        if self.npz_path:
+            self.npz_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def callback_block(self, header, block, missing):
+        self.psd.update(block.samples, missing)
+
+        cur_time = time.time()
+        if cur_time - self.prev_time_publish > self.publish_dt:
+            self.prev_time_publish = cur_time
+            self.publish()
+
+    def publish(self):
+        if self.psd.psd is None:
+            return
+        print(f"Spectrum, {self.psd.n_segments} segments averaged:")
+        for ch, peaks in enumerate(self.psd.peaks(self.n_peaks)):
+            peaks_str = ", ".join(f"{f:7.1f}Hz {p:9.3g}" for f, p in peaks)
+            print(f"  ch{ch}: {peaks_str}")
+
+        if self.npz_path:
+            # Write then rename, so a reader never sees a half written file.
+            tmp_path = self.npz_path.with_suffix(".tmp.npz")
+            self.np.savez(tmp_path, freqs=self.psd.freqs, psd=self.psd.psd)
+            tmp_path.replace(self.npz_path)
+
+    def cleanup(self):
+        self.publish()
+
+
+class SocketStream(dsbu.NotifyCallbackSamples):
     """Stream each channel to a TCP localhost socket.
     Intended for to be used with waveforms & the `read_from_tcp_4_ports.js` script."""
 
+    interactive_setup = True  # setup() waits for enter, see pipeline.py
+
     def __init__(
-        self, ports: Optional[list[int]] = None, conversion: str = "volts_adc_ir"
+        self,
+        ports: Optional[list[int]] = None,
+        conversion: str = "volts_adc_ir",
+        gap_fill: str = "hold",
     ):
+        """
+        gap_fill:   How to fill in dropped samples, see feed_arrays.GapFiller. "zero"
+                    is the old behaviour, but it plots as a spike to zero force.
+        """
+        # Import inside the class so that numpy is only needed when this is used.
+        import feed_arrays
+        import socket
+
+        self.feed_arrays = feed_arrays
+        self.socket = socket
         self.ports = ports
         if not self.ports:
             self.ports = [8090, 8091, 8092, 8093]
         assert len(set(self.ports)) == 4, "There needs to be 4 ports specified"
 
         self.conversion_str = conversion
-        self.servers: list[socket.socket] = []
+        self.servers: list["socket.socket"] = []
 
-        # What data to send when samples where dropped
-        self.empty_data = ds.FeedData(0, 0, 0, 0)
+        assert gap_fill != "nan", "NaN can't be sent as an integer"
+        self.gap_filler = feed_arrays.GapFiller(gap_fill)
 
     def setup(self, device_dict):
         input("Press enter to start socket connections")
         for port in self.ports:
             print(f"waiting socket {port}")
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s = self.socket.socket(self.socket.AF_INET, self.socket.SOCK_STREAM)
             s.connect(("localhost", port))
             self.servers.append(s)
             print(f"socket connected {port}")
@@ -215,15 +546,13 @@ class SocketStream(dsbu.NotifyCallbackFeeddatas):
             )
             server.send(scale_factor.to_bytes(4, "little", signed=True))
 
-    def callback(self, header, feeddatas, missing):
-        # Send empty data for the other side to know that packets were missed
+    def callback_block(self, header, block, missing):
+        filled = self.gap_filler.fill(block.samples, missing)
 
-        for data in itertools.chain((self.empty_data,) * missing, feeddatas):
-            for server, ch_val in zip(
-                self.servers, (data.ch0, data.ch1, data.ch2, data.ch3)
-            ):
-                bytes_to_send = ch_val.to_bytes(4, "little", signed=True)
-                server.send(bytes_to_send)
+        # One send per channel per packet, as little-endian int32s.
+        channels = filled.data.astype("<i4").T
+        for server, ch_vals in zip(self.servers, channels):
+            server.sendall(ch_vals.tobytes())
 
     def cleanup(self):
         print("Closing server sockets")
@@ -242,40 +571,150 @@ def gen_append_class_init(cls):
     return AppendClassInit
 
 
+def gen_append_registry_init(name):
+    """Like gen_append_class_init, for a sink of the pipeline registry. The class is
+    only resolved, importing its module, when the flag is given."""
+
+    class AppendRegistryInit(argparse.Action):
+        def __call__(self, parser, namespace, values, option_string=None):
+            import pipeline
+
+            cls = pipeline.resolve(name)
+            if issubclass(cls, dsbu.NotifyCallbackRawData):
+                dest = "callbacks_rawdata"
+            elif issubclass(cls, dsbu.NotifyCallbackFeeddatas):
+                dest = "callbacks_feeddata"
+            else:
+                parser.error(f"{option_string} is not a sink, use it in a --pipeline")
+            getattr(namespace, dest).append(cls(**json.loads(values)))
+
+    return AppendRegistryInit
+
+
 if __name__ == "__main__":
     # WIP argparser. Haven't figured out the best syntax for this script.
     # This is something that works
     parser = argparse.ArgumentParser(description=__doc__)
     # TODO add help about the json input
 
-    arg_classes = [
-        ("--metrics", MetricsPrinter, "callbacks_rawdata"),
-        ("--tqdm", TQDMPbar, "callbacks_rawdata"),
-        ("--socket", SocketStream, "callbacks_feeddata"),
-        ("--csv", FeedDataCSVWriter, "callbacks_feeddata"),
-    ]
-
-    for flag, cls, dest in arg_classes:
+    # The sinks are looked up in the pipeline registry. Let it find the classes of this
+    # script instead of importing it a second time as "stream".
+    sys.modules.setdefault("stream", sys.modules["__main__"])
+    import pipeline
+
+    parser.set_defaults(callbacks_rawdata=[], callbacks_feeddata=[])
+    for name, target in pipeline.REGISTRY.items():
+        if isinstance(target, str) and target.partition(":")[0] in sys.modules:
+            target = pipeline.resolve(name)  # Already imported, e.g. stream's sinks
+        if isinstance(target, type) and not issubclass(
+            target, (dsbu.NotifyCallbackRawData, dsbu.NotifyCallbackFeeddatas)
+        ):
+            continue  # Processing stages are only for --pipeline configs
         # TODO add help to the arguments
-        # each argument will append a class instance to the dest.
+        # each argument will append a class instance to callbacks_rawdata or
+        # callbacks_feeddata, depending on the class. The class (and its module) is only
+        # loaded for the flags given, so unused sinks cost nothing at startup.
         # optionally each flag can take in a string json that will be parsed and passed
         # into the initializer as keyword args.
         parser.add_argument(
-            flag,
-            action=gen_append_class_init(cls),
-            dest=dest,
+            f"--{name}",
+            action=gen_append_registry_init(name),
             nargs="?",  # 0 or 1 arguments
             const="{}",  # if 0 arguments pass in empty dict
-            default=[],  # if no arguments in dest, make it an empty list
+            metavar="JSON",
         )
 
     parser.add_argument(
         "--txpwr", default=None, type=int, help="Set the tx power of the board"
     )
 
+    parser.add_argument(
+        "--adaptive-txpwr",
+        nargs="?",
+        const="{}",
+        default=None,
+        type=json.loads,
+        metavar="CONFIG",
+        help="Adjust the tx power to the missed samples, starting from --txpwr. "
+        "Optionally a JSON of tx_power.AdaptiveTxPower keyword args",
+    )
+
+    parser.add_argument(
+        "--pipeline-metrics",
+        nargs="?",
+        const=0,
+        default=None,
+        type=int,
+        metavar="PORT",
+        help="Time each pipeline stage and print a summary at the end. If a PORT is "
+        "given, also serve it on localhost:PORT (/metrics is in Prometheus format)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "sampling"],
+        default=None,
+        help="Arm an on-demand profiler of the feed pipeline stages. Send SIGUSR1 to "
+        "the process to profile the next --profile-duration seconds into ./profiles",
+    )
+    parser.add_argument(
+        "--profile-duration",
+        default=10.0,
+        type=float,
+        help="[Seconds] Length of a profiling interval",
+    )
+
+    parser.add_argument(
+        "--replay",
+        default=None,
+        metavar="PATH",
+        help="Instead of connecting to a device, stream a .dynrec recording (see "
+        "--record) through the selected callbacks. Doesn't import bleak",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        default=1.0,
+        type=float,
+        help="Playback speed of --replay relative to the recorded sample rate, 0 for "
+        "as fast as possible",
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        default=None,
+        metavar="CONFIG",
+        help="JSON pipeline config of processing stages and sinks, each run inline, on "
+        "a thread or in a process (see pipeline.py). Added to the sinks of the flags",
+    )
+
+    parser.add_argument(
+        "--fan-out",
+        nargs="?",
+        const=256,
+        default=None,
+        type=int,
+        metavar="QUEUE_SIZE",
+        help="Run every sink on its own thread with a queue of QUEUE_SIZE batches "
+        "(256 by default). A sink that falls behind drops batches instead of delaying "
+        "the others",
+    )
+
     args = parser.parse_args()
 
-    if args.callbacks_rawdata == [] and args.callbacks_feeddata == []:
+    if args.pipeline:
+        config_rawdata, config_feeddata = pipeline.build_pipeline(
+            pipeline.load_config(args.pipeline)
+        )
+        args.callbacks_rawdata += config_rawdata
+        args.callbacks_feeddata += config_feeddata
+
+    if args.replay and args.callbacks_rawdata == [] and args.callbacks_feeddata == []:
+        print("No callbacks selected; adding the following:")
+        callbacks_rawdata = [MetricsPrinter()]
+        callbacks_feeddata = [StatsPrinter()]
+        print(callbacks_rawdata)
+        print(callbacks_feeddata)
+    elif args.callbacks_rawdata == [] and args.callbacks_feeddata == []:
         print("No callbacks selected; adding the following:")
         callbacks_rawdata = [MetricsPrinter()]
         callbacks_feeddata = [FeedDataCSVWriter(), SocketStream()]
@@ -285,8 +724,58 @@ if __name__ == "__main__":
         callbacks_rawdata = args.callbacks_rawdata
         callbacks_feeddata = args.callbacks_feeddata
 
-    asyncio.run(
-        dsbu.dynamite_sampler_connect_notify(
-            callbacks_rawdata, callbacks_feeddata, tx_power=args.txpwr
+    if args.fan_out is not None:
+        callbacks_rawdata, callbacks_feeddata = pipeline.fan_out(
+            callbacks_rawdata, callbacks_feeddata, args.fan_out
         )
-    )
+
+    metrics = None
+    if args.pipeline_metrics is not None:
+        import pipeline_metrics
+
+        metrics = pipeline_metrics.PipelineMetrics()
+        if args.pipeline_metrics:
+            pipeline_metrics.serve_metrics(metrics, args.pipeline_metrics)
+            print(f"Serving pipeline metrics on localhost:{args.pipeline_metrics}")
+
+    profiler = None
+    if args.profile is not None:
+        import profiling
+
+        profiler_classes = {
+            "cprofile": profiling.CProfileProfiler,
+            "sampling": profiling.SamplingProfiler,
+        }
+        profiler = profiler_classes[args.profile](duration_s=args.profile_duration)
+        profiler.install_signal_handler()
+
+    if args.replay:
+        import replay
+
+        asyncio.run(
+            replay.replay_recording(
+                args.replay,
+                callbacks_rawdata,
+                callbacks_feeddata,
+                speed=args.replay_speed,
+                metrics=metrics,
+                profiler=profiler,
+            )
+        )
+    else:
+        asyncio.run(
+            dsbu.dynamite_sampler_connect_notify(
+                callbacks_rawdata,
+                callbacks_feeddata,
+                tx_power=args.txpwr,
+                metrics=metrics,
+                profiler=profiler,
+                adaptive_tx_power=args.adaptive_txpwr,
+            )
+        )
+
+    if profiler is not None:
+        profiler.finish()  # Write out an interval cut short by the end of the stream
+
+    if metrics is not None:
+        print(metrics.to_text())
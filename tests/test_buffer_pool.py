@@ -0,0 +1,147 @@
+# Run it like so: `python -m tests.test_buffer_pool`
+
+import asyncio
+import random
+import unittest
+
+import numpy as np
+
+import buffer_pool
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+import feed_arrays
+import pipeline_metrics
+from tests.test_feed_session import FakeClient, RecordingCallback, make_packet
+
+
+def random_packet(ssn: int, n_samples: int, rng: random.Random) -> bytearray:
+    values = [rng.randint(-(2**23), 2**23 - 1) for _ in range(n_samples * 4)]
+    if n_samples:
+        values[:2] = [-(2**23), 2**23 - 1]  # The extremes of the 24-bit range
+    samples = b"".join(v.to_bytes(3, "little", signed=True) for v in values)
+    return bytearray(ssn.to_bytes(2, "little") + samples)
+
+
+class BlockCollector(dsbu.NotifyCallbackSamples):
+    """Keeps every block it gets, retained, to check they aren't reused meanwhile."""
+
+    def __init__(self, retain: bool = False):
+        self.retain = retain
+        self.blocks = []
+        self.calls = []
+
+    def callback_block(self, header, block, missing):
+        self.calls.append(
+            (header.sample_sequence_number, block.samples.copy(), missing)
+        )
+        if self.retain:
+            block.retain()
+            self.blocks.append(block)
+
+
+def run_session(packets, callbacks_feeddata, **kwargs):
+    async def scenario():
+        client = FakeClient()
+        session = dsbu.FeedSession(
+            client, (), callbacks_feeddata, device_info={}, **kwargs
+        )
+        await session.start()
+        for packet in packets:
+            client.notify_callback(None, packet)
+        client.is_connected = False
+        await asyncio.wait_for(session.wait_done(), timeout=2.0)
+        await session.stop()
+        return session
+
+    return asyncio.run(scenario())
+
+
+class BufferPoolTest(unittest.TestCase):
+    def test_decode_matches_adc_feed(self):
+        rng = random.Random(0)
+        pool = buffer_pool.BufferPool(block_samples=20, preallocate=1)
+        for n_samples in (20, 7, 1, 0):
+            packet = random_packet(123, n_samples, rng)
+            expected = feed_arrays.feeddatas_to_array(
+                ds.DynamiteSampler.ADCFeed.unpack(packet).samples
+            )
+            block = pool.decode(packet)
+            np.testing.assert_array_equal(block.samples, expected)
+            self.assertEqual(block.samples.dtype, np.int32)
+            self.assertFalse(block.samples.flags.writeable)
+            block.release()
+
+    def test_blocks_are_reused(self):
+        pool = buffer_pool.BufferPool(block_samples=10, preallocate=2)
+        first = pool.decode(make_packet(0, 10, 1))
+        first.release()
+        again = pool.decode(make_packet(10, 10, 2))
+        self.assertIs(again, first)
+        again.release()
+        self.assertEqual((pool.hits, pool.misses, pool.in_use), (2, 0, 0))
+
+    def test_retained_block_is_not_reused(self):
+        pool = buffer_pool.BufferPool(block_samples=10, preallocate=1)
+        block = pool.decode(make_packet(0, 10, 1))
+        block.retain()
+        block.release()  # Still held by the retain
+        other = pool.decode(make_packet(10, 10, 2))
+        self.assertIsNot(other, block)
+        self.assertEqual(pool.misses, 1)  # The only free block was taken
+        self.assertEqual(block.samples[0, 0], 1)
+        block.release()
+        other.release()
+        self.assertEqual(pool.in_use, 0)
+        self.assertEqual(pool.peak_in_use, 2)
+        with self.assertRaises(AssertionError):
+            block.release()
+
+    def test_oversize_packet_is_a_miss(self):
+        pool = buffer_pool.BufferPool(block_samples=10, preallocate=1)
+        block = pool.decode(make_packet(0, 30, 5))
+        self.assertEqual(block.samples.shape, (30, 4))
+        block.release()
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+        self.assertEqual(pool.stats()["free"], 1)  # The odd size isn't kept
+
+    def test_feed_session(self):
+        pool = buffer_pool.BufferPool(block_samples=20, preallocate=2)
+        metrics = pipeline_metrics.PipelineMetrics()
+        blocks = BlockCollector()
+        feeddatas = RecordingCallback()
+        packets = [make_packet(i * 20, 20, i) for i in range(10)]
+        packets.append(make_packet(220, 20, 10))  # 20 samples dropped
+        session = run_session(packets, [blocks, feeddatas], pool=pool, metrics=metrics)
+
+        self.assertIs(session.pool, pool)
+        self.assertEqual(
+            [c[0] for c in blocks.calls], [i * 20 for i in range(10)] + [220]
+        )
+        self.assertEqual(blocks.calls[-1][2], 20)
+        for i, (_, samples, _) in enumerate(blocks.calls):
+            self.assertTrue((samples == i).all())
+        self.assertEqual(len(feeddatas.calls), 11)  # FeedData callbacks still work
+        self.assertEqual((pool.hits, pool.misses, pool.peak_in_use), (11, 0, 1))
+        self.assertEqual(metrics.stages["samples:BlockCollector"].count, 11)
+        self.assertIn("dynamite_feed_pool_hits_total 11", metrics.to_prometheus())
+
+    def test_feed_session_makes_a_pool(self):
+        blocks = BlockCollector(retain=True)
+        session = run_session([make_packet(i * 5, 5, i) for i in range(3)], [blocks])
+        self.assertEqual(session.pool.in_use, 3)
+        for i, block in enumerate(blocks.blocks):
+            self.assertTrue((block.samples == i).all())
+            block.release()
+        self.assertEqual(session.pool.in_use, 0)
+
+    def test_feeddata_fallback(self):
+        blocks = BlockCollector()
+        header = ds.FeedHeader(7)
+        blocks.callback(header, [ds.FeedData(1, 2, 3, 4)], 3)
+        ssn, samples, missing = blocks.calls[0]
+        self.assertEqual((ssn, missing), (7, 3))
+        np.testing.assert_array_equal(samples, [[1, 2, 3, 4]])
+
+
+if __name__ == "__main__":
+    unittest.main()
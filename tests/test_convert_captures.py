@@ -0,0 +1,107 @@
+# Run it like so: `python -m tests.test_convert_captures`
+
+import ast
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+import convert_captures
+import dynamite_sampler_api as ds
+import recording
+import stream
+
+SAMPLE_DATA = pathlib.Path(__file__).parent.parent / "sample_data"
+
+
+class ConvertCapturesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out = pathlib.Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_sample_data_in_chunks(self):
+        paths = convert_captures.find_captures([str(SAMPLE_DATA)])
+        summaries = convert_captures.convert(
+            paths, self.out, "columnar", workers=2, chunk_bytes=64 * 1024
+        )
+        self.assertEqual(len(summaries), 2)
+        self.assertTrue((self.out / "summary.csv").exists())
+
+        dict_dump = SAMPLE_DATA / "datadump_20241212_123045.txt"
+        with open(dict_dump) as f:
+            expected = [ast.literal_eval(line) for line in f]
+        columns = np.load(self.out / "datadump_20241212_123045.npz")
+        np.testing.assert_array_equal(
+            columns["channels"], [d["channels"] for d in expected]
+        )
+        np.testing.assert_array_equal(
+            columns["status"], [d["status"] for d in expected]
+        )
+
+        int_dump = SAMPLE_DATA / "datadump_20241203_175001.txt"
+        columns = np.load(self.out / "datadump_20241203_175001.npz")
+        np.testing.assert_array_equal(
+            columns["channels"][:, 0], np.loadtxt(int_dump, dtype=np.int32)
+        )
+
+    def test_stream_csv_to_binary(self):
+        csv_path = self.out / "capture.csv"
+        sink = stream.FeedDataCSVWriter(str(csv_path))
+        sink.setup({"FirmwareRevision": "1.0"})
+        sink.callback(
+            ds.FeedHeader(10), [ds.FeedData(i, -i, 2, 3) for i in range(5)], 0
+        )
+        sink.callback(ds.FeedHeader(20), [ds.FeedData(9, 9, 9, 9)], 5)
+        sink.cleanup()
+
+        out = self.out / "converted"
+        (summary,) = convert_captures.convert([csv_path], out, "binary", workers=1)
+        self.assertEqual(summary.samples, 6)
+        self.assertEqual(summary.missing, 5)
+
+        with recording.RecordingReader(out / "capture.dynrec") as reader:
+            self.assertIn("FirmwareRevision", reader.metadata["source"])
+            ssns, samples = reader.read()
+        np.testing.assert_array_equal(ssns, [10, 11, 12, 13, 14, 20])
+        np.testing.assert_array_equal(samples[:, 1], [0, -1, -2, -3, -4, 9])
+
+    def test_merged_csv_duplicates_and_reorders(self):
+        # Overlapping captures merged into one CSV: 12 and 13 come twice, and 16
+        # arrives after 20.
+        csv_path = self.out / "merged.csv"
+        ssns = [10, 11, 12, 13, 12, 13, 15, 20, 16]
+        with open(csv_path, "w") as f:
+            f.writelines(f"{ssn},{ssn - 10},0,0,0\n" for ssn in ssns)
+
+        out = self.out / "converted"
+        (summary,) = convert_captures.convert([csv_path], out, "binary", workers=1)
+        self.assertEqual(summary.missing, 5)  # 14, and 16-19 before 16 arrived late
+
+        with recording.RecordingReader(out / "merged.dynrec") as reader:
+            ssns, samples = reader.read()
+        np.testing.assert_array_equal(ssns, [10, 11, 12, 13, 15, 20])
+        np.testing.assert_array_equal(samples[:, 0], [0, 1, 2, 3, 5, 10])
+
+    def test_csv_gap_longer_than_ssn_cycle(self):
+        # stream.py CSVs have unwrapped SSNs, a gap over 2**16 samples is kept as is.
+        csv_path = self.out / "outage.csv"
+        ssns = [100000, 100001, 170000, 170001]
+        with open(csv_path, "w") as f:
+            f.writelines(f"{ssn},{i},0,0,0\n" for i, ssn in enumerate(ssns))
+
+        out = self.out / "converted"
+        (summary,) = convert_captures.convert([csv_path], out, "binary", workers=1)
+        self.assertEqual(summary.missing, 69998)
+
+        with recording.RecordingReader(out / "outage.dynrec") as reader:
+            read_ssns, samples = reader.read()
+        np.testing.assert_array_equal(read_ssns, ssns)
+        np.testing.assert_array_equal(samples[:, 0], [0, 1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
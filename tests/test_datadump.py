@@ -0,0 +1,77 @@
+# Run it like so: `python -m tests.test_datadump`
+
+import ast
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+import datadump
+
+SAMPLE_DATA = pathlib.Path(__file__).parent.parent / "sample_data"
+DICT_DUMP = SAMPLE_DATA / "datadump_20241212_123045.txt"
+INT_DUMP = SAMPLE_DATA / "datadump_20241203_175001.txt"
+
+
+class DatadumpTest(unittest.TestCase):
+    def test_dict_layout_matches_literal_eval(self):
+        with open(DICT_DUMP) as f:
+            expected = [ast.literal_eval(line) for line in f]
+        # Small odd chunks, so lines get cut at every position.
+        for chunk_bytes in (997, 2**20):
+            dump = datadump.read_datadump(DICT_DUMP, chunk_bytes)
+            np.testing.assert_array_equal(
+                dump.channels, [d["channels"] for d in expected]
+            )
+            np.testing.assert_array_equal(dump.status, [d["status"] for d in expected])
+            np.testing.assert_array_equal(dump.crc, [d["crc"] for d in expected])
+            self.assertEqual(dump.channels.dtype, np.int32)
+
+    def test_int_layout(self):
+        dump = datadump.read_datadump(INT_DUMP, 1000)
+        with open(INT_DUMP) as f:
+            expected = [int(line) for line in f if line.strip()]
+        np.testing.assert_array_equal(dump.channels[:, 0], expected)
+        self.assertIsNone(dump.status)
+        self.assertEqual(list(dump.columns()), ["channels"])
+
+    def test_unusual_lines_fall_back(self):
+        b = (
+            b"{'status': 1, 'channels': [1, -2, 3, 4], 'crc': 0}\n"
+            b"\n"
+            b"# comment 123\n"
+            b"{'crc': 7, 'channels': [5, 6, 7, -8], 'status': 2}\n"
+        )
+        dump = datadump.parse_bytes(b, datadump.LAYOUT_DICT)
+        np.testing.assert_array_equal(dump.channels, [[1, -2, 3, 4], [5, 6, 7, -8]])
+        np.testing.assert_array_equal(dump.status, [1, 2])
+        np.testing.assert_array_equal(dump.crc, [0, 7])
+
+    def test_reordered_keys_fall_back(self):
+        # Same number count per line as the usual lines, but not in the same order.
+        b = (
+            b"{'status': 1, 'channels': [1, -2, 3, 4], 'crc': 0}\n"
+            b"{'crc': 7, 'channels': [5, 6, 7, -8], 'status': 2}\n"
+        )
+        dump = datadump.parse_bytes(b, datadump.LAYOUT_DICT)
+        np.testing.assert_array_equal(dump.channels, [[1, -2, 3, 4], [5, 6, 7, -8]])
+        np.testing.assert_array_equal(dump.status, [1, 2])
+        np.testing.assert_array_equal(dump.crc, [0, 7])
+
+    def test_numbers_in_other_lines_dont_shift_channels(self):
+        # The comment's number makes up for the missing channel in the total count.
+        b = b"# comment 2\n{'status': 1, 'channels': [5, 6, 7], 'crc': 0}\n"
+        with self.assertRaises(ValueError):
+            datadump.parse_bytes(b, datadump.LAYOUT_DICT)
+
+    def test_not_a_datadump(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "notes.txt"
+            path.write_text("hello\n")
+            with self.assertRaises(ValueError):
+                datadump.read_datadump(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+# Run it like so: `python -m tests.test_dynamite_sampler_api`
+
+import dataclasses
+import random
+import unittest
+
+import dynamite_sampler_api as ds
+
+ADCFeed = ds.DynamiteSampler.ADCFeed
+
+
+def random_packet(ssn: int, n_samples: int, rng: random.Random) -> bytearray:
+    values = [rng.randint(-(2**23), 2**23 - 1) for _ in range(n_samples * 4)]
+    if n_samples:
+        values[:4] = [-(2**23), 2**23 - 1, -1, 0]  # The edges of the 24-bit range
+    samples = b"".join(v.to_bytes(3, "little", signed=True) for v in values)
+    return bytearray(ssn.to_bytes(2, "little") + samples)
+
+
+def unpack_per_sample(b: bytearray) -> ds.FeedPacket:
+    """Reference: int.from_bytes on every sample slice, the original implementation."""
+    header = ds.FeedHeader(int.from_bytes(b[0:2], "little", signed=False))
+    samples = [ADCFeed._unpack_single(b[i : i + 12]) for i in range(2, len(b), 12)]
+    return ds.FeedPacket(header, samples)
+
+
+class ADCFeedTest(unittest.TestCase):
+    def test_unpack_matches_per_sample(self):
+        rng = random.Random(0)
+        for n_samples in (0, 1, 2, 20, 41):
+            packet = random_packet(rng.randrange(2**16), n_samples, rng)
+            with self.subTest(n_samples=n_samples):
+                self.assertEqual(ADCFeed.unpack(packet), unpack_per_sample(packet))
+
+    def test_unpack_buffer_types(self):
+        packet = random_packet(65535, 5, random.Random(1))
+        expected = unpack_per_sample(packet)
+        for b in (bytes(packet), packet, memoryview(packet)):
+            with self.subTest(type=type(b).__name__):
+                self.assertEqual(ADCFeed.unpack(b), expected)
+
+    def test_unpack_values(self):
+        packet = random_packet(3, 2, random.Random(2))
+        values = ADCFeed.unpack_values(packet)
+        samples = unpack_per_sample(packet).samples
+        self.assertEqual(
+            values, tuple(v for d in samples for v in dataclasses.astuple(d))
+        )
+
+    def test_bad_length(self):
+        with self.assertRaises(AssertionError):
+            ADCFeed.unpack(bytes(2 + 12 + 5))
+        with self.assertRaises(AssertionError):
+            ADCFeed.unpack(bytes(1))
+
+    def test_feed_types_have_slots(self):
+        data = ds.FeedData(1, 2, 3, 4)
+        self.assertFalse(hasattr(data, "__dict__"))
+        with self.assertRaises(AttributeError):
+            data.ch4 = 5
+        self.assertFalse(hasattr(ds.FeedHeader(0), "__dict__"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# Run it like so: `python -m tests.test_feed_arrays`
+
+import unittest
+
+import numpy as np
+
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+from feed_arrays import GapFiller, unwrap_ssns
+
+
+def scalar_unwrap(raw_ssns, n_samples):
+    unwrapper = dsbu.SsnUnwrapper()
+    ssns, missing = [], []
+    for ssn, n in zip(raw_ssns, n_samples):
+        packet = ds.FeedPacket(ds.FeedHeader(ssn), [None] * n)
+        missing.append(unwrapper.unwrap_and_modify(packet))
+        ssns.append(packet.header.sample_sequence_number)
+    return ssns, missing
+
+
+class UnwrapSsnsTest(unittest.TestCase):
+    def test_matches_ssn_unwrapper(self):
+        rng = np.random.default_rng(0)
+        n_samples = rng.integers(1, 20, 5000)
+        gaps = np.where(rng.random(5000) < 0.05, rng.integers(1, 3000, 5000), 0)
+        gaps[0] = 0
+        starts = 65000 + np.cumsum(gaps + np.concatenate(([0], n_samples[:-1])))
+        raw = starts % 2**16  # Wraps around several times
+
+        expected_ssns, expected_missing = scalar_unwrap(raw, n_samples)
+
+        result = unwrap_ssns(raw, n_samples)
+        np.testing.assert_array_equal(result.ssns, expected_ssns)
+        np.testing.assert_array_equal(result.missing, expected_missing)
+        self.assertFalse(result.duplicate.any() or result.reordered.any())
+
+        # The same stream split in batches.
+        expected = None
+        for start in range(0, len(raw), 333):
+            batch = unwrap_ssns(
+                raw[start : start + 333], n_samples[start : start + 333], expected
+            )
+            np.testing.assert_array_equal(
+                batch.ssns, expected_ssns[start : start + 333]
+            )
+            expected = batch.next_expected
+
+    def test_duplicates_and_reorders(self):
+        # The second 65530 is a duplicate, 15 follows a 10 sample gap that 5 (late)
+        # partly fills, and 30 follows a 5 sample gap.
+        raw = [65520, 65530, 65530, 4, 15, 5, 30]
+        result = unwrap_ssns(raw, [10, 10, 10, 1, 10, 5, 10])
+        np.testing.assert_array_equal(
+            result.ssns, [65520, 65530, 65530, 65540, 65551, 65541, 65566]
+        )
+        np.testing.assert_array_equal(result.missing, [0, 0, 0, 0, 10, 0, 5])
+        np.testing.assert_array_equal(
+            result.duplicate, [False, False, True, False, False, False, False]
+        )
+        np.testing.assert_array_equal(
+            result.reordered, [False, False, False, False, False, True, False]
+        )
+        self.assertEqual(result.next_expected, 65576)
+
+    def test_empty(self):
+        self.assertIsNone(unwrap_ssns([], 10).next_expected)
+        result = unwrap_ssns([], 10, expected=42)
+        self.assertEqual(result.next_expected, 42)
+        self.assertEqual(result.total_missing, 0)
+
+
+class GapFillerTest(unittest.TestCase):
+    first = np.array([[10, 20, 30, 40]])
+    second = np.array([[50, 60, 70, 80], [51, 61, 71, 81]])
+
+    def fill_gap(self, policy, missing=3):
+        filler = GapFiller(policy)
+        filler.fill(self.first, 0)
+        return filler.fill(self.second, missing)
+
+    def test_policies(self):
+        expected_fill = {
+            "zero": [[0, 0, 0, 0]] * 3,
+            "hold": [[10, 20, 30, 40]] * 3,
+            "linear": [[20, 30, 40, 50], [30, 40, 50, 60], [40, 50, 60, 70]],
+        }
+        for policy, fill in expected_fill.items():
+            with self.subTest(policy=policy):
+                batch = self.fill_gap(policy)
+                np.testing.assert_array_equal(batch.data[:3], fill)
+                np.testing.assert_array_equal(batch.data[3:], self.second)
+                np.testing.assert_array_equal(batch.valid, [False] * 3 + [True] * 2)
+                self.assertEqual(batch.gap, 3)
+
+    def test_nan_and_skip(self):
+        batch = self.fill_gap("nan")
+        self.assertTrue(np.isnan(batch.data[:3]).all())
+        np.testing.assert_array_equal(batch.data[3:], self.second)
+
+        batch = self.fill_gap("skip")
+        np.testing.assert_array_equal(batch.data, self.second)
+        self.assertTrue(batch.valid.all())
+        self.assertEqual(batch.gap, 3)
+
+    def test_no_gap(self):
+        batch = self.fill_gap("linear", missing=0)
+        np.testing.assert_array_equal(batch.data, self.second)
+        self.assertTrue(batch.valid.all())
+
+
+if __name__ == "__main__":
+    unittest.main()
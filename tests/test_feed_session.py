@@ -1,9 +1,12 @@
 # Run it like so: `python -m tests.test_feed_session`
 
 import asyncio
+import contextlib
+import io
 import unittest
 
 import dynamite_sampler_bleak_util as dsbu
+import pipeline_metrics
 
 # Don't wait a second per poll cycle in tests.
 dsbu._DISCONNECT_POLL_S = 0.01
@@ -23,6 +26,54 @@ class FakeClient:
         pass
 
 
+def make_packet(ssn: int, n_samples: int, value: int = 0) -> bytearray:
+    """Raw ADC feed notification with every channel of every sample set to value."""
+    sample = value.to_bytes(3, "little", signed=True) * 4
+    return bytearray(ssn.to_bytes(2, "little") + sample * n_samples)
+
+
+class RecordingCallback(dsbu.NotifyCallbackFeeddatas):
+    def __init__(self):
+        self.calls = []
+
+    def callback(self, header, feeddatas, missing):
+        self.calls.append((header.sample_sequence_number, len(feeddatas), missing))
+
+
+class SlowAsyncSink(dsbu.AsyncNotifyCallbackFeeddatas):
+    """Async sink whose callbacks each take delay_s of (simulated) I/O."""
+
+    def __init__(self, delay_s: float, max_in_flight: int = 1):
+        self.delay_s = delay_s
+        self.max_in_flight = max_in_flight
+        self.running = 0
+        self.max_running = 0
+        self.calls = []
+        self.events = []
+
+    async def setup(self, device_dict):
+        self.events.append("setup")
+
+    async def callback(self, header, feeddatas, missing):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay_s)
+        self.calls.append((header.sample_sequence_number, len(feeddatas), missing))
+        self.running -= 1
+
+    async def cleanup(self):
+        self.events.append(f"cleanup after {len(self.calls)} calls")
+
+
+class FailingAsyncSink(SlowAsyncSink):
+    """Async sink whose callback raises from the second batch on."""
+
+    async def callback(self, header, feeddatas, missing):
+        if self.calls:
+            raise OSError("connection reset")
+        await super().callback(header, feeddatas, missing)
+
+
 class FeedSessionTest(unittest.TestCase):
     def test_pump_exits_on_disconnect(self):
         """A mid-stream disconnect must not leave the pump blocked on the
@@ -52,6 +103,115 @@ class FeedSessionTest(unittest.TestCase):
 
         asyncio.run(scenario())
 
+    def test_stop_while_streaming(self):
+        """stop() must return while notifications keep arriving, when the pump never
+        has to wait for one."""
+
+        async def scenario():
+            client = FakeClient()
+            session = dsbu.FeedSession(client, device_info={})
+            await session.start()
+
+            async def flood():
+                ssn = 0
+                while True:
+                    for _ in range(20):
+                        client.notify_callback(None, make_packet(ssn, 2))
+                        ssn = (ssn + 2) % 2**16
+                    await asyncio.sleep(0)
+
+            flooding = asyncio.create_task(flood())
+            await asyncio.sleep(0.05)
+            await asyncio.wait_for(session.stop(), timeout=2.0)
+            flooding.cancel()
+
+        asyncio.run(scenario())
+
+    def test_metrics(self):
+        async def scenario():
+            client = FakeClient()
+            metrics = pipeline_metrics.PipelineMetrics()
+            recorder = RecordingCallback()
+            session = dsbu.FeedSession(
+                client, (), [recorder], device_info={}, metrics=metrics
+            )
+            await session.start()
+            client.notify_callback(None, make_packet(0, 10))
+            client.notify_callback(None, make_packet(15, 10))  # 5 samples dropped
+            client.is_connected = False
+            await asyncio.wait_for(session.wait_done(), timeout=1.0)
+            await session.stop()
+            return recorder, metrics
+
+        recorder, metrics = asyncio.run(scenario())
+        self.assertEqual(recorder.calls, [(0, 10, 0), (15, 10, 5)])
+        self.assertEqual(metrics.packets, 2)
+        self.assertEqual(metrics.samples, 20)
+        self.assertEqual(metrics.missed_samples, 5)
+        self.assertEqual(metrics.stages["feeddata:RecordingCallback"].count, 2)
+        self.assertEqual(metrics.stages["queue_wait"].count, 2)
+        self.assertIn("dynamite_feed_missed_samples_total 5", metrics.to_prometheus())
+
+    def test_async_callbacks(self):
+        async def scenario(max_in_flight):
+            client = FakeClient()
+            metrics = pipeline_metrics.PipelineMetrics()
+            sink = SlowAsyncSink(0.02, max_in_flight)
+            recorder = RecordingCallback()
+            session = dsbu.FeedSession(
+                client, (), [sink, recorder], device_info={}, metrics=metrics
+            )
+            await session.start()
+            for i in range(6):
+                client.notify_callback(None, make_packet(i * 10, 10))
+            # The pump runs until the slow sink has max_in_flight batches running,
+            # then waits for it (the sync sink gets the next batch first).
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(recorder.calls), max_in_flight + 1)
+            client.is_connected = False
+            await asyncio.wait_for(session.wait_done(), timeout=2.0)
+            await session.stop()
+            return sink, metrics
+
+        sink, metrics = asyncio.run(scenario(1))
+        self.assertEqual(sink.max_running, 1)
+        self.assertEqual([c[0] for c in sink.calls], [0, 10, 20, 30, 40, 50])
+        self.assertEqual(sink.events, ["setup", "cleanup after 6 calls"])
+        self.assertEqual(metrics.stages["async_feeddata:SlowAsyncSink"].count, 6)
+
+        sink, _ = asyncio.run(scenario(3))
+        self.assertEqual(sink.max_running, 3)
+        self.assertEqual(sorted(c[0] for c in sink.calls), [0, 10, 20, 30, 40, 50])
+
+    def test_failing_async_sink_is_disabled(self):
+        async def scenario():
+            client = FakeClient()
+            failing = FailingAsyncSink(0)
+            healthy = SlowAsyncSink(0)
+            recorder = RecordingCallback()
+            session = dsbu.FeedSession(
+                client, (), [failing, healthy, recorder], device_info={}
+            )
+            await session.start()
+            for i in range(5):
+                client.notify_callback(None, make_packet(i * 10, 10))
+                await asyncio.sleep(0.005)
+            client.is_connected = False
+            await asyncio.wait_for(session.wait_done(), timeout=1.0)
+            failing_sink, _ = session._async_feeddata
+            await session.stop()
+            return failing, failing_sink, healthy, recorder
+
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            failing, failing_sink, healthy, recorder = asyncio.run(scenario())
+        self.assertEqual(len(recorder.calls), 5)
+        self.assertEqual(len(healthy.calls), 5)
+        self.assertEqual(len(failing.calls), 1)
+        self.assertIsInstance(failing_sink.error, OSError)
+        self.assertEqual(failing_sink.skipped, 3)
+        self.assertEqual(failing.events[-1], "cleanup after 1 calls")
+        self.assertIn("3 batches skipped", out.getvalue())
+
 
 if __name__ == "__main__":
     unittest.main()
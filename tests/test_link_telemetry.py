@@ -0,0 +1,161 @@
+# Run it like so: `python -m tests.test_link_telemetry`
+
+import asyncio
+import math
+import pathlib
+import tempfile
+import unittest
+
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+import link_telemetry
+import pipeline
+import pipeline_metrics
+import stream
+from tests.test_feed_session import FakeClient, make_packet
+
+MS = 1_000_000
+
+
+def connection_events(intervals_ms, packets_per_event, spacing_ms=0.2):
+    """Arrival stamps of bursts of notifications, starting at 1 s."""
+    stamps = []
+    t = 1000 * MS
+    for interval_ms, n in zip(intervals_ms, packets_per_event):
+        stamps += [t + int(i * spacing_ms * MS) for i in range(n)]
+        t += int(interval_ms * MS)
+    return stamps
+
+
+class LinkTelemetryTest(unittest.TestCase):
+    def test_interval_jitter_and_bursts(self):
+        telemetry = link_telemetry.LinkTelemetry(window_s=10)
+        intervals = [7.5, 8.5] * 50
+        bursts = [3, 1, 2, 3] * 25
+        for ssn, stamp in enumerate(connection_events(intervals, bursts)):
+            telemetry.record(ssn * 10, stamp, 10, 0, stamp + MS)
+        telemetry.flush()
+
+        self.assertEqual(telemetry.packets, 225)
+        self.assertAlmostEqual(telemetry.interval_ms, 8.0, places=1)
+        self.assertAlmostEqual(telemetry.jitter_ms, 0.5, places=1)
+        self.assertEqual(telemetry.burst_sizes, {1: 25, 2: 25, 3: 50})
+        self.assertAlmostEqual(telemetry.packets_per_interval, 2.25)
+        self.assertEqual(telemetry.queue_wait.max_ns, MS)
+
+        (window,) = telemetry.windows
+        self.assertEqual(
+            (window.packets, window.bursts, window.max_burst), (225, 100, 3)
+        )
+        self.assertAlmostEqual(window.interval_ms, 8.0, places=1)
+        self.assertAlmostEqual(window.jitter_ms, 0.5, places=1)
+        self.assertAlmostEqual(window.queue_wait_ms, 1.0)
+
+    def test_missed_rate_per_window(self):
+        telemetry = link_telemetry.LinkTelemetry(window_s=1.0)
+        stamps = connection_events([10] * 300, [1] * 300)  # 3 s, 1 packet per event
+        for i, stamp in enumerate(stamps):
+            missed = 10 if 100 <= i < 200 and i % 10 == 0 else 0
+            telemetry.record(i * 10, stamp, 10, missed)
+        telemetry.flush()
+
+        self.assertEqual(telemetry.windows_closed, 3)
+        rates = [window.missed_rate for window in telemetry.windows]
+        self.assertEqual(rates[0], 0.0)
+        self.assertAlmostEqual(rates[1], 100 / 1100)
+        self.assertEqual(rates[2], 0.0)
+        self.assertEqual([w.t_s for w in telemetry.windows], [0.0, 1.0, 2.0])
+        self.assertTrue(math.isnan(telemetry.windows[0].queue_wait_ms))
+        self.assertAlmostEqual(telemetry.missed_rate, 100 / 3100)
+
+    def test_link_log(self):
+        telemetry = link_telemetry.LinkTelemetry(window_s=0.05)
+        for i, stamp in enumerate(connection_events([10] * 20, [2] * 20)):
+            telemetry.record(i, stamp, 10, 0)
+        telemetry.flush()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = link_telemetry.link_log_path(pathlib.Path(tmp) / "a.dynrec")
+            self.assertEqual(path.name, "a.link.jsonl")
+            link_telemetry.write_link_log(path, telemetry.windows)
+            rows = link_telemetry.read_link_log(path)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(sum(row["packets"] for row in rows), 40)
+        self.assertEqual(rows[0]["max_burst"], 2)
+
+
+class LinkTelemetrySink(dsbu.NotifyCallbackFeeddatas):
+    def __init__(self):
+        self.link_telemetry = None
+        self.arrivals = []
+
+    def callback(self, header, feeddatas, missing):
+        self.arrivals.append(header.arrival_ns)
+
+
+class FeedSessionLinkTelemetryTest(unittest.TestCase):
+    def test_stamps_and_telemetry(self):
+        async def scenario(tmp):
+            client = FakeClient()
+            sink = LinkTelemetrySink()
+            threaded = pipeline.ThreadedCallback(LinkTelemetrySink())
+            recorder = stream.FeedDataRecorder(str(pathlib.Path(tmp) / "c.dynrec"))
+            metrics = pipeline_metrics.PipelineMetrics()
+            adc_config = ds.ADCConfigData(4, "HIGH_RESOLUTION", 1000, [1, 1, 1, 1])
+            session = dsbu.FeedSession(
+                client,
+                callbacks_feeddata=[sink, threaded, recorder],
+                device_info={"ADCConfig": adc_config},
+                metrics=metrics,
+            )
+            await session.start()
+            for i in range(20):
+                client.notify_callback(None, make_packet(i * 10 + (i >= 10) * 5, 10))
+            while session.telemetry.packets < 20:
+                await asyncio.sleep(0.001)
+            await session.stop()
+            return session, sink, threaded, recorder, metrics
+
+        with tempfile.TemporaryDirectory() as tmp:
+            session, sink, threaded, recorder, metrics = asyncio.run(scenario(tmp))
+            rows = link_telemetry.read_link_log(recorder.link_log_path)
+
+        telemetry = session.telemetry
+        self.assertIs(sink.link_telemetry, telemetry)
+        self.assertIs(threaded.sink.link_telemetry, telemetry)
+        self.assertIs(recorder.link_telemetry, telemetry)
+        self.assertIs(metrics.link_telemetry, telemetry)
+
+        self.assertEqual(len(sink.arrivals), 20)
+        self.assertEqual(sink.arrivals, sorted(sink.arrivals))
+        self.assertEqual((telemetry.samples, telemetry.missed_samples), (200, 5))
+        self.assertEqual(telemetry.queue_wait.count, 20)
+        self.assertEqual(sum(row["packets"] for row in rows), 20)
+        self.assertIn("link: interval", metrics.to_text())
+
+    def test_telemetry_is_opt_in(self):
+        class ArrivalSink(dsbu.NotifyCallbackFeeddatas):
+            def __init__(self):
+                self.arrivals = []
+
+            def callback(self, header, feeddatas, missing):
+                self.arrivals.append(header.arrival_ns)
+
+        async def scenario():
+            client = FakeClient()
+            sink = ArrivalSink()
+            session = dsbu.FeedSession(client, (), [sink], device_info={})
+            await session.start()
+            for i in range(5):
+                client.notify_callback(None, make_packet(i * 10, 10))
+            while len(sink.arrivals) < 5:
+                await asyncio.sleep(0.001)
+            await session.stop()
+            return session, sink
+
+        session, sink = asyncio.run(scenario())
+        self.assertIsNone(session.telemetry)
+        self.assertTrue(all(stamp > 0 for stamp in sink.arrivals))  # Still stamped
+
+
+if __name__ == "__main__":
+    unittest.main()
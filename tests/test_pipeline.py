@@ -0,0 +1,279 @@
+# Run it like so: `python -m tests.test_pipeline`
+
+import csv
+import pathlib
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+import pipeline
+
+
+def batches(samples: np.ndarray, first_ssn: int = 0, size: int = 10):
+    """(header, feeddatas, missing) batches of the samples."""
+    for start in range(0, len(samples), size):
+        feeddatas = [ds.FeedData(*row) for row in samples[start : start + size]]
+        yield ds.FeedHeader(first_ssn + start), feeddatas, 0
+
+
+class CollectSink(dsbu.NotifyCallbackFeeddatas):
+    def setup(self, device_dict):
+        self.device_dict = device_dict
+        self.calls = []
+
+    def callback(self, header, feeddatas, missing):
+        rows = [(d.ch0, d.ch1, d.ch2, d.ch3) for d in feeddatas]
+        self.calls.append((header.sample_sequence_number, rows, missing))
+
+    def samples(self) -> np.ndarray:
+        return np.array([row for _, rows, _ in self.calls for row in rows])
+
+
+pipeline.register("collect", CollectSink)
+
+
+class BlockedSink(CollectSink):
+    """Blocks in its first callback until released, like a stalled network drive."""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def callback(self, header, feeddatas, missing):
+        self.release.wait()
+        super().callback(header, feeddatas, missing)
+
+
+def run(callbacks, samples, device_dict=None, **batch_kwargs):
+    for cb in callbacks:
+        cb.setup(device_dict or {})
+    for args in batches(samples, **batch_kwargs):
+        for cb in callbacks:
+            cb.callback(*args)
+    for cb in callbacks:
+        cb.cleanup()
+
+
+class ProcessorTest(unittest.TestCase):
+    def test_moving_average(self):
+        x = np.random.default_rng(0).integers(-1000, 1000, (100, 4))
+        sink = CollectSink()
+        run([pipeline.StageNode("ma", pipeline.MovingAverage(5), [sink])], x)
+        padded = np.concatenate([np.repeat(x[:1], 4, axis=0), x])
+        expected = np.stack(
+            [np.convolve(padded[:, ch], np.ones(5) / 5, "valid") for ch in range(4)], 1
+        )
+        np.testing.assert_array_equal(sink.samples(), np.rint(expected))
+
+    def test_decimate_across_batches_and_gaps(self):
+        decimate = pipeline.Decimate(4)
+        adc_config = ds.ADCConfigData(4, "high", 32000, [1, 1, 1, 1])
+        device_dict = decimate.setup({"ADCConfig": adc_config})
+        self.assertEqual(device_dict["ADCConfig"].sample_rate, 8000)
+        self.assertEqual(adc_config.sample_rate, 32000)
+
+        x = np.arange(40 * 4).reshape(40, 4)
+        out = [decimate.process(*args) for args in batches(x, first_ssn=2, size=3)]
+        out = [o for o in out if o is not None]
+        # SSNs 2..41: the first full block is 4..7, the last 36..39.
+        self.assertEqual(out[0][0].sample_sequence_number, 1)
+        samples = [(d.ch0, d.ch1, d.ch2, d.ch3) for o in out for d in o[1]]
+        np.testing.assert_array_equal(samples, x[2:38].reshape(9, 4, 4).mean(axis=1))
+
+        # A gap of 10 samples after SSN 41 skips blocks 10 to 12 (40..51)
+        header, feeddatas, missing = decimate.process(
+            ds.FeedHeader(52), [ds.FeedData(1, 1, 1, 1)] * 8, 10
+        )
+        self.assertEqual((header.sample_sequence_number, missing), (13, 3))
+        self.assertEqual(len(feeddatas), 2)  # 52..55 and 56..59
+
+
+class FanOutTest(unittest.TestCase):
+    def test_slow_sink_only_hurts_itself(self):
+        fast, slow = CollectSink(), BlockedSink()
+        _, (fast_cb, slow_cb) = pipeline.fan_out([], [fast, slow], queue_size=8)
+        fast_cb.setup({})
+        slow_cb.setup({})
+
+        # Would never return if the slow sink held up the pump.
+        for args in batches(np.arange(100 * 4).reshape(100, 4)):
+            fast_cb.callback(*args)
+            slow_cb.callback(*args)
+            while fast_cb.stats()["queued"] or slow_cb.stats()["batches"] == 0:
+                pass  # The fast sink keeps up, the slow one is stuck in batch 0
+        slow.release.set()
+        fast_cb.cleanup()
+        slow_cb.cleanup()
+
+        self.assertEqual(fast_cb.dropped_batches, 0)
+        self.assertEqual(len(fast.calls), 10)
+        # The slow one got the batch it blocked in and the 8 queued after it.
+        self.assertEqual(slow_cb.dropped_batches, 1)
+        self.assertEqual(slow_cb.dropped_samples, 10)
+        self.assertEqual([ssn for ssn, _, _ in slow.calls], list(range(0, 90, 10)))
+        self.assertGreater(slow_cb.max_lag_s, fast_cb.max_lag_s)
+
+    def test_drops_become_missing(self):
+        slow = BlockedSink()
+        cb = pipeline.ThreadedCallback(slow, queue_size=1, overflow="drop")
+        cb.setup({})
+        sent = list(batches(np.zeros((40, 4), dtype=np.int32)))
+        cb.callback(*sent[0])  # Taken by the worker, which blocks
+        while cb.stats()["batches"] == 0:
+            pass
+        cb.callback(*sent[1])  # Queued
+        cb.callback(*sent[2])  # Dropped
+        slow.release.set()
+        while cb.stats()["queued"]:
+            pass
+        cb.callback(*sent[3])
+        cb.cleanup()
+        self.assertEqual(
+            [(ssn, missing) for ssn, _, missing in slow.calls],
+            [(0, 0), (10, 0), (30, 10)],
+        )
+
+    def test_batches_are_shared(self):
+        seen = []
+
+        class Sink(dsbu.NotifyCallbackFeeddatas):
+            def callback(self, header, feeddatas, missing):
+                seen.append(feeddatas)
+
+        _, cbs = pipeline.fan_out([], [Sink(), Sink()])
+        for cb in cbs:
+            cb.setup({})
+        feeddatas = [ds.FeedData(1, 2, 3, 4)]
+        for cb in cbs:
+            cb.callback(ds.FeedHeader(0), feeddatas, 0)
+        for cb in cbs:
+            cb.cleanup()
+        self.assertTrue(all(f is feeddatas for f in seen))
+
+
+class PipelineConfigTest(unittest.TestCase):
+    def test_stages_and_taps(self):
+        config = {
+            "stages": [
+                {"name": "decim", "type": "decimate", "args": {"factor": 2}},
+                {"name": "ma", "type": "moving_average", "args": {"length": 1}},
+            ],
+            "sinks": [
+                {"type": "collect", "after": "decode", "placement": "thread"},
+                {"type": "collect", "after": "decim"},
+                {"type": "collect", "placement": "thread", "batch_size": 8},
+                {"type": "metrics"},
+            ],
+        }
+        callbacks_raw, callbacks_feeddata = pipeline.build_pipeline(config)
+        self.assertEqual(len(callbacks_raw), 1)
+        self.assertEqual(len(callbacks_feeddata), 2)  # Decode tap and the chain
+        raw_tap, chain = callbacks_feeddata[0].sink, callbacks_feeddata[1]
+        decim_tap = chain.downstream[0]
+        end_tap = chain.downstream[1].downstream[0].sink
+
+        x = np.arange(100 * 4).reshape(100, 4)
+        run(callbacks_feeddata, x)
+        np.testing.assert_array_equal(raw_tap.samples(), x)
+        decimated = x.reshape(50, 2, 4).mean(axis=1)
+        np.testing.assert_array_equal(decim_tap.samples(), decimated)
+        np.testing.assert_array_equal(end_tap.samples(), decimated)
+        # Consecutive queued batches get merged, never more than batch_size of them.
+        self.assertLessEqual(len(end_tap.calls), 10)
+        self.assertTrue(all(len(rows) <= 8 * 5 for _, rows, _ in end_tap.calls))
+
+    def test_process_placement(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "decimated.csv"
+            config = {
+                "stages": [
+                    {
+                        "name": "decim",
+                        "type": "decimate",
+                        "args": {"factor": 10},
+                        "placement": "process",
+                        "batch_size": 4,
+                    }
+                ],
+                "sinks": [{"type": "csv", "args": {"file_path_str": str(path)}}],
+            }
+            _, callbacks = pipeline.build_pipeline(config)
+            run(callbacks, np.ones((200, 4), dtype=np.int32), first_ssn=100)
+
+            with open(path) as f:
+                rows = [row for row in csv.reader(f) if row[0].isdigit()]
+        self.assertEqual([int(r[0]) for r in rows], list(range(10, 30)))
+        self.assertTrue(all(r[1:] == ["1"] * 4 for r in rows))
+
+    def test_bad_configs(self):
+        bad = [
+            {"stages": [{"type": "decimate"}]},
+            {"stages": [{"name": "x", "type": "csv"}]},
+            {"sinks": [{"type": "decimate"}]},
+            {"sinks": [{"type": "nope"}]},
+            {"sinks": [{"type": "csv", "after": "nope"}]},
+            {"sinks": [{"type": "csv", "placement": "gpu"}]},
+            {"sinks": [{"type": "csv", "queue_size": 0}]},
+            {
+                "stages": [{"name": "d", "type": "decimate"}],
+                "sinks": [{"type": "metrics", "after": "d"}],
+            },
+            {"sinks": [{"type": "socket", "placement": "process"}]},
+            {
+                "stages": [
+                    {"name": "p", "type": "decimate", "placement": "process"},
+                    {"name": "d", "type": "decimate"},
+                ],
+                "sinks": [{"type": "socket"}],
+            },
+            # Worker processes can't start processes of their own.
+            {
+                "stages": [
+                    {"name": "a", "type": "moving_average", "placement": "process"},
+                    {"name": "b", "type": "decimate", "placement": "process"},
+                ]
+            },
+            {
+                "stages": [{"name": "a", "type": "decimate", "placement": "process"}],
+                "sinks": [{"type": "csv", "placement": "process"}],
+            },
+            {"sink": []},
+        ]
+        for config in bad:
+            with self.subTest(config=config), self.assertRaises(ValueError):
+                pipeline.check_config(config)
+
+    def test_cli_only_imports_the_selected_sinks(self):
+        probe = (
+            "import runpy, sys\n"
+            "sys.argv = ['stream.py', *sys.argv[1:]]\n"
+            "try:\n"
+            "    runpy.run_path('stream.py', run_name='__main__')\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(*sorted(m for m in OPTIONAL if m in sys.modules))\n"
+        )
+        optional = ["link_telemetry", "query_service", "rotation"]
+
+        def imported(*args):
+            out = subprocess.run(
+                [sys.executable, "-c", f"OPTIONAL = {optional}\n" + probe, *args],
+                cwd=pathlib.Path(__file__).parent.parent,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            return [m for m in out.stdout.splitlines()[-1].split() if m in optional]
+
+        self.assertEqual(imported("--help"), [])
+        # The unknown flag stops it after --serve was parsed, and the sink built.
+        self.assertEqual(imported("--serve", "--no-such-flag"), ["query_service"])
+
+
+if __name__ == "__main__":
+    unittest.main()
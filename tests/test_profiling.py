@@ -0,0 +1,103 @@
+# Run it like so: `python -m tests.test_profiling`
+
+import asyncio
+import pstats
+import tempfile
+import time
+import unittest
+
+import dynamite_sampler_bleak_util as dsbu
+import profiling
+from tests.test_feed_session import FakeClient, RecordingCallback, make_packet
+
+# Don't wait a second per poll cycle in tests.
+dsbu._DISCONNECT_POLL_S = 0.01
+
+
+class StageLog(profiling.ProfilerHook):
+    def __init__(self):
+        self.events = []
+
+    def start(self, stage):
+        self.events.append(("start", stage))
+
+    def stop(self, stage):
+        self.events.append(("stop", stage))
+
+
+class SlowCallback(RecordingCallback):
+    """Takes long enough for the sampling profiler to catch it."""
+
+    def callback(self, header, feeddatas, missing):
+        time.sleep(0.005)
+        super().callback(header, feeddatas, missing)
+
+
+def run_session(profiler, packets, callback=None):
+    async def scenario():
+        client = FakeClient()
+        session = dsbu.FeedSession(
+            client,
+            (),
+            [callback or RecordingCallback()],
+            device_info={},
+            profiler=profiler,
+        )
+        await session.start()
+        for packet in packets:
+            client.notify_callback(None, packet)
+        client.is_connected = False
+        await asyncio.wait_for(session.wait_done(), timeout=1.0)
+        await session.stop()
+
+    asyncio.run(scenario())
+
+
+class ProfilingTest(unittest.TestCase):
+    def test_hook_wraps_each_stage(self):
+        log = StageLog()
+        run_session(log, [make_packet(0, 2)])
+        stages = ["unpack", "unwrap", "feeddata:RecordingCallback"]
+        expected = [(event, s) for s in stages for event in ("start", "stop")]
+        self.assertEqual(log.events, expected)
+
+    def test_cprofile_on_demand(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = profiling.CProfileProfiler(output_dir=tmp, duration_s=0)
+            run_session(profiler, [make_packet(0, 2)])
+            self.assertIsNone(profiler.last_output)  # Not triggered, no output
+
+            profiler.trigger()
+            run_session(profiler, [make_packet(0, 2)])
+            self.assertFalse(profiler.active)
+            stats = pstats.Stats(str(profiler.last_output))
+            functions = {func for _, _, func in stats.stats}
+            self.assertIn("unpack", functions)
+
+    def test_sampling_writes_collapsed_stacks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = profiling.SamplingProfiler(output_dir=tmp, duration_s=60)
+            profiler.trigger()
+            packets = [make_packet(i * 50, 50) for i in range(20)]
+            run_session(profiler, packets, SlowCallback())
+            self.assertTrue(profiler.active)
+            profiler.finish()
+            with open(profiler.last_output) as f:
+                stacks = [line.rsplit(" ", 1) for line in f]
+        self.assertTrue(stacks)
+        for stack, count in stacks:
+            self.assertGreater(int(count), 0)
+        # Rooted at the stage, through the pump down to the sink.
+        self.assertTrue(
+            any(
+                stack.startswith("feeddata:SlowCallback;")
+                and "_pump (dynamite_sampler_bleak_util.py" in stack
+                and "callback (test_profiling.py" in stack
+                for stack, _ in stacks
+            ),
+            stacks,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
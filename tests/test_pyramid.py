@@ -0,0 +1,215 @@
+# Run it like so: `python -m tests.test_pyramid`
+
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+import pyramid
+import recording
+
+
+def brute_force(ssns, samples, starts, width, start_ssn, span):
+    """Overview of the samples, each sample going to the pixel of its bin start."""
+    pixels = np.clip((starts - start_ssn) * width // span, 0, width - 1)
+    out_min = np.zeros((width, samples.shape[1]), np.int32)
+    out_max = np.zeros((width, samples.shape[1]), np.int32)
+    out_mean = np.full((width, samples.shape[1]), np.nan)
+    count = np.zeros(width, np.int64)
+    for p in range(width):
+        rows = samples[pixels == p]
+        if len(rows):
+            out_min[p], out_max[p], out_mean[p] = rows.min(0), rows.max(0), rows.mean(0)
+            count[p] = len(rows)
+    return out_min, out_max, out_mean, count
+
+
+class PyramidTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.samples = rng.integers(-(2**23), 2**23, (5000, 4), dtype=np.int32)
+        # Two runs with 300 samples dropped in between.
+        self.ssns = np.r_[np.arange(1000, 3000), np.arange(3300, 6300)]
+
+    def build(self, batch_sizes, **kwargs) -> pyramid.Pyramid:
+        pyr = pyramid.Pyramid(base_samples=16, factor=4, n_levels=4, **kwargs)
+        pos = 0
+        for size in batch_sizes:
+            ssns = self.ssns[pos : pos + size]
+            for run in np.split(
+                np.arange(len(ssns)), np.flatnonzero(np.diff(ssns) != 1) + 1
+            ):
+                pyr.add(int(ssns[run[0]]), self.samples[pos + run])
+            pos += size
+        return pyr
+
+    def assert_overview(self, overview, expected):
+        for got, want in zip(
+            (overview.min, overview.max, overview.mean, overview.count), expected
+        ):
+            np.testing.assert_allclose(got, want)
+
+    def test_levels_match_brute_force(self):
+        pyr = self.build([5000])
+        self.assertEqual(
+            (pyr.first_ssn, pyr.end_ssn, pyr.n_samples), (1000, 6300, 5000)
+        )
+        # Aligned on the bins of each level, so every bin falls in one pixel.
+        for bin_samples, width in ((16, 320), (64, 80), (256, 20), (1024, 5)):
+            with self.subTest(bin_samples=bin_samples):
+                overview = pyr.query(1024, 6144, width)
+                self.assertEqual(overview.bin_samples, bin_samples)
+                keep = (self.ssns >= 1024) & (self.ssns < 6144)
+                starts = self.ssns[keep] // bin_samples * bin_samples
+                expected = brute_force(
+                    self.ssns[keep], self.samples[keep], starts, width, 1024, 5120
+                )
+                self.assert_overview(overview, expected)
+                self.assertEqual(overview.edges[0], 1024)
+                self.assertEqual(overview.edges[-1], 6144)
+
+    def test_gap_pixels_are_invalid(self):
+        overview = self.build([5000]).query(1024, 6144, 320)  # 16 samples per pixel
+        gap = (overview.edges[:-1] >= 3008) & (overview.edges[1:] <= 3296)
+        self.assertTrue(gap.any())
+        self.assertFalse(overview.valid[gap].any())
+        self.assertTrue(np.isnan(overview.mean[gap]).all())
+
+    def test_incremental_and_out_of_order(self):
+        expected = self.build([5000]).query(1000, 6300, 50)
+        for batch_sizes in ([7] * 714 + [2], [1, 999, 4000]):
+            overview = self.build(batch_sizes).query(1000, 6300, 50)
+            self.assert_overview(
+                overview, (expected.min, expected.max, expected.mean, expected.count)
+            )
+
+        pyr = pyramid.Pyramid(base_samples=16, factor=4, n_levels=4)
+        pyr.add(3300, self.samples[2000:])
+        pyr.add(1000, self.samples[:2000])
+        overview = pyr.query(1000, 6300, 50)
+        self.assert_overview(
+            overview, (expected.min, expected.max, expected.mean, expected.count)
+        )
+
+    def test_spilled_bins(self):
+        expected = self.build([5000])
+        for batch_sizes in ([5000], [7] * 714 + [2]):
+            pyr = self.build(batch_sizes, max_live_bins=8)
+            self.assertLessEqual(max(level.n for level in pyr.levels), 8)
+            self.assertGreater(pyr.levels[0].n_spilled, 0)
+            for start, end, width in (
+                (1000, 6300, 50),
+                (1024, 6144, 320),
+                (3000, 3400, 20),
+            ):
+                with self.subTest(
+                    batch_sizes=len(batch_sizes), start=start, width=width
+                ):
+                    overview = pyr.query(start, end, width)
+                    want = expected.query(start, end, width)
+                    self.assert_overview(
+                        overview, (want.min, want.max, want.mean, want.count)
+                    )
+
+        # Samples before the spilled bins, and saved with them.
+        pyr = pyramid.Pyramid(base_samples=16, factor=4, n_levels=4, max_live_bins=8)
+        pyr.add(3300, self.samples[2000:])
+        pyr.add(1000, self.samples[:2000])
+        want = expected.query(1000, 6300, 320)
+        with tempfile.TemporaryDirectory() as tmp:
+            pyr.save(pathlib.Path(tmp) / "p.npz")
+            loaded = pyramid.Pyramid.load(pathlib.Path(tmp) / "p.npz")
+        for got in (pyr.query(1000, 6300, 320), loaded.query(1000, 6300, 320)):
+            self.assert_overview(got, (want.min, want.max, want.mean, want.count))
+
+    def test_raw_when_zoomed_in(self):
+        pyr = self.build([5000])
+
+        def raw(start_ssn, end_ssn):
+            keep = (self.ssns >= start_ssn) & (self.ssns < end_ssn)
+            return self.ssns[keep], self.samples[keep]
+
+        overview = pyr.query(2990, 3310, 100, raw=raw)
+        self.assertEqual(overview.bin_samples, 1)
+        ssns, samples = raw(2990, 3310)
+        self.assert_overview(overview, brute_force(ssns, samples, ssns, 100, 2990, 320))
+
+        # Without raw samples level 0 is used, bounded by the number of bins.
+        overview = pyr.query(2990, 3310, 100)
+        self.assertEqual(overview.bin_samples, 16)
+        self.assertLessEqual(overview.valid.sum(), 320 // 16 + 1)
+
+    def test_recording_overview(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "capture.dynrec"
+            with recording.RecordingWriter(
+                path, chunk_samples=512, background=False
+            ) as writer:
+                writer.write(1000, self.samples[:2000])
+                self.assertEqual(writer.pyramid.n_samples, 1536)  # The full chunks
+                writer.write(3300, self.samples[2000:])
+                writer.flush()
+                self.assertEqual(writer.pyramid.n_samples, 5000)
+            self.assertTrue(pyramid.pyramid_path(path).exists())
+
+            with recording.RecordingReader(path) as reader:
+                overview = reader.overview(width=100)
+                self.assertEqual(overview.count.sum(), 5000)
+                self.assertEqual(overview.min.min(), self.samples.min())
+                self.assertEqual(overview.max.max(), self.samples.max())
+                zoomed = reader.overview(1000, 1100, width=100)
+                self.assertEqual(zoomed.bin_samples, 1)
+                np.testing.assert_array_equal(zoomed.min, self.samples[:100])
+
+            # A missing pyramid is rebuilt from the chunks.
+            pyramid.pyramid_path(path).unlink()
+            with recording.RecordingReader(path) as reader:
+                rebuilt = reader.overview(width=100)
+            self.assertEqual(rebuilt.count.tolist(), overview.count.tolist())
+
+    def test_reader_follows_a_recording_being_written(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "capture.dynrec"
+            # Without a pyramid of its own, as if written by another process.
+            with recording.RecordingWriter(
+                path, chunk_samples=500, background=False, build_pyramid=False
+            ) as writer:
+                writer.write(0, self.samples[:1000])
+                writer.flush()
+                reader = recording.RecordingReader(path)
+                self.assertEqual(len(reader.chunks), 2)
+                writer.write(1000, self.samples[1000:2000])
+                writer.flush()
+                self.assertEqual(reader.refresh(), 2)
+                pyr = reader.read_pyramid()
+                self.assertEqual(pyr.n_samples, 2000)
+
+                writer.write(2000, self.samples[2000:3000])
+                writer.flush()
+                self.assertEqual(reader.refresh(), 2)
+                self.assertEqual(reader.refresh(), 0)
+                self.assertIs(reader.read_pyramid(), pyr)  # Only the new chunks added
+                self.assertEqual(pyr.n_samples, 3000)
+                overview = reader.overview(width=100)
+                self.assertEqual(overview.max.max(), self.samples[:3000].max())
+                reader.close()
+
+    def test_save_load(self):
+        pyr = self.build([5000])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "p.npz"
+            pyr.save(path)
+            loaded = pyramid.Pyramid.load(path)
+        self.assertEqual((loaded.first_ssn, loaded.end_ssn), (1000, 6300))
+        expected = pyr.query(1000, 6300, 64)
+        self.assert_overview(
+            loaded.query(1000, 6300, 64),
+            (expected.min, expected.max, expected.mean, expected.count),
+        )
+        loaded.add(6300, self.samples[:10])  # Still growable
+        self.assertEqual(loaded.n_samples, 5010)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+# Run it like so: `python -m tests.test_query_service`
+
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+import buffer_pool
+import dynamite_sampler_api as ds
+import query_service
+import recording
+
+
+class SampleRingTest(unittest.TestCase):
+    def test_wraps_around(self):
+        ring = query_service.SampleRing(10)
+        samples = np.arange(25 * 4, dtype=np.int32).reshape(25, 4)
+        ring.append(100, samples[:7])
+        ring.append(107, samples[7:15], missing=2)
+        ssns, latest = ring.latest(100)
+        np.testing.assert_array_equal(ssns, np.arange(105, 115))
+        np.testing.assert_array_equal(latest, samples[5:15])
+        self.assertEqual(ring.extent(), (105, 115))
+
+        ring.append(200, samples[:25])  # More than the capacity
+        ssns, latest = ring.latest(3)
+        np.testing.assert_array_equal(ssns, [222, 223, 224])
+        np.testing.assert_array_equal(latest, samples[22:25])
+        self.assertEqual((ring.total, ring.total_missing), (25, 2))
+
+
+class QueryServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self.tmp.name)
+        rng = np.random.default_rng(0)
+        self.samples = rng.integers(-(2**23), 2**23, (20000, 4), dtype=np.int32)
+        with recording.RecordingWriter(self.dir / "capture.dynrec") as writer:
+            writer.write(0, self.samples)
+
+        self.service = query_service.QueryService(
+            port=0, seconds=1.0, recordings_dir=str(self.dir)
+        )
+        adc_config = ds.ADCConfigData(4, "HIGH_RESOLUTION", 1000, [1, 1, 1, 1])
+        self.service.setup({"ADCConfig": adc_config})
+        for i in range(0, 1500, 20):
+            block = buffer_pool.PooledBlock.wrap(self.samples[i : i + 20])
+            self.service.callback_block(ds.FeedHeader(i), block, 0)
+        self.client = query_service.Client(port=self.service.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.service.cleanup()
+        self.tmp.cleanup()
+
+    def test_info(self):
+        info = self.client.info()
+        self.assertEqual(info["sample_rate"], 1000)
+        self.assertEqual(info["device_info"]["ADCConfig"]["sample_rate"], 1000)
+        self.assertEqual(info["ring_ssns"], [500, 1500])  # 1 s at 1 kHz
+
+    def test_latest(self):
+        ssns, samples = self.client.latest(0.1)
+        np.testing.assert_array_equal(ssns, np.arange(1400, 1500))
+        np.testing.assert_array_equal(samples, self.samples[1400:1500])
+        ssns, _ = self.client.latest(60)  # Capped to the ring
+        self.assertEqual(len(ssns), 1000)
+
+    def test_recordings_and_range(self):
+        (found,) = self.client.recordings()
+        self.assertEqual((found["name"], found["n_samples"]), ("capture.dynrec", 20000))
+
+        overview = self.client.overview("capture.dynrec", width=50)
+        with recording.RecordingReader(self.dir / "capture.dynrec") as reader:
+            expected = reader.overview(width=50)
+        for name in ("edges", "count", "min", "max", "mean"):
+            np.testing.assert_array_equal(
+                getattr(overview, name), getattr(expected, name)
+            )
+        wide = self.client.overview("capture.dynrec", width=10**9)
+        self.assertEqual(len(wide.count), query_service.MAX_WIDTH)
+        zoomed = self.client.overview("capture.dynrec", 100, 150, width=50)
+        self.assertEqual(zoomed.bin_samples, 1)
+        np.testing.assert_array_equal(zoomed.max, self.samples[100:150])
+
+    def test_range_while_recording(self):
+        path = self.dir / "live.dynrec"
+        writer = recording.RecordingWriter(path, chunk_samples=1000, background=False)
+        try:
+            writer.write(0, self.samples[:5000])
+            writer.flush()
+            self.assertEqual(self.client.overview("live.dynrec").count.sum(), 5000)
+            reader = self.service._readers[path.resolve()]
+            # The writer's pyramid is used, the chunks aren't decoded again.
+            self.assertIs(reader.read_pyramid(), writer.pyramid)
+
+            writer.write(5000, self.samples[5000:8000])
+            writer.flush()
+            self.assertEqual(self.client.overview("live.dynrec").count.sum(), 8000)
+            self.assertIs(self.service._readers[path.resolve()], reader)
+            self.assertEqual(len(reader.chunks), 8)  # Indexed as they are written
+            names = {found["name"] for found in self.client.recordings()}
+            self.assertEqual(names, {"capture.dynrec", "live.dynrec"})
+        finally:
+            writer.close()
+
+    def test_compression_and_keep_alive(self):
+        compressed = self.client.get("/latest", seconds=1)
+        sock = self.client.connection.sock
+        self.client.info()
+        self.assertIs(self.client.connection.sock, sock)  # Same connection reused
+
+        with query_service.Client(port=self.service.port, compress=False) as plain:
+            self.assertEqual(plain.get("/latest", seconds=1), compressed)
+
+    def test_errors(self):
+        with self.assertRaisesRegex(RuntimeError, "404"):
+            self.client.overview("../capture.dynrec")
+        with self.assertRaisesRegex(RuntimeError, "404"):
+            self.client.get("/nothing")
+        with self.assertRaisesRegex(RuntimeError, "400"):
+            self.client.get("/range")
+        for seconds in ("inf", "nan", "-1"):
+            with self.assertRaisesRegex(RuntimeError, "400"):
+                self.client.get("/latest", seconds=seconds)
+        with self.assertRaisesRegex(RuntimeError, "400"):
+            self.client.overview("capture.dynrec", width=0)
+        with self.assertRaisesRegex(RuntimeError, "400"):
+            self.client.overview("capture.dynrec", 0, 2**70)
+        self.client.info()  # Still usable after errors
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# Run it like so: `python -m tests.test_recording`
+
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+import recording
+
+
+class RecordingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name) / "test.dynrec"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_encoding_round_trip_24_bit_extremes(self):
+        samples = np.array(
+            [[-(2**23), 2**23 - 1, 0, -1], [2**23 - 1, -(2**23), -1, 0]] * 3,
+            dtype=np.int32,
+        )
+        encoded = recording.encode_samples(samples)
+        self.assertEqual(len(encoded), samples.size * 3)
+        decoded = recording.decode_samples(encoded, len(samples), 4)
+        np.testing.assert_array_equal(decoded, samples)
+
+    def test_round_trip_with_gaps(self):
+        rng = np.random.default_rng(0)
+        samples = rng.integers(-(2**23), 2**23, (1000, 4), dtype=np.int32)
+        metadata = {"FirmwareRevision": "1.2.3"}
+
+        with recording.RecordingWriter(
+            self.path, sample_rate=32000, metadata=metadata, chunk_samples=128
+        ) as writer:
+            writer.write(100, samples[:500])
+            writer.write(610, samples[500:])  # 10 samples dropped
+
+        with recording.RecordingReader(self.path) as reader:
+            self.assertEqual(reader.metadata, metadata)
+            self.assertEqual(reader.sample_rate, 32000)
+            self.assertEqual(reader.n_samples, 1000)
+            # The gap closes a chunk early.
+            self.assertEqual(reader.chunks[3].n_samples, 500 - 3 * 128)
+            self.assertEqual(reader.chunks[4].first_ssn, 610)
+
+            ssns, decoded = reader.read()
+            np.testing.assert_array_equal(decoded, samples)
+            np.testing.assert_array_equal(
+                ssns, np.concatenate((np.arange(100, 600), np.arange(610, 1110)))
+            )
+
+            ssns, decoded = reader.read(590, 620)
+            np.testing.assert_array_equal(ssns, [*range(590, 600), *range(610, 620)])
+            np.testing.assert_array_equal(decoded, samples[490:510])
+
+    def test_truncated_and_corrupt_chunks(self):
+        samples = np.arange(400, dtype=np.int32).reshape(100, 4)
+        with recording.RecordingWriter(self.path, chunk_samples=50) as writer:
+            writer.write(0, samples)
+
+        # Cut the last chunk short, as a crash while writing would.
+        data = bytearray(self.path.read_bytes()[:-5])
+        with recording.RecordingReader(self.path) as reader:
+            payload_offset = reader.chunks[0].offset
+        data[payload_offset] ^= 0xFF
+        self.path.write_bytes(data)
+
+        with recording.RecordingReader(self.path) as reader:
+            self.assertEqual(len(reader.chunks), 1)
+            with self.assertRaises(ValueError):
+                reader.read_chunk(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# Run it like so: `python -m tests.test_replay`
+
+import asyncio
+import pathlib
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+import recording
+import replay
+
+# Don't wait a second per poll cycle in tests.
+dsbu._DISCONNECT_POLL_S = 0.01
+
+
+class CollectCallback(dsbu.NotifyCallbackFeeddatas):
+    def setup(self, device_dict):
+        self.device_dict = device_dict
+        self.ssns, self.samples, self.missing = [], [], 0
+
+    def callback(self, header, feeddatas, missing):
+        for i, data in enumerate(feeddatas):
+            self.ssns.append(header.sample_sequence_number + i)
+            self.samples.append([data.ch0, data.ch1, data.ch2, data.ch3])
+        self.missing += missing
+
+
+class ReplayTest(unittest.TestCase):
+    def test_pack_is_inverse_of_unpack(self):
+        samples = np.array([[0, -1, 2**23 - 1, -(2**23)], [5, 6, -7, 8]])
+        packet = ds.DynamiteSampler.ADCFeed.unpack(
+            replay.pack_feed_packet(70000, samples)
+        )
+        self.assertEqual(packet.header.sample_sequence_number, 70000 % 2**16)
+        self.assertEqual(packet.samples[0], ds.FeedData(0, -1, 2**23 - 1, -(2**23)))
+        self.assertEqual(packet.samples[1], ds.FeedData(5, 6, -7, 8))
+
+    def test_replay_recording(self):
+        rng = np.random.default_rng(0)
+        samples = rng.integers(-(2**23), 2**23, (300, 4), dtype=np.int32)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "capture.dynrec"
+            adc_config = ds.ADCConfigData(4, "high", 32000, [1, 1, 1, 1])
+            with recording.RecordingWriter(
+                path, sample_rate=32000, metadata={"ADCConfig": adc_config}
+            ) as writer:
+                writer.write(65500, samples[:200])
+                writer.write(65800, samples[200:])  # 100 samples dropped
+
+            sink = CollectCallback()
+            asyncio.run(replay.replay_recording(path, [], [sink], speed=0))
+
+        self.assertEqual(sink.device_dict["ADCConfig"], adc_config)
+        np.testing.assert_array_equal(sink.samples, samples)
+        self.assertEqual(sink.ssns[0], 65500)
+        self.assertEqual(sink.ssns[-1], 65899)  # Unwrapped past the 16-bit rollover
+        self.assertEqual(sink.missing, 100)
+
+    def test_stream_does_not_import_bleak(self):
+        code = "import sys, stream, replay; print('bleak' in sys.modules)"
+        out = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=pathlib.Path(__file__).parent.parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(out.stdout.strip(), "False")
+
+
+if __name__ == "__main__":
+    unittest.main()
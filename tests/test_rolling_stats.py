@@ -0,0 +1,90 @@
+# Run it like so: `python -m tests.test_rolling_stats`
+
+import contextlib
+import io
+import unittest
+
+import numpy as np
+
+import dynamite_sampler_api as ds
+import stream
+from rolling_stats import RollingStats
+
+
+class RollingStatsTest(unittest.TestCase):
+    def test_matches_full_recompute(self):
+        """Streaming in uneven batches must agree with numpy over the last window."""
+        rng = np.random.default_rng(0)
+        data = rng.integers(-(2**23), 2**23, size=(5000, 4))
+        window = 300  # Not a perfect square, so it gets rounded up to whole blocks
+
+        rs = RollingStats([window])
+        start = 0
+        for size in batch_sizes(len(data)):
+            rs.update(data[start : start + size])
+            start += size
+
+            stats = rs.stats()
+            last = data[max(0, start - stats.window) : start].astype(np.float64)
+            self.assertEqual(stats.count, len(last))
+            np.testing.assert_allclose(stats.mean, last.mean(axis=0))
+            np.testing.assert_allclose(stats.std, last.std(axis=0), rtol=1e-6)
+            np.testing.assert_allclose(
+                stats.rms, np.sqrt(np.square(last).mean(axis=0)), rtol=1e-6
+            )
+            np.testing.assert_array_equal(stats.min, last.min(axis=0))
+            np.testing.assert_array_equal(stats.max, last.max(axis=0))
+
+    def test_noise_ignores_offset_and_gaps(self):
+        rng = np.random.default_rng(1)
+        noise_std = 50.0
+        data = 2_000_000 + rng.normal(0, noise_std, size=(40000, 4))
+
+        rs = RollingStats([32000])
+        rs.update(data[:20000])
+        # A large step across a gap must not be counted as noise.
+        rs.update(data[20000:] + 100_000, missing=10)
+
+        stats = rs.stats()
+        np.testing.assert_allclose(stats.noise, noise_std, rtol=0.05)
+        self.assertEqual(rs.total_missing, 10)
+        self.assertEqual(rs.total_samples, 40000)
+
+    def test_no_samples(self):
+        rs = RollingStats([10, 100])
+        self.assertEqual(rs.snapshot(), {10: None, 100: None})
+
+
+class StatsPrinterTest(unittest.TestCase):
+    def test_windows_of_the_same_length(self):
+        # 0.1 s and 0.1004 s are both 100 samples at 1 kHz.
+        printer = stream.StatsPrinter([0.1, 0.1004, 1.0])
+        printer.setup(
+            {"ADCConfig": ds.ADCConfigData(4, "HIGH_RESOLUTION", 1000, [1] * 4)}
+        )
+        samples = np.zeros((1000, 4), np.int32)
+        samples[-100:] = 10
+        printer.stats.update(samples)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            printer.print_stats()
+        means = {
+            line.split()[0]: float(line.split()[3].rstrip(","))
+            for line in out.getvalue().splitlines()
+            if "ch0:" in line
+        }
+        self.assertEqual(means, {"[0.1s]": 10.0, "[0.1004s]": 10.0, "[1s]": 1.0})
+
+
+def batch_sizes(total: int):
+    """Batch sizes from single samples to more than a whole window."""
+    sizes = [1, 7, 12, 120, 299, 1000, 3]
+    i = 0
+    while total > 0:
+        size = min(sizes[i % len(sizes)], total)
+        yield size
+        total -= size
+        i += 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# Run it like so: `python -m tests.test_rotation`
+
+import csv
+import pathlib
+import tempfile
+import time
+import unittest
+
+import dynamite_sampler_api as ds
+import recording
+import rotation
+import stream
+
+
+def feed(sink, n_packets: int, samples_per_packet: int = 10, gap_at: int = -1):
+    ssn = 0
+    for i in range(n_packets):
+        missing = 5 if i == gap_at else 0
+        ssn += missing
+        feeddatas = [
+            ds.FeedData(ssn + j, -(ssn + j), 1, 2) for j in range(samples_per_packet)
+        ]
+        sink.callback(ds.FeedHeader(ssn), feeddatas, missing)
+        ssn += samples_per_packet
+
+
+class RotationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = pathlib.Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_csv_rotates_by_size(self):
+        sink = stream.FeedDataCSVWriter(str(self.dir / "capture.csv"), max_bytes=2000)
+        sink.setup({})
+        feed(sink, 50, gap_at=20)
+        sink.cleanup()
+
+        manifest = rotation.read_manifest(self.dir / "capture.csv")
+        self.assertGreater(len(manifest), 2)
+        self.assertFalse((self.dir / "capture.csv").exists())
+        self.assertEqual(sum(s["n_samples"] for s in manifest), 500)
+        self.assertEqual(sum(s["missing"] for s in manifest), 5)
+        self.assertEqual(manifest[0]["first_ssn"], 0)
+        self.assertEqual(manifest[-1]["end_ssn"], 505)
+
+        for segment in manifest:
+            path = self.dir / segment["path"]
+            self.assertEqual(path.stat().st_size, segment["bytes"])
+            with open(path, newline="") as f:
+                lines = [line for line in f if not line.startswith("#")]
+            rows = list(csv.reader(lines))
+            self.assertEqual(rows[0][0], "Sample Sequence Number")
+            self.assertEqual(int(rows[1][0]), segment["first_ssn"])
+            self.assertEqual(int(rows[-1][0]), segment["end_ssn"] - 1)
+            self.assertEqual(len(rows) - 1, segment["n_samples"])
+
+    def test_csv_without_rotation_keeps_path(self):
+        sink = stream.FeedDataCSVWriter(str(self.dir / "capture.csv"))
+        sink.setup({})
+        feed(sink, 3)
+        sink.cleanup()
+        self.assertTrue((self.dir / "capture.csv").exists())
+        self.assertFalse((self.dir / "capture.manifest.jsonl").exists())
+
+    def test_background_flush(self):
+        sink = stream.FeedDataCSVWriter(
+            str(self.dir / "capture.csv"), flush_interval=0.01
+        )
+        sink.setup({})
+        feed(sink, 3)
+        time.sleep(0.2)
+        # Visible on disk before the writer is closed.
+        with open(self.dir / "capture.csv") as f:
+            self.assertEqual(len(f.readlines()), 3 + 30)
+        sink.cleanup()
+
+    def test_recorder_rotates_by_time(self):
+        sink = stream.FeedDataRecorder(
+            str(self.dir / "capture.dynrec"), max_seconds=0.05, flush_interval=0.01
+        )
+        sink.setup({})
+        for _ in range(4):
+            feed(sink, 2)
+            time.sleep(0.1)
+        sink.cleanup()
+
+        manifest = rotation.read_manifest(self.dir / "capture.manifest.jsonl")
+        self.assertGreater(len(manifest), 1)
+        for segment in manifest:
+            with recording.RecordingReader(self.dir / segment["path"]) as reader:
+                self.assertEqual(reader.n_samples, segment["n_samples"])
+
+
+if __name__ == "__main__":
+    unittest.main()
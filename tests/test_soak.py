@@ -0,0 +1,99 @@
+# Run it like so: `python -m tests.test_soak`
+
+import asyncio
+import json
+import time
+import unittest
+
+import dynamite_sampler_bleak_util as dsbu
+import soak
+
+
+class CountingSink(dsbu.NotifyCallbackSamples):
+    def __init__(self):
+        self.samples = 0
+
+    def callback_block(self, header, block, missing):
+        self.samples += len(block.samples)
+
+
+class LeakySink(dsbu.NotifyCallbackSamples):
+    """Keeps a copy of every block."""
+
+    def __init__(self):
+        self.kept = []
+
+    def callback_block(self, header, block, missing):
+        self.kept.append(block.samples.copy())
+
+
+class SlowingSink(dsbu.NotifyCallbackSamples):
+    """Busy waits longer and longer per packet, 100 us more every second."""
+
+    def setup(self, device_dict):
+        self.start = time.perf_counter()
+
+    def callback_block(self, header, block, missing):
+        now = time.perf_counter()
+        deadline = now + (now - self.start) * 1e-4
+        while time.perf_counter() < deadline:
+            pass
+
+
+def run(callbacks, **kwargs):
+    kwargs.setdefault("sample_interval_s", 0.1)
+    kwargs.setdefault("warmup_s", 0.3)
+    device = soak.SimulatedDevice(sample_rate=8000, drop_rate=0.01)
+    return asyncio.run(
+        soak.run_soak(1.5, callbacks_feeddata=callbacks, device=device, **kwargs)
+    )
+
+
+class SoakTest(unittest.TestCase):
+    def test_clean_run(self):
+        sink = CountingSink()
+        report = run([sink])
+        self.assertTrue(report["passed"], report["failures"])
+        self.assertEqual(report["samples"], sink.samples)
+        self.assertGreater(report["missed_samples"], 0)  # Simulated drops
+        self.assertEqual(report["config"]["callbacks"], ["CountingSink"])
+        summary = report["summary"]
+        self.assertAlmostEqual(summary["packets_per_s"], 400 * 0.99, delta=40)
+        self.assertIn("samples:CountingSink", summary["latency"])
+        self.assertLessEqual(len(report["timeline"]["t_s"]), soak.TIMELINE_ROWS)
+
+        # Compact and comparable
+        self.assertLess(len(json.dumps(report)), 20_000)
+        self.assertIn("samples:CountingSink", soak.compare_reports(report, report))
+        self.assertIn("PASSED", soak.format_report(report))
+
+    def test_memory_growth_fails(self):
+        thresholds = soak.Thresholds(max_traced_growth_mb=0.1)
+        report = run([LeakySink()], thresholds=thresholds)
+        self.assertFalse(report["passed"])
+        self.assertTrue(report["failures"][0].startswith("Traced memory grew"))
+        self.assertIn("tests/test_soak.py", report["top_allocations"][0]["where"])
+
+    def test_latency_drift_fails(self):
+        report = run([SlowingSink()], trace_allocations=False)
+        self.assertFalse(report["passed"])
+        self.assertIn("Stage samples:SlowingSink drifted", report["failures"][-1])
+        self.assertEqual(report["top_allocations"], [])
+
+    def test_timeline_columns_line_up(self):
+        for n in (5, 120, 121, 240, 1000):
+            samples = [
+                soak._Sample(i, 0, 0, i, i, {"s": (i, i * 1000)}) for i in range(n)
+            ]
+            with self.subTest(n=n):
+                timeline = soak._timeline(samples)
+                rows = len(timeline["t_s"])
+                self.assertEqual(rows, min(n, soak.TIMELINE_ROWS))
+                self.assertEqual(timeline["t_s"][-1], n - 1)
+                # Largest since the previous row, which is the row's own here.
+                self.assertEqual(timeline["queue_depth_max"], timeline["t_s"])
+                self.assertEqual(len(timeline["stage_mean_us"]["s"]), rows - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
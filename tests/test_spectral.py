@@ -0,0 +1,58 @@
+# Run it like so: `python -m tests.test_spectral`
+
+import unittest
+
+import numpy as np
+
+from spectral import WelchPSD
+
+
+class WelchPSDTest(unittest.TestCase):
+    fs = 32000
+
+    def test_finds_mains_hum(self):
+        rng = np.random.default_rng(0)
+        t = np.arange(self.fs * 2) / self.fs
+        hum = 300 * np.sin(2 * np.pi * 60 * t)
+        data = 2_000_000 + rng.normal(0, 20, (len(t), 4)) + hum[:, np.newaxis]
+
+        psd = WelchPSD(self.fs, segment_len=8192)
+        psd.update(data)
+
+        for ch_peaks in psd.peaks(n=1):
+            freq, _ = ch_peaks[0]
+            self.assertAlmostEqual(freq, 60, delta=self.fs / 8192)
+
+    def test_density_integrates_to_variance(self):
+        rng = np.random.default_rng(1)
+        data = rng.normal(0, 50, (self.fs * 4, 4))
+
+        psd = WelchPSD(self.fs, segment_len=1024, averaging=0.01)
+        psd.update(data)
+
+        df = psd.freqs[1] - psd.freqs[0]
+        np.testing.assert_allclose(psd.psd.sum(axis=0) * df, 50**2, rtol=0.1)
+
+    def test_batching_does_not_matter(self):
+        rng = np.random.default_rng(2)
+        data = rng.normal(0, 1, (20000, 4))
+
+        whole = WelchPSD(self.fs, segment_len=512, overlap=0.75)
+        whole.update(data)
+
+        pieces = WelchPSD(self.fs, segment_len=512, overlap=0.75)
+        for start in range(0, len(data), 37):
+            pieces.update(data[start : start + 37])
+
+        self.assertEqual(whole.n_segments, pieces.n_segments)
+        np.testing.assert_allclose(whole.psd, pieces.psd)
+
+    def test_gap_restarts_segment(self):
+        psd = WelchPSD(self.fs, segment_len=100, overlap=0)
+        self.assertEqual(psd.update(np.zeros((60, 4))), 0)
+        self.assertEqual(psd.update(np.zeros((60, 4)), missing=3), 0)
+        self.assertEqual(psd.update(np.zeros((40, 4))), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+# Run it like so: `python -m tests.test_tx_power`
+
+import asyncio
+import json
+import pathlib
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+import buffer_pool
+import dynamite_sampler_api as ds
+import tx_power
+
+S = 1_000_000_000
+
+
+class SimulatedClient:
+    """Stand-in for a connected bleak.BleakClient whose link loses packets depending on
+    the TX power written to it."""
+
+    def __init__(self, power_dbm: int, loss: dict[int, float], seed: int = 0):
+        """loss: packet loss probability per power, the closest power below is used."""
+        self.power_dbm = power_dbm
+        self.loss = loss
+        self.writes = []
+        self.random = random.Random(seed)
+
+    async def write_gatt_char(self, uuid, data, response=None):
+        assert uuid == ds.TxPower.TxPowerSet.UUID
+        self.power_dbm = int.from_bytes(data, "little", signed=True)
+        self.writes.append(self.power_dbm)
+
+    def dropped(self) -> bool:
+        powers = [p for p in self.loss if p <= self.power_dbm]
+        loss = self.loss[max(powers)] if powers else 1.0
+        return self.random.random() < loss
+
+    async def stream(self, sink, seconds: float, packet_samples=10, packet_dt=0.01):
+        """Send packets for seconds of simulated time, returns (sent, received)."""
+        block = buffer_pool.PooledBlock.wrap(np.zeros((packet_samples, 4), np.int32))
+        missing = 0
+        received = 0
+        n_packets = int(seconds / packet_dt)
+        for i in range(n_packets):
+            if self.dropped():
+                missing += packet_samples
+                continue
+            header = ds.FeedHeader(i * packet_samples, int(i * packet_dt * S))
+            sink.callback_block(header, block, missing)
+            missing = 0
+            received += packet_samples
+            await asyncio.sleep(0)  # Lets the TX power writes run
+        return n_packets * packet_samples, received
+
+
+# Clean from 0 dBm up, marginal at -4 dBm, bad below.
+LOSS = {-40: 0.5, -8: 0.1, -4: 0.02, 0: 0.0}
+
+
+class TxPowerControllerTest(unittest.TestCase):
+    def test_hysteresis(self):
+        controller = tx_power.TxPowerController(0, lower_after_s=5, window_s=2)
+        t = 0
+        for _ in range(3000):  # 30 s at a missed rate between the thresholds
+            t += S // 100
+            missed = 1 if t % S == 0 else 0  # 1 in 1000 samples
+            self.assertIsNone(controller.observe(t, 10, missed))
+        self.assertEqual(controller.power_dbm, 0)
+        self.assertGreater(controller.missed_rate, controller.lower_below)
+        self.assertLess(controller.missed_rate, controller.raise_above)
+
+        for _ in range(600):  # Clean for 6 s, lowered once the window is clean
+            t += S // 100
+            if controller.observe(t, 10, 0) is not None:
+                break
+        self.assertEqual(controller.power_dbm, -4)
+        (decision,) = controller.decisions
+        self.assertEqual((decision.from_dbm, decision.to_dbm), (0, -4))
+        self.assertEqual(decision.reason, "link clean")
+
+    def test_limits(self):
+        controller = tx_power.TxPowerController(
+            100, min_dbm=-8, max_dbm=0, raise_after_s=0, min_interval_s=0
+        )
+        self.assertEqual(controller.levels, [-8, -4, 0])
+        self.assertEqual(controller.power_dbm, 0)
+        self.assertIsNone(controller.observe(0, 10, 10))  # Already at max_dbm
+        with self.assertRaises(AssertionError):
+            tx_power.TxPowerController(0, raise_above=0.01, lower_below=0.01)
+
+    def test_revert(self):
+        controller = tx_power.TxPowerController(
+            -8, raise_after_s=0, min_interval_s=1, window_s=1
+        )
+        self.assertEqual(controller.observe(S, 10, 10), -4)
+        controller.revert()
+        self.assertEqual(controller.power_dbm, -8)
+        self.assertEqual(controller.decisions, [])
+        self.assertEqual(controller._hold_ns, {})
+        # Not retried before min_interval_s, and no decision while told not to.
+        self.assertIsNone(controller.observe(S + S // 2, 10, 10))
+        self.assertIsNone(controller.observe(3 * S, 10, 10, decide=False))
+        self.assertGreater(controller.missed_rate, 0.4)
+        self.assertEqual(controller.observe(3 * S, 10, 10), -4)
+
+
+class FailingClient(SimulatedClient):
+    async def write_gatt_char(self, uuid, data, response=None):
+        raise OSError("not connected")
+
+
+class SlowClient(SimulatedClient):
+    async def write_gatt_char(self, uuid, data, response=None):
+        await asyncio.sleep(0.05)
+        await super().write_gatt_char(uuid, data, response)
+
+
+class AdaptiveTxPowerTest(unittest.TestCase):
+    def run_simulation(self, initial_dbm: int, seconds: float, **kwargs):
+        async def scenario():
+            client = SimulatedClient(initial_dbm, LOSS)
+            sink = tx_power.AdaptiveTxPower(client, **kwargs)
+            sink.setup({"TxPowerLevel": initial_dbm})
+            sent, received = await client.stream(sink, seconds)
+            sink.cleanup()
+            return client, sink, received / sent
+
+        return asyncio.run(scenario())
+
+    def test_steps_down_to_lowest_clean_power(self):
+        client, sink, completeness = self.run_simulation(4, 300)
+        decisions = sink.controller.decisions
+
+        self.assertEqual(client.power_dbm, 0)
+        self.assertEqual(client.writes, [d.to_dbm for d in decisions])
+        self.assertGreater(completeness, 0.999)
+        # Each failed try of -4 dBm waits twice as long as the previous one.
+        tries = [d.t_s for d in decisions if d.to_dbm == -4]
+        self.assertGreaterEqual(len(tries), 3)
+        gaps = np.diff(tries)
+        np.testing.assert_array_less(gaps[:-1] * 1.5, gaps[1:])
+        self.assertTrue(
+            all(d.reason == "losing samples after lowering" for d in decisions[3::2])
+        )
+        # Rate limited
+        times = [d.t_s for d in decisions]
+        self.assertGreaterEqual(min(np.diff(times)), 2.0)
+
+    def test_steps_up_from_lossy_power(self):
+        client, sink, completeness = self.run_simulation(-20, 25)
+        self.assertEqual(client.writes, [-16, -12, -8, -4, 0])
+        self.assertEqual(sink.controller.decisions[0].reason, "losing samples")
+        self.assertGreater(completeness, 0.6)
+
+    def test_failed_write_is_reverted(self):
+        async def scenario(log_path):
+            client = FailingClient(-20, LOSS)
+            sink = tx_power.AdaptiveTxPower(client, log_path=log_path)
+            sink.setup({"TxPowerLevel": -20})
+            await client.stream(sink, 10)
+            return sink
+
+        with tempfile.TemporaryDirectory() as tmp:
+            log_path = pathlib.Path(tmp) / "txpower.jsonl"
+            sink = asyncio.run(scenario(str(log_path)))
+            self.assertFalse(log_path.exists())  # No decision was applied
+        self.assertGreater(sink.write_errors, 1)  # Retried, but rate limited
+        self.assertLess(sink.write_errors, 10)
+        self.assertEqual(sink.controller.power_dbm, -20)
+        self.assertLessEqual(len(sink.controller.decisions), 1)  # The last, pending
+
+    def test_missed_samples_counted_while_writing(self):
+        block = buffer_pool.PooledBlock.wrap(np.zeros((10, 4), np.int32))
+
+        async def scenario():
+            client = SlowClient(-20, LOSS)
+            sink = tx_power.AdaptiveTxPower(client, raise_after_s=0, window_s=100)
+            sink.setup({"TxPowerLevel": -20})
+            sink.callback_block(ds.FeedHeader(0, 0), block, 10)  # Raises the power
+            self.assertIsNotNone(sink.pending)
+            for i in range(1, 5):
+                sink.callback_block(ds.FeedHeader(i * 10, i * S), block, 10)
+            missed_rate = sink.controller.missed_rate
+            await asyncio.sleep(0.1)
+            return client, sink, missed_rate
+
+        client, sink, missed_rate = asyncio.run(scenario())
+        self.assertEqual(missed_rate, 0.5)  # Counted while the write was pending
+        self.assertEqual(client.writes, [-16])  # No other decision meanwhile
+
+    def test_decision_log(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_path = pathlib.Path(tmp) / "txpower.jsonl"
+            _, sink, _ = self.run_simulation(-8, 30, log_path=str(log_path))
+            with open(log_path) as f:
+                rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), len(sink.controller.decisions))
+        self.assertEqual((rows[0]["from_dbm"], rows[0]["to_dbm"]), (-8, -4))
+        self.assertGreater(rows[0]["missed_rate"], 0.005)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,287 @@
+"""Adaptive TX power: keep the link complete at the lowest power that does it.
+
+TxPowerController watches the samples missed (as counted by SsnUnwrapper) over a
+sliding window and decides when to change the TX power, one level at a time:
+- up when the missed rate of the window goes over raise_above, after raise_after_s at
+  the current power,
+- down when it stayed under lower_below for lower_after_s at the current power.
+The gap between the two thresholds is the hysteresis. No two changes are closer than
+min_interval_s, and every step up doubles the time before the level that lost samples
+is tried again (up to max_hold_s), so a marginal level isn't retried over and over. The
+window starts over on every change, so decisions are only made from samples received
+at the current power.
+
+AdaptiveTxPower is the callback running it on a FeedSession: it writes the power to the
+board's TxPower.TxPowerSet and logs every decision.
+"""
+
+import asyncio
+import collections
+import dataclasses
+import json
+import pathlib
+import time
+from typing import Optional
+
+import dynamite_sampler_api as ds
+import dynamite_sampler_bleak_util as dsbu
+
+# [dBm] The TX powers stepped through by default, one at a time.
+TX_POWER_LEVELS = (-40, -20, -16, -12, -8, -4, 0, 3, 4)
+
+
+@dataclasses.dataclass
+class TxPowerDecision:
+    """A change of TX power, with the window it was decided on."""
+
+    time: float  # [Seconds] Wall clock time of the decision
+    t_s: float  # [Seconds] Since the first observation
+    from_dbm: int
+    to_dbm: int
+    missed_rate: float  # Of the window at from_dbm
+    samples: int  # Received in the window
+    span_s: float  # [Seconds] Length of the window
+    reason: str
+
+    def __str__(self):
+        return (
+            f"TX power {self.from_dbm} -> {self.to_dbm} dBm: {self.reason} (missed "
+            f"{self.missed_rate:.3%} of {self.samples} samples over {self.span_s:.1f}s)"
+        )
+
+
+class TxPowerController:
+    """Decides the TX power from the missed samples, see the module docstring. It only
+    decides; the caller applies the power returned by observe(), or revert()s the
+    change if it couldn't."""
+
+    def __init__(
+        self,
+        initial_dbm: int,
+        levels: tuple[int, ...] = TX_POWER_LEVELS,
+        min_dbm: Optional[int] = None,
+        max_dbm: Optional[int] = None,
+        window_s: float = 5.0,
+        raise_above: float = 0.005,
+        lower_below: float = 0.0005,
+        raise_after_s: float = 1.0,
+        lower_after_s: float = 10.0,
+        min_interval_s: float = 2.0,
+        max_hold_s: float = 600.0,
+    ):
+        """
+        initial_dbm:    The power the board is at, moved to the closest level.
+        levels:         The powers to choose from, in dBm.
+        min_dbm, max_dbm: Limit the levels used.
+        window_s:       [Seconds] Length of the sliding window of the missed rate.
+        raise_above:    Missed rate (missed / sent samples) over which power goes up.
+        lower_below:    Missed rate under which power goes down.
+        raise_after_s:  [Seconds] Time at a power before raising it.
+        lower_after_s:  [Seconds] Time at a power before lowering it, doubled for
+                        each time the level below lost samples.
+        min_interval_s: [Seconds] The minimum time between two changes.
+        max_hold_s:     [Seconds] Cap of the time before retrying a failed level.
+        """
+        assert 0 <= lower_below < raise_above, "lower_below must be under raise_above"
+        self.levels = sorted(
+            level
+            for level in levels
+            if (min_dbm is None or level >= min_dbm)
+            and (max_dbm is None or level <= max_dbm)
+        )
+        assert self.levels, "No TX power level in [min_dbm, max_dbm]"
+        self.window_ns = int(window_s * 1e9)
+        self.raise_above = float(raise_above)
+        self.lower_below = float(lower_below)
+        self.raise_after_ns = int(raise_after_s * 1e9)
+        self.lower_after_ns = int(lower_after_s * 1e9)
+        self.min_interval_ns = int(min_interval_s * 1e9)
+        self.max_hold_ns = int(max_hold_s * 1e9)
+
+        self.index = min(
+            range(len(self.levels)), key=lambda i: abs(self.levels[i] - initial_dbm)
+        )
+        self.decisions: list[TxPowerDecision] = []
+        # (time_ns, samples, missed) of each observation in the window, and their sums
+        self._window = collections.deque()
+        self._samples = 0
+        self._missed = 0
+        self._first_ns: Optional[int] = None
+        self._since_ns = 0  # When the current power was set
+        self._changed_ns: Optional[int] = None  # The last change
+        self._lowered_from: Optional[int] = None  # Level of the last step down
+        # Time at a level before lowering from it, once the level below lost samples
+        self._hold_ns: dict[int, int] = {}
+        self._undo: Optional[tuple] = None  # State before the last change, see revert()
+        self._wall_offset_s = time.time() - time.monotonic()
+
+    @property
+    def power_dbm(self) -> int:
+        return self.levels[self.index]
+
+    @property
+    def missed_rate(self) -> float:
+        """Missed rate of the window."""
+        total = self._samples + self._missed
+        return self._missed / total if total else 0.0
+
+    def observe(
+        self, now_ns: int, samples: int, missed: int, decide: bool = True
+    ) -> Optional[int]:
+        """Record a packet of samples received at now_ns (time.monotonic_ns()) and the
+        samples missed before it. Returns the new power in dBm if it should change,
+        never when decide is False (e.g. while the last change is being applied)."""
+        if self._first_ns is None:
+            self._first_ns = self._since_ns = now_ns
+        window = self._window
+        window.append((now_ns, samples, missed))
+        self._samples += samples
+        self._missed += missed
+        while window[0][0] < now_ns - self.window_ns:
+            _, old_samples, old_missed = window.popleft()
+            self._samples -= old_samples
+            self._missed -= old_missed
+
+        if not decide or (
+            self._changed_ns is not None
+            and now_ns - self._changed_ns < self.min_interval_ns
+        ):
+            return None
+        at_power_ns = now_ns - self._since_ns
+        rate = self.missed_rate
+        if rate > self.raise_above:
+            if at_power_ns >= self.raise_after_ns and self.index + 1 < len(self.levels):
+                reason = "losing samples"
+                if self._lowered_from == self.index + 1:
+                    reason = "losing samples after lowering"
+                # The level loses samples, wait longer before trying it again.
+                hold = self._hold_ns.get(self.index + 1, self.lower_after_ns)
+                hold = min(2 * hold, self.max_hold_ns)
+                return self._change(now_ns, self.index + 1, reason, hold)
+        elif rate < self.lower_below and self.index > 0:
+            hold_ns = self._hold_ns.get(self.index, self.lower_after_ns)
+            if at_power_ns >= hold_ns:
+                return self._change(now_ns, self.index - 1, "link clean")
+        return None
+
+    def revert(self):
+        """Undo the last change, when it couldn't be applied: back to the previous
+        power and timers, and its decision dropped. The failed attempt still counts
+        for min_interval_s, so it isn't retried on every packet."""
+        if self._undo is None:
+            return
+        self.index, self._lowered_from, self._since_ns, self._hold_ns = self._undo
+        self._undo = None
+        self.decisions.pop()
+
+    def _change(
+        self, now_ns: int, index: int, reason: str, hold_ns: Optional[int] = None
+    ) -> int:
+        decision = TxPowerDecision(
+            time=self._wall_offset_s + now_ns / 1e9,
+            t_s=(now_ns - self._first_ns) / 1e9,
+            from_dbm=self.power_dbm,
+            to_dbm=self.levels[index],
+            missed_rate=self.missed_rate,
+            samples=self._samples,
+            span_s=(now_ns - self._window[0][0]) / 1e9,
+            reason=reason,
+        )
+        self.decisions.append(decision)
+        self._undo = (self.index, self._lowered_from, self._since_ns, self._hold_ns)
+        if hold_ns is not None:
+            self._hold_ns = {**self._hold_ns, index: hold_ns}
+        self._lowered_from = self.index if index < self.index else None
+        self.index = index
+        self._changed_ns = self._since_ns = now_ns
+        self._window.clear()
+        self._samples = self._missed = 0
+        return decision.to_dbm
+
+
+class AdaptiveTxPower(dsbu.NotifyCallbackSamples):
+    """Runs a TxPowerController on the feed and writes its decisions to the board.
+
+    The decisions are printed, kept in controller.decisions and, with log_path,
+    appended to a JSON lines file once written to the board. The writes run on the
+    session's event loop; while one is in flight the controller keeps counting the
+    missed samples but makes no new decision, and a write that failed is reverted in
+    the controller.
+    """
+
+    def __init__(
+        self,
+        client,
+        initial_dbm: Optional[int] = None,
+        log_path: Optional[str] = None,
+        **controller_kwargs,
+    ):
+        """
+        client:         The connected bleak.BleakClient to write the TX power with.
+        initial_dbm:    The power the board is at. Read from the device info
+                        (TxPowerLevel) when not given, or 0 if it has none.
+        log_path:       JSON lines file to append the decisions to.
+        controller_kwargs: see TxPowerController.
+        """
+        self.client = client
+        self.initial_dbm = initial_dbm
+        self.log_path = pathlib.Path(log_path) if log_path else None
+        self.controller_kwargs = controller_kwargs
+        self.controller: Optional[TxPowerController] = None
+        self.write_errors = 0
+
+    def setup(self, device_dict):
+        initial_dbm = self.initial_dbm
+        if initial_dbm is None:
+            initial_dbm = device_dict.get("TxPowerLevel")
+        if initial_dbm is None:
+            initial_dbm = 0
+        self.controller = TxPowerController(initial_dbm, **self.controller_kwargs)
+        # FeedSession calls setup() from its event loop.
+        self.loop = asyncio.get_running_loop()
+        self.pending: Optional[asyncio.Future] = None
+        print(
+            f"Adaptive TX power starting at {self.controller.power_dbm} dBm, levels "
+            f"{self.controller.levels}"
+        )
+
+    def callback_block(self, header: ds.FeedHeader, block, missing: int):
+        if self.pending is not None and self.pending.done():
+            # Checked here rather than by the write, as this may run on another thread.
+            if not self.pending.result():
+                self.controller.revert()
+            self.pending = None
+        now_ns = header.arrival_ns
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        power = self.controller.observe(
+            now_ns, len(block.samples), missing, decide=self.pending is None
+        )
+        if power is not None:
+            decision = self.controller.decisions[-1]
+            print(decision)
+            # Thread safe, so this also works behind a pipeline.ThreadedCallback.
+            self.pending = asyncio.run_coroutine_threadsafe(
+                self._write(decision), self.loop
+            )
+
+    async def _write(self, decision: TxPowerDecision) -> bool:
+        power = decision.to_dbm
+        try:
+            await dsbu.write_characteristic(self.client, ds.TxPower.TxPowerSet, power)
+        except Exception as e:
+            self.write_errors += 1
+            print(f"Adaptive TX power: failed to set {power} dBm: {e}")
+            return False
+        # Only logged once applied, a decision that failed is reverted.
+        if self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(dataclasses.asdict(decision)) + "\n")
+        return True
+
+    def cleanup(self):
+        if self.controller is not None:
+            print(
+                f"Adaptive TX power: {len(self.controller.decisions)} changes, ended at "
+                f"{self.controller.power_dbm} dBm"
+            )
@@ -8,7 +8,6 @@ import threading
 import socket
 
 from bt import bt_setup
-from replay import replay_setup
 
 parsed_bt_queue = asyncio.Queue()
 shutdown_event = threading.Event()
@@ -49,12 +48,8 @@ async def send_queue_data_to_socket(queue: asyncio.Queue):
 
 
 async def main():
+    # To stream a recording instead of a device, see `stream.py --replay`.
     await bt_setup(parsed_bt_queue, shutdown_event)
-    # await replay_setup(
-    #     "./sample_data/datadump_20241212_123045.txt",
-    #     parsed_bt_queue,
-    #     shutdown_event,
-    # )
 
     task = asyncio.create_task(send_queue_data_to_socket(parsed_bt_queue))
     await asyncio.gather(task, return_exceptions=True)